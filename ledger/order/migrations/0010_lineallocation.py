@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from decimal import Decimal
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+DETAILS = (
+    ('payment', 'payment_details'),
+    ('refund', 'refund_details'),
+    ('deduction', 'deduction_details')
+)
+CHUNK_SIZE = 2000
+
+
+def backfill_allocations(apps, schema_editor):
+    Line = apps.get_model('order', 'Line')
+    LineAllocation = apps.get_model('order', 'LineAllocation')
+    last = 0
+    while True:
+        lines = list(Line.objects.filter(pk__gt=last).order_by('pk').values_list('pk', 'payment_details', 'refund_details', 'deduction_details')[:CHUNK_SIZE])
+        if not lines:
+            break
+        allocations = {}
+        for line in lines:
+            for (kind, _), details in zip(DETAILS, line[1:]):
+                for source, amounts in (details or {}).items():
+                    for txn_id, amount in amounts.items():
+                        key = (line[0], kind, source, int(txn_id))
+                        allocations[key] = allocations.get(key, Decimal('0.0')) + Decimal(amount)
+        LineAllocation.objects.bulk_create([
+            LineAllocation(line_id=l, kind=k, source=s, transaction_id=t, amount=a)
+            for (l, k, s, t), a in allocations.items()
+        ])
+        last = lines[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0009_auto_20171129_1301'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LineAllocation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('payment', 'Payment'), ('refund', 'Refund'), ('deduction', 'Deduction')], max_length=10)),
+                ('source', models.CharField(choices=[('bpay', 'BPAY'), ('card', 'Card'), ('cash', 'Cash')], max_length=4)),
+                ('transaction_id', models.IntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('line', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allocations', to='order.Line')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='lineallocation',
+            unique_together=set([('line', 'kind', 'source', 'transaction_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='lineallocation',
+            index_together=set([('source', 'transaction_id', 'kind')]),
+        ),
+        migrations.RunPython(backfill_allocations, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,9 @@
 import json
 from decimal import Decimal as D
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Sum
+from django.db.models.signals import post_save
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.postgres.fields import JSONField
 from oscar.apps.order.abstract_models import AbstractLine as CoreAbstractLine
@@ -20,29 +23,24 @@ class Line(CoreAbstractLine):
     refund_details = JSONField(db_index=True,default=DEFAULT_PAYMENT)
     deduction_details = JSONField(db_index=True,default=DEFAULT_PAYMENT)
 
+    def _allocated(self, kind):
+        # sum prefetched allocations, e.g. prefetch_related('allocations') on a list of lines
+        prefetched = getattr(self, '_prefetched_objects_cache', {}).get('allocations')
+        if prefetched is not None:
+            return sum((a.amount for a in prefetched if a.kind == kind), D('0.0'))
+        return self.allocations.filter(kind=kind).aggregate(total=Sum('amount'))['total'] or D('0.0')
+
     @property
     def paid(self):
-        amount = D(0.0)
-        for k,v in self.payment_details.items():
-            for i,a in v.items():
-                amount += D(a)
-        return amount
+        return self._allocated('payment')
 
     @property
     def refunded(self):
-        amount = D(0.0)
-        for k,v in self.refund_details.items():
-            for i,a in v.items():
-                amount += D(a)
-        return amount
+        return self._allocated('refund')
 
     @property
     def deducted(self):
-        amount = D(0.0)
-        for k,v in self.deduction_details.items():
-            for i,a in v.items():
-                amount += D(a)
-        return amount
+        return self._allocated('deduction')
 
     # A line reference is the ID that a partner uses to represent this
     # particular line (it's not the same as a SKU).
@@ -53,4 +51,98 @@ class Line(CoreAbstractLine):
     partner_line_notes = models.TextField(
         _("Partner Notes"), blank=True, null=True)
 
+
+class LineAllocation(models.Model):
+    ''' Amount of a transaction allocated to a line.
+        Mirrors the payment_details, refund_details and deduction_details
+        of the line, which are still written while code moves over to this table.
+    '''
+    KIND_CHOICES = (
+        ('payment', 'Payment'),
+        ('refund', 'Refund'),
+        ('deduction', 'Deduction')
+    )
+    SOURCE_CHOICES = (
+        ('bpay', 'BPAY'),
+        ('card', 'Card'),
+        ('cash', 'Cash')
+    )
+    # line details field holding each kind of allocation
+    DETAILS = (
+        ('payment', 'payment_details'),
+        ('refund', 'refund_details'),
+        ('deduction', 'deduction_details')
+    )
+    line = models.ForeignKey(Line, related_name='allocations', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    source = models.CharField(max_length=4, choices=SOURCE_CHOICES)
+    transaction_id = models.IntegerField()
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = ('line', 'kind', 'source', 'transaction_id')
+        index_together = ('source', 'transaction_id', 'kind')
+
+    def __str__(self):
+        return '{} {} {} on line {}: {}'.format(self.source, self.transaction_id, self.kind, self.line_id, self.amount)
+
+    @classmethod
+    def from_details(cls, line):
+        ''' Build the allocations of a line from its details fields.
+        '''
+        allocations = {}
+        for kind, details in cls.DETAILS:
+            for source, amounts in (getattr(line, details) or {}).items():
+                for txn_id, amount in amounts.items():
+                    key = (kind, source, int(txn_id))
+                    allocations[key] = allocations.get(key, D('0.0')) + D(amount)
+        return [cls(line_id=line.pk, kind=k, source=s, transaction_id=t, amount=a) for (k, s, t), a in allocations.items()]
+
+    @classmethod
+    def sync(cls, lines):
+        ''' Bring the allocations of the lines in line with their details fields.
+            Only changed amounts are updated, so allocations keep the date they were created.
+        '''
+        lines = [l for l in lines if l.pk]
+        if not lines:
+            return
+        wanted = {}
+        for line in lines:
+            for a in cls.from_details(line):
+                wanted[(a.line_id, a.kind, a.source, a.transaction_id)] = a
+        with transaction.atomic():
+            stored = cls.objects.filter(line__in=[l.pk for l in lines]).values_list('pk', 'line', 'kind', 'source', 'transaction_id', 'amount')
+            removed, changed = [], {}
+            for pk, line_id, kind, source, txn_id, amount in stored:
+                allocation = wanted.pop((line_id, kind, source, txn_id), None)
+                if allocation is None:
+                    removed.append(pk)
+                elif allocation.amount != amount:
+                    changed.setdefault(allocation.amount, []).append(pk)
+            if removed:
+                cls.objects.filter(pk__in=removed).delete()
+            for amount, pks in changed.items():
+                cls.objects.filter(pk__in=pks).update(amount=amount)
+            cls.objects.bulk_create(wanted.values())
+
+    @classmethod
+    def allocated(cls, source, transaction_id, kind):
+        ''' Total amount of a transaction allocated to lines.
+        '''
+        return cls.objects.filter(source=source, transaction_id=transaction_id, kind=kind).aggregate(total=Sum('amount'))['total'] or D('0.0')
+
+
+class LineListener(object):
+    """
+    Event listener for Line
+    """
+
+    @staticmethod
+    @receiver(post_save, sender=Line)
+    def _post_save(sender, instance, created, **kwargs):
+        if created and not LineAllocation.from_details(instance):
+            return
+        LineAllocation.sync([instance])
+
 from oscar.apps.order.models import *  # noqa
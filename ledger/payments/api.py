@@ -1,7 +1,7 @@
 import json
 from django.db import transaction
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.template.loader import get_template
 from django.template import TemplateDoesNotExist
 from django.core.exceptions import ValidationError
@@ -105,7 +105,7 @@ class BpayTransactionViewSet(viewsets.ReadOnlyModelViewSet):
         queryset = self.get_queryset()
         sorting = request.GET.get('sorting',None)
         if sorting and sorting.lower() == 'unmatched':
-            queryset = [q for q in queryset if not q.matched]
+            queryset = queryset.filter(matched_invoice__isnull=True)
         serializer = self.get_serializer(queryset,many=True)
         return Response(serializer.data)
 
@@ -163,11 +163,12 @@ class BpayCollectionSerializer(serializers.ModelSerializer):
             txn_only = kwargs.pop("txns_only")
         except:
             txn_only = False
+        summary_only = kwargs.pop("summary_only", False)
         super(BpayCollectionSerializer,self).__init__(*args, **kwargs)
 
         if txn_only:
             self.fields['transactions'] = BpayTransactionSerializer(many=True,read_only=True)
-        else:
+        elif not summary_only:
             self.fields['files'] = BpayFileSerializer(many=True)
 
 class BpayCollectionViewSet(viewsets.ReadOnlyModelViewSet):
@@ -176,6 +177,11 @@ class BpayCollectionViewSet(viewsets.ReadOnlyModelViewSet):
     renderer_classes = (JSONRenderer,)
     lookup_field = 'created'
 
+    def list(self, request, *args, **kwargs):
+        # The listing only shows the daily totals, the files of a collection are on its detail
+        serializer = BpayCollectionSerializer(self.get_queryset(), many=True, summary_only=True)
+        return Response(serializer.data)
+
     def retrieve(self, request, created=None, format=None):
         try:
             instance = BpayCollection.objects.get(date=created)
@@ -965,7 +971,7 @@ class ReportCreateView(views.APIView):
                                             serializer.validated_data['end'],
                                             district = serializer.validated_data['district'])
             if report:
-                response = HttpResponse(FileWrapper(report), content_type='text/csv')
+                response = StreamingHttpResponse(report, content_type='text/csv')
                 response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(filename)
                 return response
             else:
@@ -2,17 +2,18 @@ import datetime
 import traceback
 import csv
 import logging
+import multiprocessing
 import pytz
 from six.moves import StringIO
 from os import listdir
 from os.path import isfile, join
 from decimal import Decimal
-from django.db import IntegrityError, transaction
+from django.db import IntegrityError, connections, transaction
 from django.core.mail import EmailMessage, get_connection
 from django.conf import settings
 from ledger.payments.bpay.models import *
 from ledger.payments.bpay.crn import getCRN
-from ledger.payments.utils import update_payments
+from ledger.payments.utils import update_payments, allocate_payments
 
 logging.info('Starting logger for BPAY.')
 logger = logging.getLogger(__name__)
@@ -145,155 +146,179 @@ def checkStepValue(value):
         return '0{}'.format(value)
     return value
 
-def validate_file(f):
-    '''Check if the specified file is valid.
+# Number of columns of each record type
+RECORD_COLUMNS = {
+    '01': 9,    # file header
+    '02': 8,    # group header
+    '03': 15,   # account identifier
+    '30': 21,   # transaction detail
+    '49': 3,    # account trailer
+    '98': 4,    # group trailer
+    '99': 4,    # file trailer
+}
+# Record types allowed to follow each record type, None being the start of the file
+NEXT_RECORDS = {
+    None: ('01',),
+    '01': ('02', '99'),
+    '02': ('03', '98'),
+    '03': ('30', '49'),
+    '30': ('30', '49'),
+    '49': ('03', '98'),
+    '98': ('02', '99'),
+    '99': (),
+}
+# Model and builder of the records stored in bulk
+RECORD_BUILDERS = {
+    '02': (BpayGroupRecord, record_grouprec),
+    '03': (BpayAccountRecord, record_accountrec),
+    '30': (BpayTransaction, record_txn),
+    '49': (BpayAccountTrailer, record_accounttrailer),
+    '98': (BpayGroupTrailer, record_grouptrailer),
+}
+
+def invalid_record(line, message):
+    error = 'An error occured at line {0}: {1}'.format(line, message)
+    logger.error(error)
+    raise Exception(error)
+
+def store_records(reader, batch_size):
+    '''Validate the records of a file while building them, in a single pass.
+        Records are checked for their order and number of columns, and
+        stored in bulk every batch_size records of a type, the file
+        trailer last. Returns the stored BpayFile.
     '''
-    # Validate steps
-    steps = {
-        '01': 1,
-        '02': 2,
-        '03': 3,
-        '30': 4,
-        '49': 5,
-        '98': 6,
-        '99': 7
-    }
-    steps_count = {
-        1: 0,
-        2: 0,
-        3: 0,
-        4: 0,
-        5: 0,
-        6: 0,
-        7: 0
-    }
-    step_column_length = {
-        1: 9,
-        2: 8,
-        3: 15,
-        4: 21,
-        5: 3,
-        6: 4,
-        7: 4
-    }
-    prev_step = 0
-    current_step = 0
-    error = None
-    line = 1
-    row_count = 0
-    try:
-        reader = csv.reader(f)
-        for row in reader:
-            if row:
-                # Get current step value and check if it one step ahead of previous step.
-                current_step = steps.get(checkStepValue(row[0]))
-                # Count the number of record in the file
-                steps_count[current_step] += 1
-                    
-                # Get current step valid column number
-                if len(row) != step_column_length.get(current_step):
-                    error = 'An error occured at line {0}: Check this line and make sure that it meets the required length of {1}.'.format(line, step_column_length.get(current_step))
-                    logger.error(error)
-                    raise Exception(error)
-            line += 1
-            row_count += 1
-        if row_count > 2:
-            for k,v in steps_count.items():
-                if v < 1:
-                    error = 'An error occured at line {0}: Ensure that the file contains all the record types.'.format(line)
-                    logger.error(error)
-                    raise Exception(error)
-            
-    except:
-        raise
+    bpay_file = trailer = biller_code = previous = None
+    seen = set()
+    rows = 0
+    pending = dict((model, []) for model, build in RECORD_BUILDERS.values())
+
+    def flush(model):
+        if pending[model]:
+            if model is BpayTransaction:
+                BpayTransaction.match(pending[model])
+            model.objects.bulk_create(pending[model])
+            pending[model] = []
+
+    line = 0
+    for line, row in enumerate(reader, 1):
+        if not row:
+            continue
+        step = checkStepValue(row[0])
+        if step not in RECORD_COLUMNS:
+            invalid_record(line, 'Unknown record type {0}.'.format(row[0]))
+        if step not in NEXT_RECORDS[previous]:
+            invalid_record(line, 'A record of type {0} can\'t follow {1}.'.format(step, previous or 'the start of the file'))
+        if len(row) != RECORD_COLUMNS[step]:
+            invalid_record(line, 'Check this line and make sure that it meets the required length of {0}.'.format(RECORD_COLUMNS[step]))
+        previous = step
+        seen.add(step)
+        rows += 1
+
+        if step == '01':
+            # Format the time to 24h
+            bpay_file = BpayFile(created=validate_datetime(row[3],row[4]), file_id=row[5])
+            bpay_file.save()
+        elif step == '99':
+            trailer = record_filetrailer(row, bpay_file)
+        else:
+            if step == '02':
+                biller_code = row[1]
+            elif step == '30':
+                if row[11] in ['APF','LBX']:
+                    continue
+                row.append(biller_code)
+            model, build = RECORD_BUILDERS[step]
+            pending[model].append(build(row, bpay_file))
+            if len(pending[model]) >= batch_size:
+                flush(model)
+
+    if previous != '99':
+        invalid_record(line, 'The file ends before the file trailer.')
+    if rows > 2 and len(seen) < len(RECORD_COLUMNS):
+        invalid_record(line, 'Ensure that the file contains all the record types.')
+    for model in pending:
+        flush(model)
+    trailer.save()
+    return bpay_file
+
+def allocate_file_payments(bpay_files, batch=False):
+    '''Update the payments of the invoices paid by the transactions of the files.
+        With batch set the payments are allocated for all the invoices at once.
+    '''
+    from ledger.payments.models import Invoice
+    crns = BpayTransaction.objects.filter(file__in=bpay_files).values_list('crn', flat=True)
+    references = Invoice.objects.filter(reference__in=crns).values_list('reference', flat=True)
+    if batch:
+        allocate_payments(references)
+    else:
+        for reference in references:
+            update_payments(reference)
 
-def parseFile(file_path):
+def parseFile(file_path, batch=False, batch_size=None, allocate=True, refresh_collection=True):
     '''Parse the file in order to create the relevant
         objects.
+        The file is read once, validating the records as they are
+        built, and stored in its own transaction in bulk batches of
+        batch_size (BPAY_PARSER_BATCH_SIZE by default).
+        With batch set the payments of the new transactions are allocated
+        for all the matching invoices at once.
+        allocate and refresh_collection can be turned off to update
+        the payments and the collection of several files together.
     '''
-    from ledger.payments.models import Invoice
     f = get_file(file_path)
-    transaction_list, group_list, account_list = [], [], []
-    transaction_rows, group_rows, account_rows  = [], [], []
-    accountttrailer_rows, grouptrailer_rows, filetrailer_row = [], [], None
-    accountttrailer_list, grouptrailer_list = [], []
-    bpay_file = None
-    success = True
-    biller_code = None
     try:
-        # Validate the file first
-        validate_file(f)
-        f.seek(0)
-        reader = csv.reader(f)
-        # Instanciate a new Bpay File
-        bpay_file = BpayFile()
-        for row in reader:
-            if row:
-                if checkStepValue(row[0]) == '01':
-                    # Format the time to 24h
-                    bpay_file.created = validate_datetime(row[3],row[4])
-                    bpay_file.file_id = row[5]
-                elif checkStepValue(row[0]) == '02':
-                    biller_code = row[1]
-                    group_rows.append(row)
-                elif checkStepValue(row[0]) == '03':
-                    account_rows.append(row)
-                elif checkStepValue(row[0]) == '30':
-                    if row[11] not in ['APF','LBX']:
-                        #transaction_list.append(record_txn(row,bpay_file))
-                        row.append(biller_code)
-                        transaction_rows.append(row)
-                elif checkStepValue(row[0]) == '49':
-                    accountttrailer_rows.append(row)
-                elif checkStepValue(row[0]) == '98':
-                    grouptrailer_rows.append(row)
-                elif checkStepValue(row[0]) == '99':
-                    filetrailer_row = row
-
         with transaction.atomic():
-            bpay_file.save()
-            # Create Group Records
-            for row in group_rows:
-                group_list.append(record_grouprec(row,bpay_file))
-            # Create Account Records
-            for row in account_rows:
-                account_list.append(record_accountrec(row,bpay_file))
-            # Create transactions
-            for row in transaction_rows:
-                transaction_list.append(record_txn(row,bpay_file))
-            # Create Account Trailer Records
-            for row in accountttrailer_rows:
-                accountttrailer_list.append(record_accounttrailer(row,bpay_file))
-            # Create Group Trailer Records
-            for row in grouptrailer_rows:
-                grouptrailer_list.append(record_grouptrailer(row,bpay_file))
-            # Store Records
-            BpayGroupRecord.objects.bulk_create(group_list)
-            BpayAccountRecord.objects.bulk_create(account_list)
-            BpayTransaction.objects.bulk_create(transaction_list)
-            BpayAccountTrailer.objects.bulk_create(accountttrailer_list)
-            BpayGroupTrailer.objects.bulk_create(grouptrailer_list)
-            # Create File Trailer Record
-            record_filetrailer(filetrailer_row,bpay_file).save()
-
+            bpay_file = store_records(csv.reader(f), batch_size or settings.BPAY_PARSER_BATCH_SIZE)
             # Update payments in the new transaction invoices
-            for t in bpay_file.transactions.all():
-                try:
-                    inv = Invoice.objects.get(reference=t.crn)
-                    update_payments(inv.reference)
-                except Invoice.DoesNotExist:
-                    pass
-        return success,bpay_file,''
+            if allocate:
+                allocate_file_payments([bpay_file], batch=batch)
+        if refresh_collection:
+            BpayCollection.refresh(bpay_file.collection_date)
+        return True,bpay_file,''
     except IntegrityError as e:
-        success = False
-        return success,None,e.message
+        return False,None,str(e)
     except Exception as e:
         traceback.print_exc()
-        success = False
-        return success,None,e.message
+        return False,None,str(e)
     finally:
         f.close()
 
+def _parse_in_worker(args):
+    '''Parse a file in a worker process, leaving the payments and
+        the collection to be updated once all the files are stored.
+    '''
+    file_path, batch_size = args
+    status, bfile, reason = parseFile(file_path, batch_size=batch_size, allocate=False, refresh_collection=False)
+    return status, bfile.pk if bfile else None, reason
+
+def parseFiles(paths, batch=False, batch_size=None, workers=1):
+    '''Parse a list of files, in parallel worker processes with more
+        than one worker. Each file is stored in its own transaction.
+        In parallel the collections and payments of the files are updated
+        after all of them are stored, so that workers don't update the same
+        collection or invoice at once.
+        Returns (success, BpayFile, reason) for each path in order.
+    '''
+    if workers <= 1 or len(paths) <= 1:
+        return [parseFile(p, batch=batch, batch_size=batch_size) for p in paths]
+
+    # The workers are forked and must open their own database connections
+    for conn in connections.all():
+        conn.close()
+    pool = multiprocessing.Pool(min(workers, len(paths)))
+    try:
+        results = pool.map(_parse_in_worker, [(p, batch_size) for p in paths])
+    finally:
+        pool.close()
+        pool.join()
+
+    stored = BpayFile.objects.in_bulk([pk for status, pk, reason in results if pk])
+    for date in set(f.collection_date for f in stored.values()):
+        BpayCollection.refresh(date)
+    with transaction.atomic():
+        allocate_file_payments(list(stored.values()), batch=batch)
+    return [(status, stored.get(pk), reason) for status, pk, reason in results]
+
 def getfiles(path):
     files = []
     try:
@@ -377,28 +402,23 @@ def sendBillerCodeEmail(summaries,monthly=False):
     
 
 def generateTransactionsSummary(files,unmatched_only=False):
+    '''Summarise the transactions of the files per biller code, files
+        being [name, BpayFile] pairs, or a BpayFile queryset with unmatched_only.
+        Without files, unmatched_only summarises every unmatched transaction.
+    '''
     try:
         # Split transactions into biller codes
         biller_codes = {}
         biller_code_emails = {}
+        txns = BpayTransaction.objects.order_by('file', 'pk')
         if unmatched_only:
-            for f in files:
-                for t in f.transactions.all():
-                    if t.biller_code in biller_codes:
-                        txns = list(biller_codes[t.biller_code])
-                        txns.append(t)
-                        biller_codes[t.biller_code] = txns
-                    else:
-                        biller_codes[t.biller_code] = [t]
+            txns = txns.filter(matched_invoice__isnull=True)
+            if files is not None:
+                txns = txns.filter(file__in=files)
         else:
-            for n, f in files:
-                for t in f.transactions.all():
-                    if t.biller_code in biller_codes:
-                        txns = list(biller_codes[t.biller_code])
-                        txns.append(t)
-                        biller_codes[t.biller_code] = txns
-                    else:
-                        biller_codes[t.biller_code] = [t]
+            txns = txns.filter(file__in=[f for n, f in files])
+        for t in BpayTransaction.match(txns):
+            biller_codes.setdefault(t.biller_code, []).append(t)
         # Generate summaries per biller code
         for k,v in biller_codes.items():
             matched = []
@@ -429,10 +449,10 @@ def generateTransactionsSummary(files,unmatched_only=False):
         raise
 
 def monthlyReport():
-    files =  BpayFile.objects.all()
-    sendBillerCodeEmail(generateTransactionsSummary(files,unmatched_only=True),monthly=True)
+    # the stored matches are indexed, so this doesn't read the matched history
+    sendBillerCodeEmail(generateTransactionsSummary(None,unmatched_only=True),monthly=True)
 
-def bpayParser(path):
+def bpayParser(path, batch=False, batch_size=None, workers=None):
     files = getfiles(path)
     valid_files = []
     failed_files = []
@@ -440,10 +460,11 @@ def bpayParser(path):
     processed_files = []
     try:
         if settings.NOTIFICATION_EMAIL:
-            for p,n in files:
-                status,bfile,reason = parseFile(p)
+            results = parseFiles([p for p,n in files], batch=batch, batch_size=batch_size,
+                                 workers=workers or settings.BPAY_PARSER_WORKERS)
+            for (p,n),(status,bfile,reason) in zip(files,results):
                 if bfile is not None:
-                    if bfile.transactions.all():
+                    if bfile.transactions.exists():
                         valid_files.append([n,bfile])
                     else:
                         other_files.append([n,bfile])
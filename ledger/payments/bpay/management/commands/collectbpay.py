@@ -6,13 +6,18 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('path')
+        parser.add_argument('--batch', action='store_true', default=False,
+                            help='Allocate the payments of all the invoices in a file at once.')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Number of records of a type stored at once (default BPAY_PARSER_BATCH_SIZE).')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of files parsed in parallel (default BPAY_PARSER_WORKERS).')
     
     def handle(self, *args, **options):
         try:
-            bpayParser(options['path'])
+            bpayParser(options['path'], batch=options['batch'], batch_size=options['batch_size'], workers=options['workers'])
         except Exception as e:
             raise CommandError(e)
         
         self.stdout.write(self.style.SUCCESS('Parsed files successfully.'))
     
-    
\ No newline at end of file
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Files are collected by the UTC date they were created on, the same grouping
+# as the date(created) of the view this table replaces.
+BACKFILL_FILES = "UPDATE payments_bpayfile SET collection_date = date(created AT TIME ZONE 'UTC')"
+
+# Same totals as BpayCollection.refresh: every file on the date is counted,
+# files without account records add nothing to the totals
+BACKFILL_COLLECTIONS = """
+INSERT INTO payments_bpaycollection (date, count, credit_total, cheque_total, debit_total, total)
+SELECT f.collection_date, count(*), coalesce(sum(a.credit_total), 0), coalesce(sum(a.cheque_total), 0), coalesce(sum(a.debit_total), 0),
+       coalesce(sum(a.credit_total), 0) + coalesce(sum(a.cheque_total), 0) + coalesce(sum(a.debit_total), 0)
+FROM payments_bpayfile f
+LEFT JOIN (
+    SELECT file_id, sum(credit_amount) AS credit_total, sum(cheque_amount) AS cheque_total, sum(debit_amount) AS debit_total
+    FROM payments_bpayaccountrecord GROUP BY file_id
+) a ON f.id = a.file_id
+GROUP BY f.collection_date
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bpay', '0014_auto_20180118_1505'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bpayfile',
+            name='collection_date',
+            field=models.DateField(db_index=True, null=True, help_text='UTC date of the file creation, the collection the file belongs to.'),
+        ),
+        migrations.RunSQL(BACKFILL_FILES, migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='bpayfile',
+            name='collection_date',
+            field=models.DateField(db_index=True, help_text='UTC date of the file creation, the collection the file belongs to.'),
+        ),
+        migrations.RunSQL('DROP VIEW IF EXISTS bpay_bpaycollection_v', migrations.RunSQL.noop),
+        migrations.DeleteModel(
+            name='BpayCollection',
+        ),
+        migrations.CreateModel(
+            name='BpayCollection',
+            fields=[
+                ('date', models.DateField(primary_key=True, serialize=False)),
+                ('count', models.IntegerField()),
+                ('credit_total', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('cheque_total', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('debit_total', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('total', models.DecimalField(decimal_places=2, max_digits=12)),
+            ],
+            options={
+                'db_table': 'payments_bpaycollection',
+            },
+        ),
+        migrations.RunSQL(BACKFILL_COLLECTIONS, 'DELETE FROM payments_bpaycollection'),
+    ]
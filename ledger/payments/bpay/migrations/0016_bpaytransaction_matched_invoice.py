@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# An invoice with the CRN takes precedence over a link to an invoice
+BACKFILL_CRNS = """
+UPDATE payments_bpaytransaction t SET matched_invoice_id = i.id
+FROM payments_invoice i WHERE i.reference = t.crn
+"""
+
+BACKFILL_LINKS = """
+UPDATE payments_bpaytransaction t SET matched_invoice_id = l.invoice_id
+FROM payments_invoicebpay l WHERE l.bpay_id = t.id AND t.matched_invoice_id IS NULL
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0009_invoice_payment_summary'),
+        ('bpay', '0015_bpaycollection_table'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bpaytransaction',
+            name='matched_invoice',
+            field=models.ForeignKey(blank=True, help_text='Invoice with the CRN of the transaction, or linked to it.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='matched_bpay_transactions', to='invoice.Invoice'),
+        ),
+        migrations.RunSQL(BACKFILL_CRNS, migrations.RunSQL.noop),
+        migrations.RunSQL(BACKFILL_LINKS, migrations.RunSQL.noop),
+    ]
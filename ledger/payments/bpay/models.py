@@ -1,13 +1,22 @@
-from django.db import models, connection
+from django.db import models
 from django.conf import settings
 from decimal import Decimal as D
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models import Sum
+from django.db.models.signals import pre_save, post_delete
 from django.utils.encoding import python_2_unicode_compatible
 from django.core.validators import MinLengthValidator
 from django.core.exceptions import ValidationError
 from oscar.apps.order.models import Order
+from ledger.order.models import LineAllocation
 import datetime
+import pytz
+
+def get_collection_date(created):
+    '''The collection a file created at the given time belongs to,
+        collections are grouped by the UTC date of creation.
+    '''
+    return created.astimezone(pytz.utc).date()
 
 class BpayJobRecipient(models.Model):
     email = models.EmailField(unique=True)
@@ -22,6 +31,7 @@ class BpayFile(models.Model):
     inserted = models.DateTimeField(auto_now_add=True)
     created = models.DateTimeField(help_text='File Creation Date Time.')
     file_id = models.BigIntegerField(help_text='File Identification Number.')
+    collection_date = models.DateField(db_index=True, help_text='UTC date of the file creation, the collection the file belongs to.')
 
     class Meta:
         unique_together = ('created','file_id')
@@ -29,6 +39,10 @@ class BpayFile(models.Model):
         
     def __unicode__(self):
         return 'File #{0} {1}'.format(self.file_id,self.created.strftime('%Y-%m-%d %H:%M:%S'))
+
+    def save(self, *args, **kwargs):
+        self.collection_date = get_collection_date(self.created)
+        super(BpayFile, self).save(*args, **kwargs)
     
     @property
     def items_validated(self):
@@ -44,23 +58,9 @@ class BpayFileTrailer(models.Model):
     class Meta:
         db_table = 'payments_bpayfiletrailer'
 
-@receiver(post_save, sender=BpayFileTrailer)
-def update_file_view(sender, instance, **kwargs):
-    try:
-        cursor = connection.cursor()
-        sql = 'CREATE OR REPLACE VIEW bpay_bpaycollection_v AS \
-                select date(created), count(*), sum(a.credit_total) as credit_total, \
-                sum(a.cheque_total) as cheque_total,sum(a.debit_total) as debit_total, \
-                (sum(a.credit_total)+sum(a.cheque_total)+sum(a.debit_total)) as total from payments_bpayfile f\
-                inner join \
-                (select file_id,sum(credit_amount) as credit_total,sum(cheque_amount) as cheque_total,\
-                sum(debit_amount) as debit_total from payments_bpayaccountrecord GROUP BY \
-                file_id,credit_amount,cheque_amount,debit_amount) a \
-                on f.id=a.file_id \
-                group by date(f.created);'
-        cursor.execute(sql)
-    except Exception as e:
-        raise ValidationError(e)
+@receiver(post_delete, sender=BpayFile)
+def remove_from_collection(sender, instance, **kwargs):
+    BpayCollection.refresh(instance.collection_date)
 
 class BpayTransaction(models.Model):
     TRANSACTION_TYPE = (
@@ -121,11 +121,44 @@ class BpayTransaction(models.Model):
     discount_method = models.CharField(max_length=3, null=True, blank=True, help_text='Discount Method Code.')
     biller_code = models.CharField(max_length=10)
     file = models.ForeignKey(BpayFile, related_name='transactions')
+    matched_invoice = models.ForeignKey('invoice.Invoice', null=True, blank=True, on_delete=models.SET_NULL, related_name='matched_bpay_transactions', help_text='Invoice with the CRN of the transaction, or linked to it.')
 
     class Meta:
         unique_together = ('crn', 'txn_ref', 'p_date')
         db_table = 'payments_bpaytransaction'
 
+    @classmethod
+    def match(cls, transactions):
+        '''Resolve the invoices of a set of transactions, with one query
+            for the invoices with their CRNs and one for the invoice links.
+            An invoice with the CRN takes precedence over a link.
+            Sets matched_invoice and linked on each transaction and returns them.
+        '''
+        from ledger.payments.invoice.models import Invoice, InvoiceBPAY
+        transactions = list(transactions)
+        if not transactions:
+            return transactions
+        references = dict(Invoice.objects.filter(reference__in=set(t.crn for t in transactions)).values_list('reference', 'id'))
+        saved = [t.pk for t in transactions if t.pk]
+        links = dict(InvoiceBPAY.objects.filter(bpay__in=saved).values_list('bpay', 'invoice')) if saved else {}
+        for t in transactions:
+            t.matched_invoice_id = references.get(t.crn, links.get(t.pk))
+            t._linked = t.pk in links
+        return transactions
+
+    @classmethod
+    def sync_matches(cls, transactions):
+        '''Store the matched invoice of the transactions where it changed.
+        '''
+        transactions = list(transactions)
+        stored = dict((t.pk, t.matched_invoice_id) for t in transactions)
+        changed = {}
+        for t in cls.match(transactions):
+            if t.matched_invoice_id != stored[t.pk]:
+                changed.setdefault(t.matched_invoice_id, []).append(t.pk)
+        for invoice, pks in changed.items():
+            cls.objects.filter(pk__in=pks).update(matched_invoice=invoice)
+
     @property
     def approved(self):
         if self.service_code == '0':
@@ -134,48 +167,17 @@ class BpayTransaction(models.Model):
 
     @property
     def order(self):
-        from ledger.payments.models import Invoice, InvoiceBPAY
-        order = None
-        try:
-            order = Order.objects.get(number=Invoice.objects.get(reference=self.crn).order_number)
-        except Order.DoesNotExist:
-            pass
-        except Invoice.DoesNotExist:
-            pass
-        
-        if not order:
-            try:    
-                order = Order.objects.get(number=InvoiceBPAY.objects.get(bpay=self).invoice.order_number)
-            except InvoiceBPAY.DoesNotExist:
-                pass
-        
-        return order
+        if self.matched_invoice is None:
+            return None
+        return Order.objects.filter(number=self.matched_invoice.order_number).first()
 
     @property
     def payment_allocated(self):
-        allocated = D('0.0')
-        if self.order:
-            lines = self.order.lines.all()
-            for line in lines:
-                for k,v in line.payment_details.items():
-                    if k == 'bpay':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += D(a)
-        return allocated
+        return LineAllocation.allocated('bpay', self.id, 'payment')
 
     @property
     def refund_allocated(self):
-        allocated = D('0.0')
-        if self.order:
-            lines = self.order.lines.all()
-            for line in lines:
-                for k,v in line.refund_details.items():
-                    if k == 'bpay':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += D(a)
-        return allocated
+        return LineAllocation.allocated('bpay', self.id, 'refund')
 
     @property
     def system(self):
@@ -183,42 +185,23 @@ class BpayTransaction(models.Model):
     
     @property
     def matched(self):
-        from ledger.payments.invoice.models import Invoice, InvoiceBPAY
-        matched = False
-        
-        # Check if there is any invoice with a matching crn
-        try:
-            Invoice.objects.get(reference=self.crn)
-            matched = True
-        except Invoice.DoesNotExist:
-            pass
-        
-        # Check if there is any association between invoice and this payment
-        if not matched:
-            try:
-                InvoiceBPAY.objects.get(bpay=self)
-                matched = True
-            except InvoiceBPAY.DoesNotExist:
-                pass
-        
-        return matched
+        return self.matched_invoice_id is not None
     
     @property
     def linked(self):
         from ledger.payments.invoice.models import InvoiceBPAY
-        linked = False
-        # Check if there is any association between invoice and this payment
-        try:
-            InvoiceBPAY.objects.get(bpay=self)
-            linked = True
-        except InvoiceBPAY.DoesNotExist:
-            pass
-        
-        return linked
+        if not hasattr(self, '_linked'):
+            self._linked = InvoiceBPAY.objects.filter(bpay=self).exists()
+        return self._linked
 
     def __unicode__(self):
         return str(self.crn)
 
+@receiver(pre_save, sender=BpayTransaction)
+def update_matched_invoice(sender, instance, **kwargs):
+    # The crn changes when funds are moved to another invoice
+    BpayTransaction.match([instance])
+
 class BpayGroupRecord(models.Model):
     DATE_MODIFIERS = (
         (1,'interim/previous day'),
@@ -271,19 +254,34 @@ class BpayCollection(models.Model):
     total = models.DecimalField(max_digits=12,decimal_places=2)
     
     class Meta:
-        managed = False
-        db_table = 'bpay_bpaycollection_v'
-        
+        db_table = 'payments_bpaycollection'
+
+    @classmethod
+    def refresh(cls, date):
+        '''Recalculate the summary of the files collected on a date
+            from that date's files only.
+        '''
+        count = BpayFile.objects.filter(collection_date=date).count()
+        if not count:
+            cls.objects.filter(date=date).delete()
+            return None
+        totals = BpayAccountRecord.objects.filter(file__collection_date=date).aggregate(
+            credit_total=Sum('credit_amount'),
+            cheque_total=Sum('cheque_amount'),
+            debit_total=Sum('debit_amount')
+        )
+        totals = {k: v or D('0.00') for k, v in totals.items()}
+        totals['total'] = totals['credit_total'] + totals['cheque_total'] + totals['debit_total']
+        collection, created = cls.objects.update_or_create(date=date, defaults=dict(count=count, **totals))
+        return collection
+
     @property
     def files(self):
-        return BpayFile.objects.filter(created__contains=self.date)
+        return BpayFile.objects.filter(collection_date=self.date)
     
     @property
     def transactions(self):
-        txns = []
-        for f in self.files:
-            txns.extend(f.transactions.all())
-        return txns
+        return BpayTransaction.objects.filter(file__collection_date=self.date)
     
 class BillerCodeSystem(models.Model):
     biller_code = models.CharField(max_length=10,unique=True)
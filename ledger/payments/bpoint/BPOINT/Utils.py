@@ -6,12 +6,86 @@ Created on 15 Jan 2015
 import requests
 import json
 import base64
+import threading
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 class RequestSender(object):
+    # The connection pool is shared by every sender in the process, with a
+    # session per thread on top of it. Idempotent requests and failed
+    # connections are retried; a POST that reached the gateway never is.
+    pool_size = 10
+    max_retries = 3
+    backoff_factor = 0.5
+    retry_statuses = (502, 503, 504)
+
+    _adapter = None
+    _lock = threading.Lock()
+    _local = threading.local()
+    _generation = 0
+    _stats = {"requests": 0, "failures": 0}
+
     def __init__(self, base_url):
         self.base_url = base_url
         self.user_agent = "Premier.Billpay.API.BPOINT.Python-V1.0";
-        
+
+    @classmethod
+    def configure(cls, pool_size = None, max_retries = None, backoff_factor = None):
+        with cls._lock:
+            if pool_size is not None:
+                cls.pool_size = pool_size
+            if max_retries is not None:
+                cls.max_retries = max_retries
+            if backoff_factor is not None:
+                cls.backoff_factor = backoff_factor
+            if cls._adapter is not None:
+                cls._adapter.close()
+            cls._adapter = None
+            cls._generation += 1
+
+    @classmethod
+    def get_adapter(cls):
+        with cls._lock:
+            if cls._adapter is None:
+                retry = Retry(total = cls.max_retries, backoff_factor = cls.backoff_factor,
+                              status_forcelist = cls.retry_statuses, raise_on_status = False)
+                cls._adapter = HTTPAdapter(pool_connections = cls.pool_size, pool_maxsize = cls.pool_size,
+                                           max_retries = retry, pool_block = False)
+            return cls._adapter
+
+    @classmethod
+    def get_session(cls):
+        session = getattr(cls._local, "session", None)
+        if session is None or cls._local.generation != cls._generation:
+            generation = cls._generation
+            adapter = cls.get_adapter()
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            cls._local.session = session
+            cls._local.generation = generation
+        return session
+
+    @classmethod
+    def pool_stats(cls):
+        stats = {"pool_size": cls.pool_size, "pools": 0, "connections": 0, "pool_requests": 0}
+        with cls._lock:
+            stats.update(cls._stats)
+            if cls._adapter is not None:
+                pools = cls._adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        stats["pools"] += 1
+                        stats["connections"] += pool.num_connections
+                        stats["pool_requests"] += pool.num_requests
+        return stats
+
+    @classmethod
+    def _count(cls, key):
+        with cls._lock:
+            cls._stats[key] += 1
+
     def send(self, request):
         credentials = request.credentials
         auth_header_value = base64.b64encode((credentials.username + "|" +
@@ -32,15 +106,16 @@ class RequestSender(object):
             header_dict["User-Agent"] = request.user_agent
         else:
             header_dict["User-Agent"] = self.user_agent
-            
-        if method == "POST":
-            endpoint = requests.post(url, data = payload, headers = header_dict, timeout = request.timeout / 1000)
-        elif method == "GET":
-            endpoint = requests.get(url, headers = header_dict, timeout = request.timeout / 1000)
-        elif method == "PUT":
-            endpoint = requests.put(url, data = payload, headers = header_dict, timeout = request.timeout / 1000)
-        elif method == "DELETE":
-            endpoint = requests.delete(url, headers = header_dict, timeout = request.timeout / 1000)
+
+        if method in ("GET", "DELETE"):
+            payload = None
+
+        self._count("requests")
+        try:
+            endpoint = self.get_session().request(method, url, data = payload, headers = header_dict, timeout = request.timeout / 1000)
+        except requests.RequestException:
+            self._count("failures")
+            raise
         
         return json.loads(endpoint.text)
 
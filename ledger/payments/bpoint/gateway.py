@@ -6,6 +6,13 @@ from ledger.payments.bpoint.BPOINT.API import (TransactionRequest,
                                                TransactionSearchRequest,
                                                AddDVTokenRequest,
                                                DeleteDVTokenRequest)
+from ledger.payments.bpoint.BPOINT.Utils import RequestSender
+
+RequestSender.configure(
+    pool_size=settings.BPOINT_POOL_SIZE,
+    max_retries=settings.BPOINT_MAX_RETRIES,
+    backoff_factor=settings.BPOINT_BACKOFF_FACTOR
+)
 
 class Gateway(object):
 
@@ -7,6 +7,7 @@ from django.core.exceptions import ValidationError
 from ledger.payments.bpoint import settings as bpoint_settings
 from django.utils.encoding import python_2_unicode_compatible
 from oscar.apps.order.models import Order
+from ledger.order.models import LineAllocation
 from ledger.accounts.models import EmailUser
 from ledger.payments.emails import send_refund_email
 
@@ -80,39 +81,11 @@ class BpointTransaction(models.Model):
 
     @property
     def payment_allocated(self):
-        from ledger.payments.models import Invoice
-        allocated = D('0.0')
-        try:
-            invoice = Invoice.objects.get(reference=self.crn1)
-        except Invoice.DoesNotExist:
-            invoice = None
-        if invoice and invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.payment_details.items():
-                    if k == 'card':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += D(a)
-        return allocated
+        return LineAllocation.allocated('card', self.id, 'payment')
 
     @property
     def refund_allocated(self):
-        from ledger.payments.models import Invoice
-        allocated = D('0.0')
-        try:
-            invoice = Invoice.objects.get(reference=self.crn1)
-        except Invoice.DoesNotExist:
-            invoice = None
-        if invoice and invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.refund_details.items():
-                    if k == 'card':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += D(a)
-        return allocated
+        return LineAllocation.allocated('card', self.id, 'refund')
 
     @property
     def refundable_amount(self):
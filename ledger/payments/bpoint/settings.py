@@ -5,4 +5,8 @@ BPOINT_BILLER_CODE = getattr(settings, 'BPOINT_BILLER_CODE')
 BPOINT_USERNAME = getattr(settings, 'BPOINT_USERNAME')
 BPOINT_PASSWORD = getattr(settings,'BPOINT_PASSWORD')
 BPOINT_MERCHANT_NUM = getattr(settings,'BPOINT_MERCHANT_NUM')
-BPOINT_TEST = getattr(settings, 'BPOINT_TEST') #set transactions to bpoint as test 
\ No newline at end of file
+BPOINT_TEST = getattr(settings, 'BPOINT_TEST') #set transactions to bpoint as test 
+# Connection pool for the BPOINT API client
+BPOINT_POOL_SIZE = getattr(settings, 'BPOINT_POOL_SIZE', 10)
+BPOINT_MAX_RETRIES = getattr(settings, 'BPOINT_MAX_RETRIES', 3)
+BPOINT_BACKOFF_FACTOR = getattr(settings, 'BPOINT_BACKOFF_FACTOR', 0.5)
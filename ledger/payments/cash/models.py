@@ -1,10 +1,13 @@
 from __future__ import unicode_literals
 import decimal
 from django.db import models
+from django.dispatch import receiver
+from django.db.models.signals import post_delete, post_save
 from django.core.exceptions import ValidationError
 from ledger.payments.bpoint import settings as bpoint_settings
 from django.utils.encoding import python_2_unicode_compatible
-from ledger.payments.invoice.models import Invoice
+from ledger.payments.invoice.models import Invoice, update_payment_summaries
+from ledger.order.models import LineAllocation
 
 DISTRICT_PERTH_HILLS = 'PHS'
 DISTRICT_SWAN_COASTAL = 'SWC'
@@ -158,42 +161,22 @@ class CashTransaction(models.Model):
 
     @property
     def payment_allocated(self):
-        allocated = decimal.Decimal('0.0')
-        invoice = self.invoice
-        if invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.payment_details.items():
-                    if k == 'cash':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += decimal.Decimal(a)
-        return allocated
+        return LineAllocation.allocated('cash', self.id, 'payment')
 
     @property
     def refund_allocated(self):
-        allocated = decimal.Decimal('0.0')
-        invoice = self.invoice
-        if invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.refund_details.items():
-                    if k == 'cash':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += decimal.Decimal(a)
-        return allocated
+        return LineAllocation.allocated('cash', self.id, 'refund')
 
     @property
     def deduction_allocated(self):
-        allocated = decimal.Decimal('0.0')
-        invoice = self.invoice
-        if invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.deduction_details.items():
-                    if k == 'cash':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += decimal.Decimal(a)
-        return allocated
+        return LineAllocation.allocated('cash', self.id, 'deduction')
+
+class CashTransactionListener(object):
+    """
+    Event listener for CashTransaction
+    """
+
+    @staticmethod
+    @receiver([post_save, post_delete], sender=CashTransaction)
+    def _changed(sender, instance, **kwargs):
+        update_payment_summaries([instance.invoice_id])
@@ -2,12 +2,12 @@ from __future__ import unicode_literals
 import traceback
 import decimal
 from django.db import models,transaction
-from django.db.models import Q
-from django.db.models import Sum
+from django.db.models import Q, F
+from django.db.models import Sum, Case, When
 from django.db.models.functions import Coalesce
 from django.conf import settings
-from django.dispatch import receiver
-from django.db.models.signals import post_delete, pre_save, post_save
+from django.dispatch import receiver, Signal
+from django.db.models.signals import post_delete, pre_save, post_save, pre_delete
 from django.utils.encoding import python_2_unicode_compatible
 from django.core.exceptions import ValidationError
 from oscar.apps.order.models import Order
@@ -15,6 +15,39 @@ from ledger.payments.bpay.crn import getCRN
 from ledger.payments.bpay.models import BpayTransaction
 from ledger.payments.bpoint.models import BpointTransaction, TempBankCard, BpointToken, UsedBpointToken
 
+# Sent after an invoice's payment summary has been recalculated
+payment_summary_updated = Signal(providing_args=['invoice'])
+
+# Conditional sums over each transaction table, keyed by payment total
+CASH_TOTALS = {
+    'cash_payments': Q(type='payment'),
+    'cash_move_ins': Q(type='move_in'),
+    'cash_reversals': Q(type='reversal'),
+    'cash_move_outs': Q(type='move_out'),
+    'cash_refunds': Q(type='refund'),
+}
+BPOINT_TOTALS = {
+    'bpoint_payments': Q(action__in=['payment', 'capture'], response_code='0'),
+    'bpoint_reversals': Q(action='reversal', response_code='0'),
+    'bpoint_refunds': Q(action='refund', response_code='0'),
+}
+BPAY_TOTALS = {
+    'bpay_payments': Q(p_instruction_code='05', type=399),
+    'bpay_reversals': Q(p_instruction_code='25', type=699),
+    'bpay_refunds': Q(p_instruction_code='15', type=699),
+}
+
+def _conditional_sums(totals, prefix=''):
+    amount_field = models.DecimalField(decimal_places=2,max_digits=12)
+    sums = {}
+    for name, condition in totals.items():
+        # re-root the condition on a related transaction
+        condition = Q(**{'{}{}'.format(prefix, k): v for k, v in condition.children})
+        sums[name] = Coalesce(Sum(Case(When(condition, then=F('{}amount'.format(prefix))), output_field=amount_field)), decimal.Decimal('0'))
+    return sums
+
+INVOICE_SUMMARY_FIELDS = ('payment_total', 'refund_total')
+
 class Invoice(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     text = models.TextField(null=True,blank=True)
@@ -25,6 +58,9 @@ class Invoice(models.Model):
     token = models.CharField(max_length=80,null=True,blank=True)
     voided = models.BooleanField(default=False)
     previous_invoice = models.ForeignKey('self',null=True,blank=True)
+    # Payment totals maintained from the invoice transactions, see update_payment_summary
+    payment_total = models.DecimalField(decimal_places=2,max_digits=12,null=True,editable=False)
+    refund_total = models.DecimalField(decimal_places=2,max_digits=12,null=True,editable=False)
 
     def __unicode__(self):
         return 'Invoice #{0}'.format(self.reference)
@@ -63,7 +99,7 @@ class Invoice(models.Model):
 
     @property
     def refundable_amount(self):
-        return self.total_payment_amount - self.__calculate_total_refunds()
+        return self.total_payment_amount - self.refund_amount
 
     @property
     def refundable(self):
@@ -106,17 +142,18 @@ class Invoice(models.Model):
     def payment_amount(self):
         ''' Total amount paid from bpay,bpoint and cash.
         '''
-        return self.__calculate_bpay_payments() + self.__calculate_bpoint_payments() + self.__calculate_cash_payments() - self.__calculate_total_refunds()
+        payment_total, refund_total = self.__payment_summary()
+        return payment_total - refund_total
 
     @property
     def total_payment_amount(self):
         ''' Total amount paid from bpay,bpoint and cash.
         '''
-        return self.__calculate_bpay_payments() + self.__calculate_bpoint_payments() + self.__calculate_cash_payments()
+        return self.__payment_summary()[0]
 
     @property
     def refund_amount(self):
-        return self.__calculate_total_refunds()
+        return self.__payment_summary()[1]
 
     @property
     def deduction_amount(self):
@@ -139,7 +176,7 @@ class Invoice(models.Model):
     def payment_status(self):
         ''' Payment status of the invoice.
         '''
-        amount_paid = self.__calculate_bpay_payments() + self.__calculate_bpoint_payments() + self.__calculate_cash_payments() - self.__calculate_total_refunds()
+        amount_paid = self.payment_amount
 
         if amount_paid == decimal.Decimal('0') and self.amount > 0:
             return 'unpaid'
@@ -175,65 +212,80 @@ class Invoice(models.Model):
 
     # Helper Functions
     # =============================================
+    def __payment_totals(self):
+        ''' Per type transaction totals, fetched once per instance.
+        '''
+        if getattr(self, '_payment_totals', None) is None:
+            annotate_payment_totals([self])
+        return self._payment_totals
+
+    def __payment_summary(self):
+        ''' Persisted payment and refund totals, calculated
+            on first use for invoices that predate the summary.
+        '''
+        if self.payment_total is None or self.refund_total is None:
+            self.update_payment_summary(notify=False,refresh=False)
+        return self.payment_total, self.refund_total
+
     def __calculate_cash_payments(self):
         ''' Calcluate the amount of cash payments made
             less the reversals for this invoice.
         '''
-        payments = dict(self.cash_transactions.filter(type='payment').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        move_ins = dict(self.cash_transactions.filter(type='move_in').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        reversals = dict(self.cash_transactions.filter(type='reversal').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        move_outs = dict(self.cash_transactions.filter(type='move_out').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-
-        return (payments + move_ins) - (reversals + move_outs)
+        totals = self.__payment_totals()
+        return (totals['cash_payments'] + totals['cash_move_ins']) - (totals['cash_reversals'] + totals['cash_move_outs'])
 
     def __calculate_deductions(self):
         '''Calculate all the move out transactions for this invoice
         '''
-        return dict(self.cash_transactions.filter(type='move_out').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
+        return self.__payment_totals()['cash_move_outs']
 
     def __calculate_bpoint_payments(self):
         ''' Calcluate the total amount of bpoint payments and
             captures made less the reversals for this invoice.
         '''
-        payments = reversals = 0
-        payments = payments + dict(self.bpoint_transactions.filter(action='payment', response_code='0').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        payments = payments + dict(self.bpoint_transactions.filter(action='capture', response_code='0').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        reversals = dict(self.bpoint_transactions.filter(action='reversal', response_code='0').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-
-        return payments - reversals
+        totals = self.__payment_totals()
+        return totals['bpoint_payments'] - totals['bpoint_reversals']
 
     def __calculate_bpay_payments(self):
         ''' Calcluate the amount of bpay payments made
             less the reversals for this invoice.
         '''
-        payments = 0
-        reversals = 0
-        if self.bpay_transactions:
-            payments = payments + dict(self.bpay_transactions.filter(p_instruction_code='05', type=399).aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-            reversals = dict(self.bpay_transactions.filter(p_instruction_code='25', type=699).aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-
-        return payments - reversals
+        totals = self.__payment_totals()
+        return totals['bpay_payments'] - totals['bpay_reversals']
 
     def __calculate_total_refunds(self):
         ''' Calcluate the total amount of refunds
             for this invoice.
         '''
-        refunds = 0
-        cash_refunds = dict(self.cash_transactions.filter(type='refund').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        card_refunds = dict(self.bpoint_transactions.filter(action='refund', response_code='0').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        bpay_refunds = dict(self.bpay_transactions.filter(p_instruction_code='15', type=699).aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-
-        refunds = cash_refunds + card_refunds + bpay_refunds
-        return refunds
+        totals = self.__payment_totals()
+        return totals['cash_refunds'] + totals['bpoint_refunds'] + totals['bpay_refunds']
 
     # Functions
     # =============================================
+    def update_payment_summary(self,notify=True,refresh=True):
+        ''' Recalculate and store the payment and refund totals of this invoice.
+        '''
+        if refresh:
+            self._payment_totals = None
+        self.payment_total = self.__calculate_bpay_payments() + self.__calculate_bpoint_payments() + self.__calculate_cash_payments()
+        self.refund_total = self.__calculate_total_refunds()
+        Invoice.objects.filter(pk=self.pk).update(payment_total=self.payment_total,refund_total=self.refund_total)
+        if notify:
+            payment_summary_updated.send(sender=Invoice,invoice=self)
+
     def save(self,*args,**kwargs):
         # prevent circular import
         from ledger.payments.utils import systemid_check
         if self.pk:
             self.system = systemid_check(self.system)
-        super(Invoice,self).save(*args,**kwargs)
+        # The payment totals are only written by update_payment_summary, so that an
+        # instance loaded before a payment doesn't save its stale totals back
+        if self.pk and not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in INVOICE_SUMMARY_FIELDS]
+            super(Invoice,self).save(*args,**kwargs)
+            self.refresh_from_db(fields=INVOICE_SUMMARY_FIELDS)
+        else:
+            super(Invoice,self).save(*args,**kwargs)
 
     def make_payment(self):
         ''' Pay this invoice with the token attached to it.
@@ -329,6 +381,45 @@ class Invoice(models.Model):
             except:
                 raise
 
+def annotate_payment_totals(invoices):
+    ''' Fetch the transaction totals for a list or queryset of invoices
+        with one grouped query per transaction table, so the payment
+        properties of each invoice need no further queries.
+    :return: list of invoices
+    '''
+    from ledger.payments.cash.models import CashTransaction
+    invoices = list(invoices)
+    references = [i.reference for i in invoices]
+    if not references:
+        return invoices
+
+    zero = dict((name, decimal.Decimal('0')) for totals in (CASH_TOTALS, BPOINT_TOTALS, BPAY_TOTALS) for name in totals)
+    results = dict((r, dict(zero)) for r in references)
+    def collect(rows, key):
+        for row in rows:
+            reference = row.pop(key)
+            for name, amount in row.items():
+                results[reference][name] += amount
+
+    collect(CashTransaction.objects.filter(invoice__in=references).order_by().values('invoice').annotate(**_conditional_sums(CASH_TOTALS)), 'invoice')
+    collect(BpointTransaction.objects.filter(crn1__in=references).order_by().values('crn1').annotate(**_conditional_sums(BPOINT_TOTALS)), 'crn1')
+    collect(BpayTransaction.objects.filter(crn__in=references).order_by().values('crn').annotate(**_conditional_sums(BPAY_TOTALS)), 'crn')
+    # bpay payments linked to an invoice from an unmatched crn
+    collect(InvoiceBPAY.objects.filter(invoice__reference__in=references).exclude(bpay__crn=F('invoice__reference'))
+            .order_by().values('invoice__reference').annotate(**_conditional_sums(BPAY_TOTALS, prefix='bpay__')), 'invoice__reference')
+
+    for invoice in invoices:
+        invoice._payment_totals = results[invoice.reference]
+    return invoices
+
+def update_payment_summaries(references):
+    ''' Recalculate the payment summary of each invoice in a list of references.
+    '''
+    references = set(r for r in references if r)
+    if references:
+        for invoice in annotate_payment_totals(Invoice.objects.filter(reference__in=references)):
+            invoice.update_payment_summary(refresh=False)
+
 class InvoiceBPAY(models.Model):
     ''' Link between unmatched bpay payments and invoices
     '''
@@ -376,6 +467,7 @@ class InvoiceBPAYListener(object):
     @staticmethod
     @receiver(post_delete, sender=InvoiceBPAY)
     def _post_delete(sender, instance, **kwargs):
+        instance.invoice.update_payment_summary()
         for item in instance.invoice.order.lines.all():
             removable = []
             payment_details = item.payment_details['bpay']
@@ -387,3 +479,57 @@ class InvoiceBPAYListener(object):
                     del item.payment_details['bpay'][r]
                 item.save()
 
+class BpayMatchListener(object):
+    """
+    Event listener keeping the matched invoice of the bpay transactions
+    current with the invoices and the links to them
+    """
+
+    @staticmethod
+    @receiver(post_save, sender=Invoice)
+    def _invoice_post_save(sender, instance, created, **kwargs):
+        if created:
+            BpayTransaction.objects.filter(crn=instance.reference).update(matched_invoice=instance)
+
+    @staticmethod
+    @receiver([post_save, post_delete], sender=InvoiceBPAY)
+    def _link_changed(sender, instance, **kwargs):
+        BpayTransaction.sync_matches(BpayTransaction.objects.filter(pk=instance.bpay_id))
+
+class PaymentSummaryListener(object):
+    """
+    Event listener keeping the invoice payment summaries current
+    with the card and bpay transactions
+    """
+
+    @staticmethod
+    @receiver(pre_save, sender=BpointTransaction)
+    def _bpoint_pre_save(sender, instance, **kwargs):
+        if instance.pk:
+            setattr(instance, "_original_reference", BpointTransaction.objects.filter(pk=instance.pk).values_list('crn1', flat=True).first())
+
+    @staticmethod
+    @receiver([post_save, post_delete], sender=BpointTransaction)
+    def _bpoint_changed(sender, instance, **kwargs):
+        update_payment_summaries([instance.crn1, getattr(instance, "_original_reference", None)])
+
+    @staticmethod
+    @receiver(pre_save, sender=BpayTransaction)
+    def _bpay_pre_save(sender, instance, **kwargs):
+        if instance.pk:
+            setattr(instance, "_original_reference", BpayTransaction.objects.filter(pk=instance.pk).values_list('crn', flat=True).first())
+
+    @staticmethod
+    @receiver(pre_delete, sender=BpayTransaction)
+    def _bpay_pre_delete(sender, instance, **kwargs):
+        # look up the linked invoices before the delete cascades to InvoiceBPAY
+        setattr(instance, "_linked_references", list(InvoiceBPAY.objects.filter(bpay=instance).values_list('invoice__reference', flat=True)))
+
+    @staticmethod
+    @receiver([post_save, post_delete], sender=BpayTransaction)
+    def _bpay_changed(sender, instance, **kwargs):
+        references = getattr(instance, "_linked_references", None)
+        if references is None:
+            references = list(InvoiceBPAY.objects.filter(bpay=instance).values_list('invoice__reference', flat=True))
+        references.extend([instance.crn, getattr(instance, "_original_reference", None)])
+        update_payment_summaries(references)
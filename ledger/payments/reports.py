@@ -1,398 +1,352 @@
-from six.moves import StringIO
 import csv
 import pytz
 from datetime import timedelta,datetime
 from decimal import Decimal as D
+from django.db.models import Q
 from ledger.payments.models import Invoice, CashTransaction, BpointTransaction, BpayTransaction
-from ledger.order.models import Line
+from ledger.order.models import Line, Order
 
 PERTH_TIMEZONE = pytz.timezone('Australia/Perth')
+# Number of transactions, invoices or lines loaded per query while streaming a report
+REPORT_CHUNK_SIZE = 500
+
+class Echo(object):
+    """A file-like object that returns each written row, so csv writers
+    can feed a StreamingHttpResponse one row at a time.
+    """
+    def write(self, value):
+        return value
 
 def daterange(start,end):
     for n in range(int ((end-start).days) + 1):
         yield start + timedelta(n)
 
+def chunked(queryset, field='id', size=REPORT_CHUNK_SIZE):
+    ''' Iterate a queryset in descending (field, id) order as lists of at most
+        size rows, paging on the last row seen so each chunk is a bounded query.
+    '''
+    queryset = queryset.order_by('-{}'.format(field), '-id') if field != 'id' else queryset.order_by('-id')
+    last = None
+    while True:
+        page = queryset
+        if last is not None:
+            value = getattr(last, field)
+            page = page.filter(Q(**{'{}__lt'.format(field): value}) | Q(**{field: value, 'id__lt': last.id}))
+        rows = list(page[:size])
+        if not rows:
+            return
+        yield rows
+        if len(rows) < size:
+            return
+        last = rows[-1]
+
+def chunks(values, size=REPORT_CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i+size]
+
+def invoice_products(references):
+    ''' Map each invoice reference to the product names and oracle codes
+        of its order lines, each joined with '|'.
+    '''
+    references = set(references)
+    invoices = dict(Invoice.objects.filter(reference__in=references).values_list('reference', 'order_number'))
+    missing = references.difference(invoices.keys())
+    if missing:
+        raise Invoice.DoesNotExist('Invoice matching query does not exist: {}'.format(', '.join(sorted(missing))))
+    lines = dict((number, ([], [])) for number in Order.objects.filter(number__in=invoices.values()).values_list('number', flat=True))
+    for number, title, code in Line.objects.filter(order__number__in=lines.keys()).order_by('pk').values_list('order__number', 'title', 'oracle_code'):
+        lines[number][0].append(title)
+        lines[number][1].append(code if code else 'N\A')
+
+    products = {}
+    for reference, number in invoices.items():
+        if number in lines:
+            products[reference] = ('|'.join(lines[number][0]), '|'.join(lines[number][1]))
+        else:
+            # invoices without an order keep the empty lists
+            products[reference] = ([], [])
+    return products
+
+def bulk_transactions(model, ids, *fields):
+    ''' Fetch the transactions with the given ids, keyed by id, raising
+        DoesNotExist if any of them are missing.
+    '''
+    ids = set(int(i) for i in ids)
+    txns = model.objects.only('id', *fields).in_bulk(ids) if ids else {}
+    missing = ids.difference(txns.keys())
+    if missing:
+        raise model.DoesNotExist('{} matching query does not exist: {}'.format(model.__name__, ', '.join(str(i) for i in sorted(missing))))
+    return txns
+
 def generate_items_csv(system,start,end,banked_start,banked_end,region=None,district=None):
-    strIO = None
-    invoices = []
+    ''' Streamed csv rows of the daily totals per oracle code of the invoices
+        paid within the date range, or None if there are no such invoices.
+    '''
     invoice_list = []
+    checked = set()
+
+    # Get all transactions
+    if not district:
+        cash_querysets = [
+            CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos').exclude(district__isnull=False),
+            CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end).exclude(source='eftpos').exclude(district__isnull=False)
+        ]
+        bpoint = BpointTransaction.objects.filter(settlement_date__gte=start, settlement_date__lte=end).exclude(crn1__endswith='_test')
+        bpay = BpayTransaction.objects.filter(p_date__gte=start, p_date__lte=end)
+    else:
+        cash_querysets = [
+            CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos',district=district),
+            CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end,district=district).exclude(source='eftpos')
+        ]
+        bpoint = bpay = None
+
+    # Get the required invoices, a chunk of transactions at a time
+    def add_invoices(references):
+        references = set(references).difference(checked)
+        if not references:
+            return
+        systems = dict(Invoice.objects.filter(reference__in=references).values_list('reference', 'system'))
+        missing = references.difference(systems.keys())
+        if missing:
+            raise Invoice.DoesNotExist('Invoice matching query does not exist: {}'.format(', '.join(sorted(missing))))
+        checked.update(references)
+        invoice_list.extend(str(r) for r in references if systems[r] == system)
+
+    for qs in cash_querysets:
+        for txns in chunked(qs.only('id', 'invoice')):
+            add_invoices(t.invoice_id for t in txns)
+    if bpoint is not None:
+        for txns in chunked(bpoint.only('id', 'crn1')):
+            add_invoices(t.crn1 for t in txns)
+        for txns in chunked(bpay.only('id', 'crn')):
+            add_invoices(t.crn for t in txns)
+
+    if invoice_list:
+        return items_csv_rows(invoice_list,start,end,banked_start,banked_end)
+    return None
+
+def items_csv_rows(invoice_list,start,end,banked_start,banked_end):
     dates, banked_dates = [], []
     date_amounts, banked_date_amounts = [], []
-    items = []
     oracle_codes = {}
     banked_oracle_codes = {}
     date_format = '%d/%m/%y'
-
-    eftpos = []
-    banked_cash = []
-    bpoint = []
-    bpay = []
-
-    # Get all transactions
-    if not district:
-        eftpos.extend([x for x in CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos').exclude(district__isnull=False)])
-        banked_cash.extend([x for x in CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end).exclude(source='eftpos').exclude(district__isnull=False)])
-        bpoint.extend([x for x in BpointTransaction.objects.filter(settlement_date__gte=start, settlement_date__lte=end).exclude(crn1__endswith='_test')])
-        bpay.extend([x for x in BpayTransaction.objects.filter(p_date__gte=start, p_date__lte=end)])
-    else:
-        eftpos.extend([x for x in CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos',district=district)])
-        banked_cash.extend([x for x in CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end,district=district).exclude(source='eftpos')])
-
-    # Get the required invoices
-    for e in eftpos:
-        if e.invoice.reference not in invoice_list:
-            if e.invoice.system == system:
-                invoices.append(e.invoice)
-                invoice_list.append(str(e.invoice.reference))
-    for b in banked_cash:
-        if b.invoice.reference not in invoice_list:
-            if b.invoice.system == system:
-                invoices.append(b.invoice)
-                invoice_list.append(str(b.invoice.reference))
-    for b in bpoint:
-        if b.crn1 not in invoice_list:
-            invoice = Invoice.objects.get(reference=b.crn1)
-            if invoice.system == system:
-                invoices.append(invoice)
-                invoice_list.append(str(b.crn1))
-    for b in bpay:
-        if b.crn not in invoice_list:
-            invoice = Invoice.objects.get(reference=b.crn)
-            if invoice.system == system:
-                invoices.append(invoice)
-                invoice_list.append(str(b.crn))
-
-    invoice_list = list(set(invoice_list))
-
-    if invoices:
-        strIO = StringIO()
-        fieldnames = ['Account Code', 'Day']
-        writer = csv.writer(strIO)
-        writer.writerow(fieldnames)
-
-        for d in daterange(start,end):
-            dates.append(d.strftime(date_format))
-            date_amounts.append({
-                'date':d.strftime(date_format),
-                'amounts':{
-                    'card': D('0.0'),
-                    'bpay': D('0.0'),
-                    'eftpos': D('0.0'),
-                    'cash': D('0.0'),
-                    'cheque': D('0.0'),
-                    'money_order': D('0.0')
-                }
-            })
-        for d in daterange(banked_start,banked_end):
-            banked_dates.append(d.strftime(date_format))
-            banked_date_amounts.append({
-                'date':d.strftime(date_format),
-                'amounts':{
-                    'cash': D('0.0'),
-                    'cheque': D('0.0'),
-                    'money_order': D('0.0')
-                }
-            })
-
-        dates_row = ''
-        for date in dates:
-            dates_row += '{},,,'.format(date)
-
-        # Dates row
-        writer.writerow(['']+ dates_row.split(','))
-        writer.writerow([''] + ['Credit Card','Bpay','EFTPOS'] * len(dates) + ['','Credit Card','Bpay','EFTPOS'])
-
-        # Loop through the payments and not the invoices
-        for i in invoices:
-            # Add items of invoice if not in list
-
-            if i.order:# and not i.voided:
-                lines = i.order.lines.all()
-                for x in lines:
-                    #print((i, i.__dict__, x, x.oracle_code))
-                    item_date_amounts, banked_item_dates_amounts = [], []
-                    for d in dates:
-                        item_date_amounts.append({
-                            'date':d,
-                            'amounts':{
-                                'card': D('0.0'),
-                                'bpay': D('0.0'),
-                                'eftpos': D('0.0'),
-                                'cash': D('0.0'),
-                                'cheque': D('0.0'),
-                                'money_order': D('0.0')
-                            }
-                        })
-                    for d in banked_dates:
-                        banked_item_dates_amounts.append({
-                            'date':d,
-                            'amounts':{
-                                'cash': D('0.0'),
-                                'cheque': D('0.0'),
-                                'money_order': D('0.0')
-                            }
-                        })
-
-                    items.append({
-                        'dates':item_date_amounts,
-                        'banked_dates': banked_item_dates_amounts,
-                        'item': x,
-                        'card': D('0.0'),
-                        'bpay': D('0.0'),
-                        'eftpos': D('0.0'),
-                        'cash': D('0.0'),
-                        'cheque': D('0.0'),
-                        'money_order': D('0.0')
+    banked_sources = set(['cash','cheque','money_order'])
+
+    writer = csv.writer(Echo())
+    fieldnames = ['Account Code', 'Day']
+    yield writer.writerow(fieldnames)
+
+    for d in daterange(start,end):
+        dates.append(d.strftime(date_format))
+        date_amounts.append({
+            'date':d.strftime(date_format),
+            'amounts':{
+                'card': D('0.0'),
+                'bpay': D('0.0'),
+                'eftpos': D('0.0'),
+                'cash': D('0.0'),
+                'cheque': D('0.0'),
+                'money_order': D('0.0')
+            }
+        })
+    for d in daterange(banked_start,banked_end):
+        banked_dates.append(d.strftime(date_format))
+        banked_date_amounts.append({
+            'date':d.strftime(date_format),
+            'amounts':{
+                'cash': D('0.0'),
+                'cheque': D('0.0'),
+                'money_order': D('0.0')
+            }
+        })
+    date_index = dict((d, i) for i, d in enumerate(dates))
+    banked_date_index = dict((d, i) for i, d in enumerate(banked_dates))
+
+    dates_row = ''
+    for date in dates:
+        dates_row += '{},,,'.format(date)
+
+    # Dates row
+    yield writer.writerow(['']+ dates_row.split(','))
+    yield writer.writerow([''] + ['Credit Card','Bpay','EFTPOS'] * len(dates) + ['','Credit Card','Bpay','EFTPOS'])
+
+    # Loop through the lines of the invoices a chunk of invoices at a time
+    for references in chunks(invoice_list):
+        order_numbers = Invoice.objects.filter(reference__in=references).values_list('order_number', flat=True)
+        lines = list(Line.objects.filter(order__number__in=order_numbers).order_by('pk').only('id', 'oracle_code', 'payment_details', 'refund_details', 'deduction_details'))
+
+        cash_ids, card_ids, bpay_ids = set(), set(), set()
+        for x in lines:
+            cash_ids.update(x.payment_details['cash'].keys())
+            cash_ids.update(x.refund_details['cash'].keys())
+            cash_ids.update(x.deduction_details['cash'].keys())
+            card_ids.update(x.payment_details['card'].keys())
+            card_ids.update(x.refund_details['card'].keys())
+            bpay_ids.update(x.payment_details['bpay'].keys())
+            bpay_ids.update(x.refund_details['bpay'].keys())
+        cash_txns = bulk_transactions(CashTransaction, cash_ids, 'source', 'created')
+        card_txns = bulk_transactions(BpointTransaction, card_ids, 'settlement_date', 'response_code')
+        bpay_txns = bulk_transactions(BpayTransaction, bpay_ids, 'p_date', 'service_code')
+
+        for x in lines:
+            code = x.oracle_code
+
+            # create empty subtotal list for each oracle code
+            if code not in oracle_codes:
+                oracle_codes[code] = []
+                for d in daterange(start,end):
+                    oracle_codes[code].append({
+                        'date':d.strftime(date_format),
+                        'amounts':{
+                            'card': D('0.0'),
+                            'bpay': D('0.0'),
+                            'eftpos': D('0.0'),
+                            'cash': D('0.0'),
+                            'cheque': D('0.0'),
+                            'money_order': D('0.0')
+                        }
                     })
 
-                    # create empty subtotal list for each oracle code
-                    if x.oracle_code not in oracle_codes:
-                        oracle_codes[x.oracle_code] = []
-                        for d in daterange(start,end):
-                            oracle_codes[x.oracle_code].append({
-                                'date':d.strftime(date_format),
-                                'amounts':{
-                                    'card': D('0.0'),
-                                    'bpay': D('0.0'),
-                                    'eftpos': D('0.0'),
-                                    'cash': D('0.0'),
-                                    'cheque': D('0.0'),
-                                    'money_order': D('0.0')
-                                }
-                            })
-
-                    if x.oracle_code not in banked_oracle_codes:
-                        banked_oracle_codes[x.oracle_code] = []
-                        for d in daterange(banked_start,banked_end):
-                            banked_oracle_codes[x.oracle_code].append({
-                                'date':d.strftime(date_format),
-                                'amounts':{
-                                    'cash': D('0.0'),
-                                    'cheque': D('0.0'),
-                                    'money_order': D('0.0')
-                                }
-                            })
-
-        for item in items:
-            price = D(item.get('item').line_price_before_discounts_incl_tax)
-            code = item.get('item').oracle_code
-            order = item.get('item').order
-
-            payment_details = item.get('item').payment_details
-            refund_details = item.get('item').refund_details
-            deduction_details = item.get('item').deduction_details
+            if code not in banked_oracle_codes:
+                banked_oracle_codes[code] = []
+                for d in daterange(banked_start,banked_end):
+                    banked_oracle_codes[code].append({
+                        'date':d.strftime(date_format),
+                        'amounts':{
+                            'cash': D('0.0'),
+                            'cheque': D('0.0'),
+                            'money_order': D('0.0')
+                        }
+                    })
 
             # Banked Cash
-            for d in item['banked_dates']:
-                index = 0
-                for l in banked_date_amounts:
-                    if l.get('date') == d.get('date'):
-                        date_amount_index = index
-                        break
-                    index += 1
-
-                for k,v in payment_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source in set(['cash','cheque','money_order']):
-                        if c.created.strftime(date_format) == d.get('date'):
-                            banked_oracle_codes[code][date_amount_index]['amounts'][source] += D(v)
-                            item[source] += D(v)
-                            banked_date_amounts[date_amount_index]['amounts'][source] += D(v)
-
-                for k,v in refund_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source in set(['cash','cheque','money_order']):
-                        if c.created.strftime(date_format) == d.get('date'):
-                            banked_oracle_codes[code][date_amount_index]['amounts'][source] -= D(v)
-                            item[source] -= D(v)
-                            banked_date_amounts[date_amount_index]['amounts'][source] -= D(v)
-
-                for k,v in deduction_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
+            for details, sign in ((x.payment_details, 1), (x.refund_details, -1), (x.deduction_details, -1)):
+                for k,v in details['cash'].items():
+                    c = cash_txns[int(k)]
                     source = c.source
-                    if source in set(['cash','cheque','money_order']):
-                        if c.created.strftime(date_format) == d.get('date'):
-                            banked_oracle_codes[code][date_amount_index]['amounts'][source] -= D(v)
-                            item[source] -= D(v)
-                            banked_date_amounts[date_amount_index]['amounts'][source] -= D(v)
-
+                    index = banked_date_index.get(c.created.strftime(date_format))
+                    if source in banked_sources and index is not None:
+                        banked_oracle_codes[code][index]['amounts'][source] += sign * D(v)
+                        banked_date_amounts[index]['amounts'][source] += sign * D(v)
 
             # Other transactions
-            for d in oracle_codes[code]:
-                index = 0
-                for l in date_amounts:
-                    if l.get('date') == d.get('date'):
-                        date_amount_index = index
-                        break
-                    index += 1
+            for details, sign in ((x.payment_details, 1), (x.refund_details, -1)):
                 # EFT
-                for k,v in payment_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source == 'eftpos':
-                        if c.created.strftime(date_format) == d.get('date'):
-                            oracle_codes[code][date_amount_index]['amounts']['eftpos'] += D(v)
-                            item['eftpos'] += D(v)
-                            date_amounts[date_amount_index]['amounts']['eftpos'] += D(v)
-
-                for k,v in refund_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source == 'eftpos':
-                        if c.created.strftime(date_format) == d.get('date'):
-                            oracle_codes[code][date_amount_index]['amounts']['eftpos'] -= D(v)
-                            item['eftpos'] -= D(v)
-                            date_amounts[date_amount_index]['amounts']['eftpos'] -= D(v)
-
+                for k,v in details['cash'].items():
+                    c = cash_txns[int(k)]
+                    index = date_index.get(c.created.strftime(date_format))
+                    if c.source == 'eftpos' and index is not None:
+                        oracle_codes[code][index]['amounts']['eftpos'] += sign * D(v)
+                        date_amounts[index]['amounts']['eftpos'] += sign * D(v)
                 # Card
-                for k,v in payment_details['card'].items():
-                    c = BpointTransaction.objects.get(id=int(k))
-                    if c.settlement_date.strftime(date_format) == d.get('date') and c.approved:
-                        oracle_codes[code][date_amount_index]['amounts']['card'] += D(v)
-                        item['card'] += D(v)
-                        date_amounts[date_amount_index]['amounts']['card'] += D(v)
-
-                for k,v in refund_details['card'].items():
-                    c = BpointTransaction.objects.get(id=int(k))
-                    if c.settlement_date.strftime(date_format) == d.get('date') and c.approved:
-                        oracle_codes[code][date_amount_index]['amounts']['card'] -= D(v)
-                        item['card'] -= D(v)
-                        date_amounts[date_amount_index]['amounts']['card'] -= D(v)
-
+                for k,v in details['card'].items():
+                    c = card_txns[int(k)]
+                    index = date_index.get(c.settlement_date.strftime(date_format))
+                    if index is not None and c.approved:
+                        oracle_codes[code][index]['amounts']['card'] += sign * D(v)
+                        date_amounts[index]['amounts']['card'] += sign * D(v)
                 # BPAY
-                for k,v in payment_details['bpay'].items():
-                    b = BpayTransaction.objects.get(id=int(k))
-                    if b.approved and b.p_date.strftime(date_format) == d.get('date'):
-                        oracle_codes[code][date_amount_index]['amounts']['bpay'] += D(v)
-                        item['bpay'] += D(v)
-                        date_amounts[date_amount_index]['amounts']['bpay'] += D(v)
-
-                for k,v in refund_details['bpay'].items():
-                    b = BpayTransaction.objects.get(id=int(k))
-                    if b.approved and b.p_date.strftime(date_format) == d.get('date'):
-                        oracle_codes[code][date_amount_index]['amounts']['bpay'] -= D(v)
-                        item['bpay'] -= D(v)
-                        date_amounts[date_amount_index]['amounts']['bpay'] -= D(v)
-
-        for code in oracle_codes:
-            item_str = ''
-            item_str += '{},'.format(code)
-            card_total = D('0.0')
-            bpay_total = D('0.0')
-            eftpos_total = D('0.0')
-            for d in oracle_codes[code]:
-                item_str += '{},{},{},'.format(d['amounts']['card'],d['amounts']['bpay'],d['amounts']['eftpos'])
-                card_total += d['amounts']['card']
-                bpay_total += d['amounts']['bpay']
-                eftpos_total += d['amounts']['eftpos']
-            item_str += ',{},{},{},'.format(card_total, bpay_total, eftpos_total)
-            if not ((card_total == D('0.0')) and (bpay_total == D('0.0')) and (eftpos_total == D('0.0'))):
-                writer.writerow(item_str.split(','))
-
-        total_str = 'Totals,'
-        total_amounts = {
-            'card': D('0.0'),
-            'bpay': D('0.0'),
-            'eftpos': D('0.0')
-        }
-        for d in date_amounts:
-            total_amounts['card'] += d['amounts']['card']
-            total_amounts['bpay'] += d['amounts']['bpay']
-            total_amounts['eftpos'] += d['amounts']['eftpos']
-            total_str += '{},{},{},'.format(d['amounts']['card'],d['amounts']['bpay'],d['amounts']['eftpos'])
-        total_str += ',{},{},{},'.format(total_amounts['card'],total_amounts['bpay'],total_amounts['eftpos'])
-        writer.writerow('')
-        writer.writerow(total_str.split(','))
-
-        # Banked Items
-        writer.writerow('')
-        writer.writerow(fieldnames)
-        banked_dates_row = ''
-        for date in banked_dates:
-            banked_dates_row += '{},,,'.format(date)
-        writer.writerow(['']+ banked_dates_row.split(','))
-        writer.writerow([''] + ['Cash','Cheque','Money Order'] * len(banked_dates) + ['','Cash','Cheque','Money Order','Banked(Cash,Money Order,Cheque)'])
-
-        for code in banked_oracle_codes:
-            banked_item_str = ''
-            banked_item_str += '{},'.format(code)
-            cash_total = D('0.0')
-            cheque_total = D('0.0')
-            moneyorder_total = D('0.0')
-            for d in banked_oracle_codes[code]:
-                banked_item_str += '{},{},{},'.format(d['amounts']['cash'],d['amounts']['cheque'],d['amounts']['money_order'])
-                cash_total += d['amounts']['cash']
-                cheque_total += d['amounts']['cheque']
-                moneyorder_total += d['amounts']['money_order']
-            banked_item_str += ',{},{},{},'.format(cash_total, cheque_total, moneyorder_total)
-            if not ((cash_total == D('0.0')) and (cheque_total == D('0.0')) and (moneyorder_total == D('0.0'))):
-                writer.writerow(banked_item_str.split(','))
-
-        banked_total_str = 'Totals,'
-        banked_total_amounts = {
-            'cash': D('0.0'),
-            'cheque': D('0.0'),
-            'money_order': D('0.0')
-        }
-        for d in banked_date_amounts:
-            banked_total_amounts['cash'] += d['amounts']['cash']
-            banked_total_amounts['cheque'] += d['amounts']['cheque']
-            banked_total_amounts['money_order'] += d['amounts']['money_order']
-            banked_total_str += '{},{},{},'.format(d['amounts']['cash'],d['amounts']['cheque'],d['amounts']['money_order'])
-        banked_total_str += ',{},{},{},'.format(banked_total_amounts['cash'],banked_total_amounts['cheque'],banked_total_amounts['money_order'])
-        writer.writerow('')
-        writer.writerow(banked_total_str.split(','))
-
-        strIO.flush()
-        strIO.seek(0)
-    return strIO
+                for k,v in details['bpay'].items():
+                    b = bpay_txns[int(k)]
+                    index = date_index.get(b.p_date.strftime(date_format))
+                    if b.approved and index is not None:
+                        oracle_codes[code][index]['amounts']['bpay'] += sign * D(v)
+                        date_amounts[index]['amounts']['bpay'] += sign * D(v)
+
+    for code in oracle_codes:
+        item_str = ''
+        item_str += '{},'.format(code)
+        card_total = D('0.0')
+        bpay_total = D('0.0')
+        eftpos_total = D('0.0')
+        for d in oracle_codes[code]:
+            item_str += '{},{},{},'.format(d['amounts']['card'],d['amounts']['bpay'],d['amounts']['eftpos'])
+            card_total += d['amounts']['card']
+            bpay_total += d['amounts']['bpay']
+            eftpos_total += d['amounts']['eftpos']
+        item_str += ',{},{},{},'.format(card_total, bpay_total, eftpos_total)
+        if not ((card_total == D('0.0')) and (bpay_total == D('0.0')) and (eftpos_total == D('0.0'))):
+            yield writer.writerow(item_str.split(','))
+
+    total_str = 'Totals,'
+    total_amounts = {
+        'card': D('0.0'),
+        'bpay': D('0.0'),
+        'eftpos': D('0.0')
+    }
+    for d in date_amounts:
+        total_amounts['card'] += d['amounts']['card']
+        total_amounts['bpay'] += d['amounts']['bpay']
+        total_amounts['eftpos'] += d['amounts']['eftpos']
+        total_str += '{},{},{},'.format(d['amounts']['card'],d['amounts']['bpay'],d['amounts']['eftpos'])
+    total_str += ',{},{},{},'.format(total_amounts['card'],total_amounts['bpay'],total_amounts['eftpos'])
+    yield writer.writerow('')
+    yield writer.writerow(total_str.split(','))
+
+    # Banked Items
+    yield writer.writerow('')
+    yield writer.writerow(fieldnames)
+    banked_dates_row = ''
+    for date in banked_dates:
+        banked_dates_row += '{},,,'.format(date)
+    yield writer.writerow(['']+ banked_dates_row.split(','))
+    yield writer.writerow([''] + ['Cash','Cheque','Money Order'] * len(banked_dates) + ['','Cash','Cheque','Money Order','Banked(Cash,Money Order,Cheque)'])
+
+    for code in banked_oracle_codes:
+        banked_item_str = ''
+        banked_item_str += '{},'.format(code)
+        cash_total = D('0.0')
+        cheque_total = D('0.0')
+        moneyorder_total = D('0.0')
+        for d in banked_oracle_codes[code]:
+            banked_item_str += '{},{},{},'.format(d['amounts']['cash'],d['amounts']['cheque'],d['amounts']['money_order'])
+            cash_total += d['amounts']['cash']
+            cheque_total += d['amounts']['cheque']
+            moneyorder_total += d['amounts']['money_order']
+        banked_item_str += ',{},{},{},'.format(cash_total, cheque_total, moneyorder_total)
+        if not ((cash_total == D('0.0')) and (cheque_total == D('0.0')) and (moneyorder_total == D('0.0'))):
+            yield writer.writerow(banked_item_str.split(','))
+
+    banked_total_str = 'Totals,'
+    banked_total_amounts = {
+        'cash': D('0.0'),
+        'cheque': D('0.0'),
+        'money_order': D('0.0')
+    }
+    for d in banked_date_amounts:
+        banked_total_amounts['cash'] += d['amounts']['cash']
+        banked_total_amounts['cheque'] += d['amounts']['cheque']
+        banked_total_amounts['money_order'] += d['amounts']['money_order']
+        banked_total_str += '{},{},{},'.format(d['amounts']['cash'],d['amounts']['cheque'],d['amounts']['money_order'])
+    banked_total_str += ',{},{},{},'.format(banked_total_amounts['cash'],banked_total_amounts['cheque'],banked_total_amounts['money_order'])
+    yield writer.writerow('')
+    yield writer.writerow(banked_total_str.split(','))
 
 def generate_trans_csv(system,start,end,region=None,district=None):
-    # Get invoices matching the system and date range
-    strIO = None
-    invoices = []
-
-    cash = None
-    bpoint = None
-    bpay = None
-
+    ''' Streamed csv rows of the transactions within the date range.
+    '''
     # Get all transactions
-    cash = CashTransaction.objects.filter(created__gte=start, created__lte=end,district=district,invoice__system=system).order_by('-created')
-    bpoint = BpointTransaction.objects.filter(settlement_date__gte=start, settlement_date__lte=end,crn1__startswith=system).order_by('-created').exclude(crn1__endswith='_test')
-    bpay = BpayTransaction.objects.filter(p_date__gte=start, p_date__lte=end,crn__startswith=system).order_by('-created')
+    cash = CashTransaction.objects.filter(created__gte=start, created__lte=end,district=district,invoice__system=system).exclude(type__in=['move_in','move_out'])
+    bpoint = BpointTransaction.objects.filter(settlement_date__gte=start, settlement_date__lte=end,crn1__startswith=system).exclude(crn1__endswith='_test')
+    bpay = BpayTransaction.objects.filter(p_date__gte=start, p_date__lte=end,crn__startswith=system)
 
     # Print the header
-    strIO = StringIO()
     fieldnames = ['Created','Settlement Date', 'Payment Method', 'Transaction Type', 'Amount', 'Approved', 'Source', 'Product Names',
                   'Product Codes', 'Invoice']
-    writer = csv.DictWriter(strIO, fieldnames=fieldnames)
-    writer.writeheader()
-
-    # Iterate through transactions
-    for c in cash:
-        i = c.invoice
-        items = item_codes = None
-        item_names = []
-        oracle_codes = []
-        # Get all items for this invoice
-        if i.order:
-            items = i.order.lines.all().values('title', 'oracle_code')
-            for item in items:
-                item_names.append(item.get('title'))
-                code = item.get('oracle_code')
-                if not code: code = 'N\A'
-                oracle_codes.append(code)
-            item_names = '|'.join(item_names)
-            oracle_codes = '|'.join(oracle_codes)
-
-        
-        if c.type not in ['move_in','move_out']:
+    writer = csv.DictWriter(Echo(), fieldnames=fieldnames)
+    yield writer.writerow(dict(zip(fieldnames, fieldnames)))
+
+    # Iterate through transactions, resolving the invoice products a chunk at a time
+    for txns in chunked(cash, field='created'):
+        products = invoice_products(c.invoice_id for c in txns)
+        for c in txns:
+            item_names, oracle_codes = products[c.invoice_id]
             cash_info = {
                 'Created': c.created.astimezone(PERTH_TIMEZONE).strftime('%d/%m/%Y %H:%M:%S'),
                 'Settlement Date': c.created.strftime('%d/%m/%Y'),
-                'Invoice': c.invoice.reference,
+                'Invoice': c.invoice_id,
                 'Payment Method': 'Cash',
                 'Transaction Type': c.type.lower(),
                 'Amount': c.amount if c.type not in ['refund','move_out'] else '-{}'.format(c.amount),
@@ -401,26 +355,13 @@ def generate_trans_csv(system,start,end,region=None,district=None):
                 'Product Names': item_names,
                 'Product Codes': oracle_codes
             }
-            writer.writerow(cash_info)
+            yield writer.writerow(cash_info)
     if not district:
         # Write out all bpay transactions
-        if bpay:
-            for b in bpay:
-                i = Invoice.objects.get(reference=b.crn)
-                items = item_codes = None
-                item_names = []
-                oracle_codes = []
-                # Get all items for this invoice
-                if i.order:
-                    items = i.order.lines.all().values('title', 'oracle_code')
-                    for item in items:
-                        item_names.append(item.get('title'))
-                        code = item.get('oracle_code')
-                        if not code: code = 'N\A'
-                        oracle_codes.append(code)
-                    item_names = '|'.join(item_names)
-                    oracle_codes = '|'.join(oracle_codes)
-
+        for txns in chunked(bpay, field='created'):
+            products = invoice_products(b.crn for b in txns)
+            for b in txns:
+                item_names, oracle_codes = products[b.crn]
                 bpay_info = {
                     'Created': b.created.astimezone(PERTH_TIMEZONE).strftime('%d/%m/%Y %H:%M:%S'),
                     'Settlement Date': b.p_date.strftime('%d/%m/%Y'),
@@ -433,25 +374,12 @@ def generate_trans_csv(system,start,end,region=None,district=None):
                     'Product Names': item_names,
                     'Product Codes': oracle_codes
                 }
-                writer.writerow(bpay_info)
+                yield writer.writerow(bpay_info)
         # Write out all bpoint transactions
-        if bpoint:
-            for bpt in bpoint:
-                i = Invoice.objects.get(reference=bpt.crn1)
-                items = item_codes = None
-                item_names = []
-                oracle_codes = []
-                # Get all items for this invoice
-                if i.order:
-                    items = i.order.lines.all().values('title', 'oracle_code')
-                    for item in items:
-                        item_names.append(item.get('title'))
-                        code = item.get('oracle_code')
-                        if not code: code = 'N\A'
-                        oracle_codes.append(code)
-                    item_names = '|'.join(item_names)
-                    oracle_codes = '|'.join(oracle_codes)
-
+        for txns in chunked(bpoint, field='created'):
+            products = invoice_products(bpt.crn1 for bpt in txns)
+            for bpt in txns:
+                item_names, oracle_codes = products[bpt.crn1]
                 bpoint_info = {
                     'Created': bpt.created.astimezone(PERTH_TIMEZONE).strftime('%d/%m/%Y %H:%M:%S'),
                     'Settlement Date': bpt.settlement_date.strftime('%d/%m/%Y'),
@@ -464,8 +392,4 @@ def generate_trans_csv(system,start,end,region=None,district=None):
                     'Product Names': item_names,
                     'Product Codes': oracle_codes
                 }
-                writer.writerow(bpoint_info)
-
-    strIO.flush()
-    strIO.seek(0)
-    return strIO
+                yield writer.writerow(bpoint_info)
@@ -1,3 +1,158 @@
-from django.test import TestCase
+import json
+import threading
+from datetime import date
+from decimal import Decimal
 
-# Create your tests here.
+from django.test import SimpleTestCase
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+
+from ledger.order.models import Line, LineAllocation
+from ledger.payments.bpay.facade import store_records, validate_datetime
+from ledger.payments.bpay.models import get_collection_date
+from ledger.payments.bpoint.BPOINT.Requests import Credentials, SystemStatusRequest
+from ledger.payments.bpoint.BPOINT.Utils import RequestSender
+from ledger.payments.utils import _allocate
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps({'APIResponse': {'ResponseCode': 0, 'ResponseText': 'Success'}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RequestSenderTest(SimpleTestCase):
+
+    def setUp(self):
+        super(RequestSenderTest, self).setUp()
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        RequestSender.configure(pool_size=2, max_retries=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        RequestSender.configure()
+        super(RequestSenderTest, self).tearDown()
+
+    def _request(self):
+        request = SystemStatusRequest(Credentials('user', 'pass', '1'))
+        request.base_url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        return request
+
+    def test_keep_alive(self):
+        """Test repeated requests reuse one pooled connection
+        """
+        for i in range(5):
+            response = self._request().submit()
+            self.assertEqual(response.api_response.response_code, 0)
+        stats = RequestSender.pool_stats()
+        self.assertEqual(stats['connections'], 1)
+        self.assertEqual(stats['pool_requests'], 5)
+
+    def test_shared_across_threads(self):
+        """Test worker threads share the pool without errors
+        """
+        errors = []
+
+        def work():
+            try:
+                for i in range(5):
+                    self._request().submit()
+            except Exception as e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=work) for i in range(4)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(RequestSender.pool_stats()['pool_requests'], 20)
+
+
+class LineAllocationTest(SimpleTestCase):
+
+    def test_from_details(self):
+        """Test each transaction in the line details becomes one allocation
+        """
+        line = Line(pk=7, payment_details={'bpay': {'3': '10.00'}, 'card': {}, 'cash': {5: '2.50'}},
+                    refund_details={'bpay': {}, 'card': {'4': '1.25'}, 'cash': {}},
+                    deduction_details={'bpay': {}, 'card': {}, 'cash': {}})
+        allocations = sorted((a.kind, a.source, a.transaction_id, a.amount, a.line_id) for a in LineAllocation.from_details(line))
+        self.assertEqual(allocations, [
+            ('payment', 'bpay', 3, Decimal('10.00'), 7),
+            ('payment', 'cash', 5, Decimal('2.50'), 7),
+            ('refund', 'card', 4, Decimal('1.25'), 7),
+        ])
+
+    def test_prefetched_totals(self):
+        """Test line totals are summed from prefetched allocations without a query
+        """
+        line = Line(pk=7)
+        line._prefetched_objects_cache = {'allocations': [
+            LineAllocation(kind='payment', source='cash', transaction_id=1, amount=Decimal('2.50')),
+            LineAllocation(kind='payment', source='card', transaction_id=2, amount=Decimal('7.50')),
+            LineAllocation(kind='refund', source='card', transaction_id=2, amount=Decimal('1.00')),
+        ]}
+        # SimpleTestCase fails on any database query
+        self.assertEqual(line.paid, Decimal('10.00'))
+        self.assertEqual(line.refunded, Decimal('1.00'))
+        self.assertEqual(line.deducted, Decimal('0.0'))
+
+
+class AllocateTest(SimpleTestCase):
+
+    def test_partial_allocation(self):
+        """Test a transaction covers no more of a line than is left to pay
+        """
+        amounts = {}
+        self.assertEqual(_allocate(amounts, 3, Decimal('50.00'), Decimal('0.00'), Decimal('20.00'), Decimal('20.00')), Decimal('20.00'))
+        self.assertEqual(amounts, {3: '20.00'})
+
+    def test_fully_allocated_untouched(self):
+        """Test a fully allocated transaction is not added to another line
+        """
+        amounts = {'4': '5.00'}
+        self.assertIsNone(_allocate(amounts, 3, Decimal('50.00'), Decimal('50.00'), Decimal('20.00'), Decimal('20.00')))
+        self.assertIsNone(_allocate(amounts, 4, Decimal('5.00'), Decimal('5.00'), Decimal('20.00'), Decimal('20.00')))
+        self.assertEqual(amounts, {'4': '5.00'})
+
+
+class BpayCollectionDateTest(SimpleTestCase):
+
+    def test_collected_by_utc_date(self):
+        """Test a file created early in the Sydney morning belongs to the previous day's collection
+        """
+        self.assertEqual(get_collection_date(validate_datetime('20180301', '0930')), date(2018, 2, 28))
+        self.assertEqual(get_collection_date(validate_datetime('20180301', '1200')), date(2018, 3, 1))
+
+
+class BpayRecordValidationTest(SimpleTestCase):
+
+    def test_record_order(self):
+        """Test a file has to start with the file header
+        """
+        with self.assertRaisesRegexp(Exception, 'line 1: A record of type 02'):
+            store_records(iter([['02', '', '', '', '', '', '', '']]), 10)
+
+    def test_column_count(self):
+        """Test records are rejected at the line with the wrong number of columns
+        """
+        with self.assertRaisesRegexp(Exception, 'line 2: .* length of 9'):
+            store_records(iter([[], ['01', '', '', '', '']]), 10)
@@ -10,6 +10,7 @@ from django.core.mail import EmailMessage
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import transaction
+from django.db.models import Q, Sum
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import resolve
 from django.contrib.auth.models import AnonymousUser
@@ -17,15 +18,22 @@ from six.moves.urllib.parse import urlparse
 #
 from ledger.basket.models import Basket
 from ledger.catalogue.models import Product
-from ledger.payments.models import OracleParser, OracleParserInvoice, Invoice, OracleInterface, OracleInterfaceSystem, BpointTransaction, BpayTransaction, OracleAccountCode,OracleOpenPeriod 
+from ledger.order.models import LineAllocation
+from ledger.payments.models import OracleParser, OracleParserInvoice, Invoice, OracleInterface, OracleInterfaceSystem, BpointTransaction, BpayTransaction, CashTransaction, OracleAccountCode,OracleOpenPeriod 
 from oscar.core.loading import get_class
 from oscar.apps.voucher.models import Voucher
+from oscar.apps.order.models import Order
+from oscar.apps.shipping.methods import NoShippingRequired
 import logging
 logger = logging.getLogger(__name__)
 
 
 OrderPlacementMixin = get_class('checkout.mixins','OrderPlacementMixin')
 Selector = get_class('partner.strategy', 'Selector')
+Applicator = get_class('offer.applicator', 'Applicator')
+OrderCreator = get_class('order.utils', 'OrderCreator')
+OrderNumberGenerator = get_class('order.utils', 'OrderNumberGenerator')
+OrderTotalCalculator = get_class('checkout.calculators', 'OrderTotalCalculator')
 selector = Selector()
 
 def isLedgerURL(url):
@@ -206,6 +214,47 @@ def createCustomBasket(product_list,owner,system,vouchers=None,force_flush=True)
     except Exception as e:
         raise
 
+def internalCheckout(product_list,owner,system,custom_basket=False,vouchers=None,invoice_text=None,bpay_format='crn',icrn_format='ICRNAMT'):
+    ''' Check out a basket in process the same way a proxy checkout
+        through CheckoutCreateView does, i.e. without taking a payment.
+        @param product_list - same format as createBasket or createCustomBasket
+        @param - owner (user id or user object)
+        @return - (basket, order, invoice)
+    '''
+    from ledger.payments.invoice import facade as invoice_facade
+    with transaction.atomic():
+        if custom_basket:
+            basket = createCustomBasket(product_list,owner,system,vouchers=vouchers)
+        else:
+            basket = createBasket(product_list,owner,system,vouchers=vouchers)
+        owner = basket.owner
+        Applicator().apply(basket, owner)
+        shipping_method = NoShippingRequired()
+        shipping_charge = shipping_method.calculate(basket)
+        total = OrderTotalCalculator().calculate(basket, shipping_charge)
+        order_number = OrderNumberGenerator().order_number(basket)
+        basket.freeze()
+        # Generate the invoice
+        crn_string = '{0}{1}'.format(systemid_check(system),order_number)
+        if bpay_format == 'crn':
+            invoice = invoice_facade.create_invoice_crn(order_number,total.incl_tax,crn_string,system,invoice_text or '')
+        elif bpay_format == 'icrn':
+            invoice = invoice_facade.create_invoice_icrn(order_number,total.incl_tax,crn_string,icrn_format,system,invoice_text or '')
+        else:
+            raise ValidationError('{0} is not a supported BPAY method.'.format(bpay_format))
+        # Place the order
+        order = OrderCreator().place_order(
+            basket=basket,
+            total=total,
+            shipping_method=shipping_method,
+            shipping_charge=shipping_charge,
+            user=owner,
+            order_number=order_number
+        )
+        basket.submit()
+        update_payments(invoice.reference)
+    return basket, order, invoice
+
 #Oracle Parser
 def generateOracleParserFile(oracle_codes):
     strIO = StringIO()
@@ -327,6 +376,17 @@ def addToInterface(date,oracle_codes,system,override):
         return new_codes
     except:
         raise
+def _transaction_dates(model, ids, field):
+    ''' Map the string id of each transaction to its date field,
+        raising DoesNotExist for any missing transaction.
+    '''
+    ids = set(str(i) for i in ids)
+    dates = dict((str(k), v) for k, v in model.objects.filter(id__in=ids).values_list('id', field))
+    missing = ids.difference(dates.keys())
+    if missing:
+        raise model.DoesNotExist('{} matching query does not exist: {}'.format(model.__name__, ', '.join(sorted(missing))))
+    return dates
+
 def oracle_parser(date,system,system_name,override=False):
     invoices = []
     invoice_list = []
@@ -346,95 +406,95 @@ def oracle_parser(date,system,system_name,override=False):
             bpoint_txns.extend([x for x in BpointTransaction.objects.filter(settlement_date=date,response_code=0).exclude(crn1__endswith='_test')])
             bpay_txns.extend([x for x in BpayTransaction.objects.filter(p_date__contains=date, service_code=0)])
             # Get the required invoices
-            for b in bpoint_txns:
-                if b.crn1 not in invoice_list:
-                    invoice = Invoice.objects.get(reference=b.crn1)
-                    if invoice.system == system:
-                        invoices.append(invoice)
-                        invoice_list.append(b.crn1)
-            for b in bpay_txns:
-                if b.crn not in invoice_list:
-                    invoice = Invoice.objects.get(reference=b.crn)
+            references = [b.crn1 for b in bpoint_txns] + [b.crn for b in bpay_txns]
+            invoice_map = dict((i.reference, i) for i in Invoice.objects.filter(reference__in=set(references)))
+            for r in references:
+                if r not in invoice_list:
+                    if r not in invoice_map:
+                        raise Invoice.DoesNotExist('Invoice matching query does not exist: {}'.format(r))
+                    invoice = invoice_map[r]
                     if invoice.system == system:
                         invoices.append(invoice)
-                        invoice_list.append(b.crn)
+                        invoice_list.append(r)
+
+            # Prefetch the orders and their lines
+            order_map = dict((o.number, o) for o in Order.objects.filter(number__in=[i.order_number for i in invoices]).prefetch_related('lines'))
+            invoice_lines = []
             for invoice in invoices:
-                if invoice.order:
-                    if invoice.reference not in parser_codes.keys():
-                        parser_codes[invoice.reference] = {}
-                    # Go through the items
-                    items = invoice.order.lines.all()
-                    items_codes = [{'id':i.id,'code':i.oracle_code} for i in items]
-                    for i in items_codes:
-                        v = i['code']
-                        k = i['id']
-                        if i['code'] not in oracle_codes.keys():
-                            oracle_codes[v] = D('0.0')
-                        if i['id'] not in parser_codes[invoice.reference].keys():
-                            parser_codes[invoice.reference].update({k:{'code':v,'payment': D('0.0'),'refund': D('0.0'),'deductions': D('0.0')}})
-
-                    # Start passing items in the invoice
-                    for i in items:
-                        code = i.oracle_code
-                        item_id = i.id
-                        # Check previous parser results for this invoice
-                        previous_invoices = OracleParserInvoice.objects.filter(reference=invoice.reference,parser__date_parsed=date)
-                        code_paid_amount = D('0.0')
-                        code_refunded_amount = D('0.0')
-                        code_deducted_amount = D('0.0')
-                        for p in previous_invoices:
-                            details = dict(json.loads(p.details))
-                            for k,v in details.items():
-                                p_item = details[k]
-                                if int(k) == item_id:
-                                    code_paid_amount +=  D(p_item['payment'])
-                                    code_refunded_amount += D(p_item['refund'])
-                                    code_deducted_amount += D(p_item['deductions'])
-                        # Deal with the current item
-                        # Payments
-                        paid_amount = D('0.0')
-                        for k,v in i.payment_details['bpay'].items():
-                            b_txn = BpayTransaction.objects.get(id=k)
-                            paid_amount += D(v) if b_txn.p_date.strftime('%Y-%m-%d') == date else D(0.0)
-                        for k,v in i.payment_details['card'].items():
-                            b_txn = BpointTransaction.objects.get(id=k)
-                            paid_amount += D(v) if str(b_txn.settlement_date) == date else D(0.0)
-                        code_payable_amount = paid_amount - code_paid_amount
-                        if code_payable_amount >= 0:
-                            oracle_codes[code] += code_payable_amount
-                            for k,v in parser_codes[invoice.reference][item_id].items():
-                                item = parser_codes[invoice.reference][item_id]
-                                if k == 'payment':
-                                    item[k] += code_payable_amount
-
-                        # Deductions
-                        deducted_amount = D('0.0')
-                        for k,v in i.deduction_details['cash'].items():
-                            c_txn = CashTransaction.objects.get(id=k)
-                            deducted_amount += D(v) if c_txn.created.strftime('%Y-%m-%d') == date else D(0.0)
-                        code_deductable_amount = deducted_amount - code_deducted_amount
-                        if code_deductable_amount >= 0:
-                            oracle_codes[code] -= code_deductable_amount
-                            for k,v in parser_codes[invoice.reference][item_id].items():
-                                item = parser_codes[invoice.reference][item_id]
-                                if k == 'deductions':
-                                    item[k] += code_deductable_amount
-
-                        # Refunds
-                        refunded_amount = D('0.0')
-                        for k,v in i.refund_details['bpay'].items():
-                            b_txn = BpayTransaction.objects.get(id=k)
-                            refunded_amount += D(v) if b_txn.p_date.strftime('%Y-%m-%d') == date else D(0.0)
-                        for k,v in i.refund_details['card'].items():
-                            b_txn = BpointTransaction.objects.get(id=k)
-                            refunded_amount += D(v) if str(b_txn.settlement_date) == date else D(0.0)
-                        code_refundable_amount = refunded_amount - code_refunded_amount
-                        if code_refundable_amount >= 0:
-                            oracle_codes[code] -= code_refundable_amount
-                            for k,v in parser_codes[invoice.reference][item_id].items():
-                                item = parser_codes[invoice.reference][item_id]
-                                if k == 'refund':
-                                    item[k] += code_refundable_amount
+                if invoice.order_number in order_map:
+                    invoice_lines.append((invoice, list(order_map[invoice.order_number].lines.all())))
+
+            # Sum the allocations of the lines per transaction
+            line_allocations = {}
+            bpay_ids, card_ids, cash_ids = set(), set(), set()
+            allocations = LineAllocation.objects.filter(
+                Q(source__in=['bpay', 'card'], kind__in=['payment', 'refund']) | Q(source='cash', kind='deduction'),
+                line__in=[i.id for invoice, items in invoice_lines for i in items]
+            )
+            for line_id, kind, source, txn_id, amount in allocations.values_list('line', 'kind', 'source', 'transaction_id').annotate(total=Sum('amount')):
+                line_allocations.setdefault(line_id, []).append((kind, source, str(txn_id), amount))
+                {'bpay': bpay_ids, 'card': card_ids, 'cash': cash_ids}[source].add(txn_id)
+            bpay_dates = dict((k, v.strftime('%Y-%m-%d')) for k, v in _transaction_dates(BpayTransaction, bpay_ids, 'p_date').items())
+            card_dates = dict((k, str(v)) for k, v in _transaction_dates(BpointTransaction, card_ids, 'settlement_date').items())
+            cash_dates = dict((k, v.strftime('%Y-%m-%d')) for k, v in _transaction_dates(CashTransaction, cash_ids, 'created').items())
+            txn_dates = {'bpay': bpay_dates, 'card': card_dates, 'cash': cash_dates}
+
+            previous_details = {}
+            for reference, details in OracleParserInvoice.objects.filter(reference__in=invoice_list,parser__date_parsed=date).order_by('id').values_list('reference','details'):
+                previous_details.setdefault(reference, []).append(dict(json.loads(details)))
+
+            for invoice, items in invoice_lines:
+                if invoice.reference not in parser_codes.keys():
+                    parser_codes[invoice.reference] = {}
+                # Go through the items
+                for i in items:
+                    v = i.oracle_code
+                    k = i.id
+                    if v not in oracle_codes.keys():
+                        oracle_codes[v] = D('0.0')
+                    if k not in parser_codes[invoice.reference].keys():
+                        parser_codes[invoice.reference].update({k:{'code':v,'payment': D('0.0'),'refund': D('0.0'),'deductions': D('0.0')}})
+
+                # Start passing items in the invoice
+                for i in items:
+                    code = i.oracle_code
+                    item_id = i.id
+                    item = parser_codes[invoice.reference][item_id]
+                    # Check previous parser results for this invoice
+                    code_paid_amount = D('0.0')
+                    code_refunded_amount = D('0.0')
+                    code_deducted_amount = D('0.0')
+                    for details in previous_details.get(invoice.reference, []):
+                        for k,p_item in details.items():
+                            if int(k) == item_id:
+                                code_paid_amount +=  D(p_item['payment'])
+                                code_refunded_amount += D(p_item['refund'])
+                                code_deducted_amount += D(p_item['deductions'])
+                    # Deal with the current item
+                    day_amounts = {'payment': D('0.0'), 'refund': D('0.0'), 'deduction': D('0.0')}
+                    for kind, source, txn_id, amount in line_allocations.get(item_id, []):
+                        if txn_dates[source][txn_id] == date:
+                            day_amounts[kind] += amount
+                    # Payments
+                    paid_amount = day_amounts['payment']
+                    code_payable_amount = paid_amount - code_paid_amount
+                    if code_payable_amount >= 0:
+                        oracle_codes[code] += code_payable_amount
+                        item['payment'] += code_payable_amount
+
+                    # Deductions
+                    deducted_amount = day_amounts['deduction']
+                    code_deductable_amount = deducted_amount - code_deducted_amount
+                    if code_deductable_amount >= 0:
+                        oracle_codes[code] -= code_deductable_amount
+                        item['deductions'] += code_deductable_amount
+
+                    # Refunds
+                    refunded_amount = day_amounts['refund']
+                    code_refundable_amount = refunded_amount - code_refunded_amount
+                    if code_refundable_amount >= 0:
+                        oracle_codes[code] -= code_refundable_amount
+                        item['refund'] += code_refundable_amount
 
             # Convert Deimals to strings as they cannot be serialized
             for k,v in parser_codes.items():
@@ -459,241 +519,244 @@ def oracle_parser(date,system,system_name,override=False):
         raise e
 
 def update_payments(invoice_reference):
+    ''' Allocate the payments, refunds and deductions of an invoice to its order lines.
+    '''
+    allocate_payments([invoice_reference])
+
+PAYMENT_DETAILS = ('payment_details', 'refund_details', 'deduction_details')
+LINE_UPDATE_CHUNK_SIZE = 500
+
+def _line_allocations(line):
+    ''' Amounts allocated on a line keyed by (details, kind, transaction id).
+    '''
+    allocations = {}
+    for details in PAYMENT_DETAILS:
+        for kind, amounts in getattr(line, details).items():
+            for txn_id, amount in amounts.items():
+                key = (details, kind, str(txn_id))
+                allocations[key] = allocations.get(key, D('0.0')) + D(amount)
+    return allocations
+
+def _details_total(line, details):
+    ''' Total of a line's payment, refund or deduction details as held in memory.
+    '''
+    return sum((D(a) for amounts in getattr(line, details).values() for a in amounts.values()), D('0.0'))
+
+def _normalise_details(line):
+    ''' Convert transaction ids to strings the way a save and reload
+        through the JSON fields would.
+    '''
+    for details in PAYMENT_DETAILS:
+        setattr(line, details, dict(
+            (kind, dict((str(k), v) for k, v in amounts.items()))
+            for kind, amounts in getattr(line, details).items()
+        ))
+
+def _allocate(amounts, txn_id, txn_amount, allocated, remaining_amount, remaining_total, check_remaining=True):
+    ''' Allocate a transaction to a line's payment, refund or deduction
+        details.
+        Returns the amount to add to the running totals or None.
+    '''
+    unallocated = txn_amount - allocated
+    # leave fully allocated transactions alone so allocating again changes nothing
+    if unallocated <= 0:
+        return None
+    if str(txn_id) in amounts.keys() and (remaining_total > 0 or not check_remaining):
+        if remaining_amount <= unallocated:
+            new_amount = D(amounts[str(txn_id)]) + remaining_amount
+        else:
+            new_amount = D(amounts[str(txn_id)]) + unallocated
+        amounts[str(txn_id)] = str(new_amount)
+        return new_amount
+    if remaining_amount <= unallocated:
+        new_amount = D(0.0) + remaining_amount
+    else:
+        new_amount = D(0.0) + unallocated
+    amounts[txn_id] = str(new_amount)
+    return new_amount
+
+def _bulk_update_lines(lines):
+    ''' Write the payment details of the given lines back in a single
+        UPDATE ... FROM (VALUES ...) statement per chunk, along with their
+        allocation rows.
+    '''
+    from django.db import connection
+    from ledger.order.models import Line, LineAllocation
+    table = connection.ops.quote_name(Line._meta.db_table)
+    for start in range(0, len(lines), LINE_UPDATE_CHUNK_SIZE):
+        chunk = lines[start:start + LINE_UPDATE_CHUNK_SIZE]
+        params = []
+        for line in chunk:
+            params.append(line.pk)
+            params.extend(json.dumps(getattr(line, details)) for details in PAYMENT_DETAILS)
+        sql = 'UPDATE {0} SET payment_details = v.payment_details, refund_details = v.refund_details, deduction_details = v.deduction_details ' \
+              'FROM (VALUES {1}) AS v(id, payment_details, refund_details, deduction_details) WHERE {0}.id = v.id'.format(
+                  table, ', '.join(['(%s, %s::jsonb, %s::jsonb, %s::jsonb)'] * len(chunk)))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        LineAllocation.sync(chunk)
+
+def _allocate_invoice(invoice, lines, bpoints, bpays, cash):
+    ''' Allocate the payments of one invoice against its prefetched
+        lines and transactions.
+        Returns the lines whose details changed.
+    '''
+    saved = {}
+    originals = {}
+    for line in lines:
+        originals[line.pk] = [json.dumps(getattr(line, d), sort_keys=True) for d in PAYMENT_DETAILS]
+        for key, amount in _line_allocations(line).items():
+            saved[key] = saved.get(key, D('0.0')) + amount
+
+    def allocated(details, kind, txn_id):
+        return saved.get((details, kind, str(txn_id)), D('0.0'))
+
+    def save(line, before):
+        _normalise_details(line)
+        for key, amount in before.items():
+            saved[key] -= amount
+        for key, amount in _line_allocations(line).items():
+            saved[key] = saved.get(key, D('0.0')) + amount
+
+    refunded = D(0.0)
+    paid = D(0.0)
+    deductions = D(0.0)
+    total_paid = invoice.total_payment_amount
+    total_refund = invoice.refund_amount
+    total_deductions = invoice.deduction_amount
+    for line in lines:
+        before = _line_allocations(line)
+        paid_amount = _details_total(line, 'payment_details')
+        refunded_amount = _details_total(line, 'refund_details')
+        deducted_amount = _details_total(line, 'deduction_details')
+        amount = line.line_price_incl_tax
+        paid += paid_amount
+        refunded += refunded_amount
+        deductions += deducted_amount
+        # Bpoint Amounts
+        for bpoint in bpoints:
+            if bpoint.approved:
+                if paid_amount < amount and paid < total_paid and bpoint.action == 'payment':
+                    new_amount = _allocate(line.payment_details['card'], bpoint.id, bpoint.amount, allocated('payment_details', 'card', bpoint.id),
+                                           amount - paid_amount, total_paid - paid)
+                    if new_amount is not None:
+                        paid_amount += new_amount
+                        paid += new_amount
+                if refunded_amount < amount and refunded < total_refund and bpoint.action == 'refund':
+                    new_amount = _allocate(line.refund_details['card'], bpoint.id, bpoint.amount, allocated('refund_details', 'card', bpoint.id),
+                                           amount - refunded_amount, total_refund - refunded)
+                    if new_amount is not None:
+                        refunded_amount += new_amount
+                        refunded += new_amount
+        # Bpay Transactions
+        for bpay in bpays:
+            if bpay.approved:
+                if paid_amount < amount and paid < total_paid and bpay.p_instruction_code == '05' and bpay.type == '399':
+                    new_amount = _allocate(line.payment_details['bpay'], bpay.id, bpay.amount, allocated('payment_details', 'bpay', bpay.id),
+                                           amount - paid_amount, total_paid - paid)
+                    if new_amount is not None:
+                        paid_amount += new_amount
+                        paid += new_amount
+                if refunded_amount < amount and refunded < total_refund and bpay.p_instruction_code == '25' and bpay.type == '699':
+                    new_amount = _allocate(line.refund_details['bpay'], bpay.id, bpay.amount, allocated('refund_details', 'bpay', bpay.id),
+                                           amount - refunded_amount, total_refund - refunded)
+                    if new_amount is not None:
+                        refunded_amount += new_amount
+                        refunded += new_amount
+        # Cash Transactions
+        for c in cash:
+            if paid_amount < amount and paid < total_paid and c.type in ['payment','move_in']:
+                new_amount = _allocate(line.payment_details['cash'], c.id, c.amount, allocated('payment_details', 'cash', c.id),
+                                       amount - paid_amount, total_paid - paid)
+                if new_amount is not None:
+                    paid_amount += new_amount
+                    paid += new_amount
+            if deducted_amount < amount and deductions < total_deductions and c.type == 'move_out':
+                new_amount = _allocate(line.deduction_details['cash'], c.id, c.amount, allocated('deduction_details', 'cash', c.id),
+                                       amount - deducted_amount, total_deductions - deductions, check_remaining=False)
+                if new_amount is not None:
+                    deducted_amount += new_amount
+                    deductions += new_amount
+            if refunded_amount < amount and refunded < total_refund and c.type == 'refund':
+                new_amount = _allocate(line.refund_details['cash'], c.id, c.amount, allocated('refund_details', 'cash', c.id),
+                                       amount - refunded_amount, total_refund - refunded)
+                if new_amount is not None:
+                    refunded_amount += new_amount
+                    refunded += new_amount
+        save(line, before)
+
+    # Add anything left unallocated to the first line item
+    first_item = lines[0]
+    for details, total, allocated_total in (('payment_details', total_paid, paid), ('refund_details', total_refund, refunded)):
+        if total <= allocated_total:
+            continue
+        action = 'payment' if details == 'payment_details' else 'refund'
+        residuals = [('card', b) for b in bpoints if b.action == action]
+        if action == 'payment':
+            residuals += [('bpay', b) for b in bpays if b.p_instruction_code == '05' and b.type == '399']
+            residuals += [('cash', b) for b in cash if b.type in ['payment','move_in']]
+        else:
+            residuals += [('bpay', b) for b in bpays if b.p_instruction_code == '25' and b.type == '699']
+            residuals += [('cash', b) for b in cash if b.type == 'refund']
+        before = _line_allocations(first_item)
+        amounts = getattr(first_item, details)
+        for kind, b in residuals:
+            txn_allocated = allocated(details, kind, b.id)
+            if txn_allocated < b.amount:
+                if amounts[kind].get(str(b.id)):
+                    amounts[kind][str(b.id)] = str(D(amounts[kind][str(b.id)]) + (b.amount - txn_allocated))
+                else:
+                    amounts[kind][str(b.id)] = str(b.amount - txn_allocated)
+        save(first_item, before)
+
+    return [line for line in lines
+            if [json.dumps(getattr(line, d), sort_keys=True) for d in PAYMENT_DETAILS] != originals[line.pk]]
+
+def allocate_payments(invoice_references):
+    ''' Allocate the payments of many invoices to their order lines.
+        The invoices, their order lines and transactions are fetched once,
+        the payments are allocated in memory in transaction id order, and
+        the changed lines are written back in bulk. Transactions that are
+        already fully allocated are left alone, so running it again without
+        new transactions changes nothing.
+    '''
+    from ledger.order.models import Line
+    from ledger.payments.models import InvoiceBPAY
+    from ledger.payments.invoice.models import annotate_payment_totals
+    references = set(str(r) for r in invoice_references)
+    if not references:
+        return
     with transaction.atomic():
-        try:
-            i = None
-            try:
-                i = Invoice.objects.get(reference=str(invoice_reference))
-            except Invoice.DoesNotExist:
-                raise ValidationError('The invoice with refererence {} does not exist'.format(invoice_reference))
-            refunded = D(0.0)
-            paid = D(0.0)
-            deductions = D(0.0)
-            # Bpoint Transactions
-            if i.order:
-                for line in i.order.lines.all():
-                    paid_amount = line.paid
-                    refunded_amount = line.refunded
-                    deducted_amount = line.deducted
-                    amount = line.line_price_incl_tax
-                    total_paid = i.total_payment_amount
-                    total_refund = i.refund_amount
-                    total_deductions = i.deduction_amount
-                    paid += paid_amount
-                    refunded += refunded_amount
-                    deductions += deducted_amount
-                    # Bpoint Amounts
-                    for bpoint in i.bpoint_transactions:
-                        if bpoint.approved:
-                            if paid_amount < amount and paid < total_paid:
-                                if bpoint.action == 'payment':
-                                    remaining_amount = amount - paid_amount
-                                    remaining_payable_amount = total_paid - paid
-                                    unallocated = bpoint.amount - bpoint.payment_allocated
-                                    if str(bpoint.id) in line.payment_details['card'].keys() and remaining_payable_amount > 0:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(line.payment_details['card'][str(bpoint.id)]) + remaining_amount
-                                        else:
-                                            new_amount = D(line.payment_details['card'][str(bpoint.id)]) + unallocated
-                                        if unallocated > 0:
-                                            line.payment_details['card'][str(bpoint.id)] = str(new_amount)
-                                            paid_amount += new_amount 
-                                            paid += new_amount
-                                    else:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(0.0) + remaining_amount
-                                        else:
-                                            new_amount = D(0.0) + unallocated
-                                        line.payment_details['card'][bpoint.id] = str(new_amount)
-                                        paid_amount += new_amount 
-                                        paid += new_amount
-                            if refunded_amount < amount and refunded < total_refund:
-                                if bpoint.action == 'refund':
-                                    remaining_amount = amount - refunded_amount
-                                    remaining_refundable_amount = total_refund - refunded
-                                    unallocated = bpoint.amount - bpoint.refund_allocated
-                                    if str(bpoint.id) in line.refund_details['card'].keys() and remaining_refundable_amount > 0:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(line.refund_details['card'][str(bpoint.id)]) + remaining_amount
-                                        else:
-                                            new_amount = D(line.refund_details['card'][str(bpoint.id)]) + unallocated
-                                        if unallocated > 0:
-                                            line.refund_details['card'][str(bpoint.id)] = str(new_amount)
-                                            refunded_amount += new_amount 
-                                            refunded += new_amount
-                                    else:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(0.0) + remaining_amount
-                                        else:
-                                            new_amount = D(0.0) + unallocated
-                                        line.refund_details['card'][bpoint.id] = str(new_amount)
-                                        refunded_amount += new_amount 
-                                        refunded += new_amount
-                    # Bpay Transactions
-                    for bpay in i.bpay_transactions:
-                        if bpay.approved:
-                            if paid_amount < amount and paid < total_paid:
-                                if bpay.p_instruction_code == '05' and bpay.type == '399':
-                                    remaining_amount = amount - paid_amount
-                                    remaining_payable_amount = total_paid - paid
-                                    unallocated = bpay.amount - bpay.payment_allocated
-                                    if str(bpay.id) in line.payment_details['bpay'].keys() and remaining_payable_amount > 0:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(line.payment_details['bpay'][str(bpay.id)]) + remaining_amount
-                                        else:
-                                            new_amount = D(line.payment_details['bpay'][str(bpay.id)]) + unallocated
-                                        if unallocated > 0:
-                                            line.payment_details['bpay'][str(bpay.id)] = str(new_amount)
-                                            paid_amount += new_amount 
-                                            paid += new_amount
-                                    else:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(0.0) + remaining_amount
-                                        else:
-                                            new_amount = D(0.0) + unallocated
-                                        line.payment_details['bpay'][bpay.id] = str(new_amount)
-                                        paid_amount += new_amount 
-                                        paid += new_amount
-                            if refunded_amount < amount and refunded < total_refund:
-                                if bpay.p_instruction_code == '25' and bpay.type == '699':
-                                    remaining_amount = amount - refunded_amount
-                                    remaining_refundable_amount = total_refund - refunded
-                                    unallocated = bpay.amount - bpay.refund_allocated
-                                    if str(bpay.id) in line.refund_details['bpay'].keys() and remaining_refundable_amount > 0:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(line.refund_details['bpay'][str(bpay.id)]) + remaining_amount
-                                        else:
-                                            new_amount = D(line.refund_details['bpay'][str(bpay.id)]) + unallocated
-                                        if unallocated > 0:
-                                            line.refund_details['bpay'][str(bpay.id)] = str(new_amount)
-                                            refunded_amount += new_amount 
-                                            refunded += new_amount
-                                    else:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(0.0) + remaining_amount
-                                        else:
-                                            new_amount = D(0.0) + unallocated
-                                        line.refund_details['bpay'][bpay.id] = str(new_amount)
-                                        refunded_amount += new_amount 
-                                        refunded += new_amount
-                    # Cash Transactions
-                    for c in i.cash_transactions.all():
-                        if paid_amount < amount and paid < total_paid:
-                            if c.type in ['payment','move_in']:
-                                remaining_amount = amount - paid_amount
-                                remaining_payable_amount = total_paid - paid
-                                unallocated = c.amount - c.payment_allocated
-                                if str(c.id) in line.payment_details['cash'].keys() and remaining_payable_amount > 0:
-                                    if remaining_amount <= unallocated:
-                                        new_amount = D(line.payment_details['cash'][str(c.id)]) + remaining_amount
-                                    else:
-                                        new_amount = D(line.payment_details['cash'][str(c.id)]) + unallocated
-                                    if unallocated > 0:
-                                        line.payment_details['cash'][str(c.id)] = str(new_amount)
-                                        paid_amount += new_amount 
-                                        paid += new_amount
-                                else:
-                                    if remaining_amount <= unallocated:
-                                        new_amount = D(0.0) + remaining_amount
-                                    else:
-                                        new_amount = D(0.0) + unallocated
-                                    line.payment_details['cash'][c.id] = str(new_amount)
-                                    paid_amount += new_amount 
-                                    paid += new_amount
-                        if deducted_amount < amount and deductions < total_deductions:
-                            if c.type == 'move_out':
-                                remaining_amount = amount - deducted_amount
-                                remaining_deductable_amount = total_deductions - deductions
-                                unallocated = c.amount - c.deduction_allocated
-                                if str(c.id) in line.deduction_details['cash'].keys():
-                                    if remaining_amount <= unallocated:
-                                        new_amount = D(line.deduction_details['cash'][str(c.id)]) + remaining_amount
-                                    else:
-                                        new_amount = D(line.deduction_details['cash'][str(c.id)]) + unallocated
-                                    if unallocated > 0:
-                                        line.deduction_details['cash'][str(c.id)] = str(new_amount)
-                                        deducted_amount += new_amount 
-                                        deductions += new_amount
-                                else:
-                                    if remaining_amount <= unallocated:
-                                        new_amount = D(0.0) + remaining_amount
-                                    else:
-                                        new_amount = D(0.0) + unallocated
-                                    line.deduction_details['cash'][c.id] = str(new_amount)
-                                    deducted_amount += new_amount 
-                                    deductions += new_amount
-                        if refunded_amount < amount and refunded < total_refund:
-                            if c.type == 'refund':
-                                remaining_amount = amount - refunded_amount
-                                remaining_refundable_amount = total_refund - refunded
-                                unallocated = c.amount - c.refund_allocated
-                                if str(c.id) in line.refund_details['cash'].keys() and remaining_refundable_amount > 0:
-                                    if remaining_amount <= unallocated:
-                                        new_amount = D(line.refund_details['cash'][str(c.id)]) + remaining_amount
-                                    else:
-                                        new_amount = D(line.refund_details['cash'][str(c.id)]) + unallocated
-                                    if unallocated > 0:
-                                        line.refund_details['cash'][str(c.id)] = str(new_amount)
-                                        refunded_amount += new_amount 
-                                        refunded += new_amount
-                                else:
-                                    if remaining_amount <= unallocated:
-                                        new_amount = D(0.0) + remaining_amount
-                                    else:
-                                        new_amount = D(0.0) + unallocated
-                                    line.refund_details['cash'][c.id] = str(new_amount)
-                                    refunded_amount += new_amount 
-                                    refunded += new_amount
-                    line.save()
-            # Check if the whole amount paid on the invoice has been allocated otherwise add to the first line item
-            if i.total_payment_amount > paid:
-                first_item = i.order.lines.first()
-                # Bpoint
-                for b in i.bpoint_transactions:
-                    if b.payment_allocated < b.amount and b.action == 'payment':
-                        if first_item.payment_details['card'].get(str(b.id)):
-                             first_item.payment_details['card'][str(b.id)] = str(D(first_item.payment_details['card'][str(b.id)]) + (b.amount - b.payment_allocated))
-                        else:
-                            first_item.payment_details['card'][str(b.id)] = str(b.amount - b.payment_allocated)
-                # Bpay
-                for b in i.bpay_transactions:
-                    if b.payment_allocated < b.amount and b.p_instruction_code == '05' and b.type == '399':
-                        if first_item.payment_details['bpay'].get(str(b.id)):
-                            first_item.payment_details['bpay'][str(b.id)] = str(D(first_item.payment_details['bpay'][str(b.id)]) + (b.amount - b.payment_allocated))
-                        else:
-                            first_item.payment_details['bpay'][str(b.id)] = str(b.amount - b.payment_allocated)
-                # Cash
-                for b in i.cash_transactions.all():
-                    if b.payment_allocated < b.amount and b.type in ['payment','move_in']:
-                        if first_item.payment_details['cash'].get(str(b.id)):
-                            first_item.payment_details['cash'][str(b.id)] = str(D(first_item.payment_details['cash'][str(b.id)]) + (b.amount - b.payment_allocated))
-                        else:
-                            first_item.payment_details['cash'][str(b.id)] = str(b.amount - b.payment_allocated)
-                first_item.save()
-            if i.refund_amount > refunded:
-                first_item = i.order.lines.first()
-                # Bpoint
-                for b in i.bpoint_transactions:
-                    if b.refund_allocated < b.amount and b.action == 'refund':
-                        if first_item.refund_details['card'].get(str(b.id)):
-                            first_item.refund_details['card'][str(b.id)] = str(D(first_item.refund_details['card'][str(b.id)]) + (b.amount - b.refund_allocated))
-                        else:
-                            first_item.refund_details['card'][str(b.id)] = str(b.amount - b.refund_allocated)
-                # Bpay
-                for b in i.bpay_transactions:
-                    if b.refund_allocated < b.amount and b.p_instruction_code == '25' and b.type == '699':
-                        if first_item.refund_details['bpay'].get(str(b.id)):
-                            first_item.refund_details['bpay'][str(b.id)] = str(D(first_item.refund_details['bpay'][str(b.id)]) + (b.amount - b.refund_allocated))
-                        else:
-                            first_item.refund_details['bpay'][str(b.id)] = str(b.amount - b.refund_allocated)
-                # Cash
-                for b in i.cash_transactions.all():
-                    if b.refund_allocated < b.amount and b.type == 'refund':
-                        if first_item.refund_details['cash'].get(str(b.id)):
-                            first_item.refund_details['cash'][str(b.id)] = str(D(first_item.refund_details['cash'][str(b.id)]) + (b.amount - b.refund_allocated))
-                        else:
-                            first_item.refund_details['cash'][str(b.id)] = str(b.amount - b.refund_allocated)
-                first_item.save()
-        except:
-            print(traceback.print_exc())
-            raise
+        invoices = annotate_payment_totals(Invoice.objects.filter(reference__in=references))
+        missing = references - set(i.reference for i in invoices)
+        if missing:
+            raise ValidationError('The invoice with refererence {} does not exist'.format(', '.join(sorted(missing))))
+        for i in invoices:
+            i.update_payment_summary(refresh=False)
+
+        lines = {}
+        for line in Line.objects.filter(order__number__in=[i.order_number for i in invoices]).select_related('order').order_by('pk'):
+            lines.setdefault(line.order.number, []).append(line)
+        bpoints = {}
+        for b in BpointTransaction.objects.filter(crn1__in=references).order_by('pk'):
+            bpoints.setdefault(b.crn1, []).append(b)
+        bpays = {}
+        for b in BpayTransaction.objects.filter(crn__in=references).order_by('pk'):
+            bpays.setdefault(b.crn, []).append(b)
+        for link in InvoiceBPAY.objects.filter(invoice__reference__in=references).select_related('bpay', 'invoice'):
+            linked = bpays.setdefault(link.invoice.reference, [])
+            if link.bpay.id not in [b.id for b in linked]:
+                linked.append(link.bpay)
+        for linked in bpays.values():
+            linked.sort(key=lambda b: b.id)
+        cash = {}
+        for c in CashTransaction.objects.filter(invoice__in=references).order_by('pk'):
+            cash.setdefault(c.invoice_id, []).append(c)
+
+        changed = []
+        for i in invoices:
+            order_lines = lines.get(i.order_number)
+            if not order_lines:
+                continue
+            changed.extend(_allocate_invoice(i, order_lines, bpoints.get(i.reference, []), bpays.get(i.reference, []), cash.get(i.reference, [])))
+        _bulk_update_lines(changed)
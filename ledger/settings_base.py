@@ -282,6 +282,8 @@ LEDGER_GST = env('LEDGER_GST',10)
 # BPAY settings
 BPAY_ALLOWED = env('BPAY_ALLOWED',True)
 BPAY_BILLER_CODE=env('BPAY_BILLER_CODE')
+BPAY_PARSER_BATCH_SIZE=env('BPAY_PARSER_BATCH_SIZE',1000)
+BPAY_PARSER_WORKERS=env('BPAY_PARSER_WORKERS',1)
 # BPOINT settings
 BPOINT_CURRENCY='AUD'
 BPOINT_BILLER_CODE=env('BPOINT_BILLER_CODE')
@@ -3,7 +3,7 @@ import base64
 import geojson
 from six.moves.urllib.parse import urlparse
 from wsgiref.util import FileWrapper
-from django.db.models import Q, Min
+from django.db.models import Q, Min, Count
 from django.db import transaction
 from django.http import HttpResponse
 from django.core.files.base import ContentFile
@@ -13,6 +13,7 @@ from django.contrib import messages
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.utils import timezone
+from django.utils.decorators import method_decorator
 from rest_framework import viewsets, serializers, status, generics, views
 from rest_framework.decorators import detail_route, list_route,renderer_classes,authentication_classes,permission_classes
 from rest_framework.response import Response
@@ -21,12 +22,15 @@ from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser, B
 from rest_framework.pagination import PageNumberPagination
 from datetime import datetime, timedelta
 from collections import OrderedDict
-from django.core.cache import cache
 from ledger.accounts.models import EmailUser,Address
 from ledger.address.models import Country
 from ledger.payments.models import Invoice
+from ledger.order.models import Line
 from parkstay import utils
-from parkstay.helpers import can_view_campground
+from parkstay.availability import build_availability_matrix, campground_max_stays, class_availability
+from parkstay.caching import cached_payload, generation_condition
+from parkstay.helpers import viewable_campgrounds
+from parkstay.snapshots import snapshot_response
 from datetime import datetime,timedelta, date
 from parkstay.models import (Campground,
                                 District,
@@ -54,7 +58,11 @@ from parkstay.models import (Campground,
                                 PriceReason,
                                 MaximumStayReason,
                                 ParkEntryRate,
-                                BookingVehicleRego
+                                BookingVehicleRego,
+                                PAYLOAD_MODELS,
+                                MAP_MODELS,
+                                SUGGEST_MODELS,
+                                AVAILABILITY_MODELS
                                 )
 
 from parkstay.serialisers import (  CampsiteBookingSerialiser,
@@ -377,12 +385,30 @@ class CampgroundStayHistoryViewSet(viewsets.ModelViewSet):
             raise serializers.ValidationError(str(e))
 
 
+def _site_and_day(request, *args, **kwargs):
+    return (request.build_absolute_uri('/'), date.today())
+
+
+def _query_and_day(request, *args, **kwargs):
+    return (request.build_absolute_uri(), date.today())
+
+
+def _availability_parts(request, *args, **kwargs):
+    # the response flags the ongoing booking in the session
+    return (request.build_absolute_uri(), date.today(), request.session.get('ps_booking'))
+
+
+@method_decorator(generation_condition(MAP_MODELS, _site_and_day), name='dispatch')
 class CampgroundMapViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Campground.objects.exclude(campground_type=3).annotate(Min('campsites__rates__rate__adult'))
     serializer_class = CampgroundMapSerializer
     permission_classes = []
 
+    def list(self, request, *args, **kwargs):
+        return snapshot_response('campground_map', request)
 
+
+@method_decorator(generation_condition(MAP_MODELS + AVAILABILITY_MODELS, _query_and_day), name='dispatch')
 class CampgroundMapFilterViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Campground.objects.exclude(campground_type=3)
     serializer_class = CampgroundMapFilterSerializer
@@ -433,37 +459,19 @@ class CampgroundMapFilterViewSet(viewsets.ReadOnlyModelViewSet):
         else:
             end_date = today + timedelta(days=1)
 
-        temp_queryset = Campground.objects.filter(id__in=ground_ids).order_by('name')
-        queryset = []
-        for q in temp_queryset:
-            # Get the current stay history
-            stay_history = CampgroundStayHistory.objects.filter(
-                            Q(range_start__lte=start_date,range_end__gte=start_date)|# filter start date is within period
-                            Q(range_start__lte=end_date,range_end__gte=end_date)|# filter end date is within period
-                            Q(Q(range_start__gt=start_date,range_end__lt=end_date)&Q(range_end__gt=today)) #filter start date is before and end date after period
-                            ,campground=q)
-            if stay_history:
-                max_days = min([x.max_days for x in stay_history])
-            else:
-                max_days = settings.PS_MAX_BOOKING_LENGTH
-            if (end_date - start_date).days <= max_days:            
-                queryset.append(q)
+        # Get the current stay history for every campground in one grouped query
+        max_stays = campground_max_stays(ground_ids, start_date, end_date, today)
+        ground_ids = [k for k, max_days in max_stays.items() if (end_date - start_date).days <= max_days]
+        queryset = Campground.objects.filter(id__in=ground_ids).order_by('name')
 
         serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
 
 @require_http_methods(['GET'])
+@generation_condition(SUGGEST_MODELS)
 def search_suggest(request, *args, **kwargs):
-    entries = []
-    for x in Campground.objects.filter(wkb_geometry__isnull=False).values_list('id', 'name', 'wkb_geometry'):
-        entries.append(geojson.Point((x[2].x, x[2].y), properties={'type': 'Campground', 'id': x[0], 'name': x[1]}))
-    for x in Park.objects.filter(wkb_geometry__isnull=False).values_list('id', 'name', 'wkb_geometry'):
-        entries.append(geojson.Point((x[2].x, x[2].y), properties={'type': 'Park', 'id': x[0], 'name': x[1]}))
-    for x in PromoArea.objects.filter(wkb_geometry__isnull=False).values_list('id', 'name', 'wkb_geometry'):
-        entries.append(geojson.Point((x[2].x, x[2].y), properties={'type': 'PromoArea', 'id': x[0], 'name': x[1]}))
-
-    return HttpResponse(geojson.dumps(geojson.FeatureCollection(entries)), content_type='application/json')
+    return snapshot_response('search_suggest', request)
 
 
 class CampgroundViewSet(viewsets.ModelViewSet):
@@ -473,27 +481,21 @@ class CampgroundViewSet(viewsets.ModelViewSet):
     @list_route(methods=['GET',])
     @renderer_classes((JSONRenderer,))
     def datatable_list(self,request,format=None):
-        queryset = cache.get('campgrounds_dt')
-        if queryset is None:
-            queryset = self.get_queryset()
-            cache.set('campgrounds_dt',queryset,3600)
-        qs = [c for c in queryset.all() if can_view_campground(request.user,c)]
-        serializer = CampgroundDatatableSerializer(qs,many=True)
-        data = serializer.data
-        return Response(data)
+        data = cached_payload('campgrounds_dt', PAYLOAD_MODELS,
+            lambda: list(CampgroundDatatableSerializer(self.get_queryset(),many=True).data),
+            parts=(date.today(),))
+        viewable = viewable_campgrounds(request.user)
+        return Response([c for c in data if c['id'] in viewable])
 
     @renderer_classes((JSONRenderer,))
     def list(self, request, format=None):
 
-        queryset = cache.get('campgrounds')
         formatted = bool(request.GET.get("formatted", False))
-        if queryset is None:
-            queryset = self.get_queryset()
-            cache.set('campgrounds',queryset,3600)
-        qs = [c for c in queryset.all() if can_view_campground(request.user,c)]
-        serializer = self.get_serializer(qs, formatted=formatted, many=True, method='get')
-        data = serializer.data
-        return Response(data)
+        data = cached_payload('campgrounds', PAYLOAD_MODELS,
+            lambda: list(self.get_serializer(self.get_queryset(), formatted=formatted, many=True, method='get').data),
+            parts=(request.build_absolute_uri('/'), formatted, date.today()))
+        viewable = viewable_campgrounds(request.user)
+        return Response([c for c in data if c['id'] in viewable])
 
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
@@ -633,7 +635,6 @@ class CampgroundViewSet(viewsets.ModelViewSet):
             # return object
             ground = self.get_object()
             res = CampgroundSerializer(ground, context={'request':request})
-            cache.delete('campgrounds_dt')
             return Response(res.data)
         except serializers.ValidationError:
             print(traceback.print_exc())
@@ -669,7 +670,6 @@ class CampgroundViewSet(viewsets.ModelViewSet):
                 #import thread
                 #thread.start_new_thread( self.close_campgrounds, (closure_data,campgrounds,) )
                 self.close_campgrounds(closure_data,campgrounds)
-                cache.delete('campgrounds_dt')
                 return Response('All Selected Campgrounds Closed')
             except serializers.ValidationError:
                 print(traceback.print_exc())
@@ -990,9 +990,9 @@ class BaseAvailabilityViewSet(viewsets.ReadOnlyModelViewSet):
             } for siteid, dates in utils.get_visit_rates(sites_qs, start_date, end_date).items()
         }
 
-        # fetch availability map
-        availability = utils.get_campsite_availability(sites_qs, start_date, end_date)
-        
+        # fetch availability matrix
+        matrix = build_availability_matrix(sites_qs, start_date, end_date)
+
         # create our result object, which will be returned as JSON
         result = {
             'id': ground.id,
@@ -1013,108 +1013,12 @@ class BaseAvailabilityViewSet(viewsets.ReadOnlyModelViewSet):
 
         # group results by campsite class
         if ground.site_type in (1, 2):
-            # from our campsite queryset, generate a distinct list of campsite classes
-            classes = [x for x in sites_qs.distinct('campsite_class__name').order_by('campsite_class__name').values_list('pk', 'campsite_class', 'campsite_class__name', 'tent', 'campervan', 'caravan')]
-
-            classes_map = {}
-            bookings_map = {}
-
-            # create a rough mapping of rates to campsite classes
-            # (it doesn't matter if this isn't a perfect match, the correct
-            # pricing will show up on the booking page)
-            rates_map = {}
-
-            class_sites_map = {}
-            for s in sites_qs:
-                if s.campsite_class.pk not in class_sites_map:
-                    class_sites_map[s.campsite_class.pk] = set()
-                    rates_map[s.campsite_class.pk] = rates[s.pk]
-
-                class_sites_map[s.campsite_class.pk].add(s.pk)
-
-
-            # make an entry under sites for each campsite class
-            for c in classes:
-                rate = rates_map[c[1]]
-                site = {
-                    'name': c[2],
-                    'id': None,
-                    'type': c[1],
-                    'price': '${}'.format(sum(rate.values())) if not show_all else False,
-                    'availability': [[True, '${}'.format(rate[start_date+timedelta(days=i)]), rate[start_date+timedelta(days=i)], [0, 0]] for i in range(length)],
-                    'breakdown': OrderedDict(),
-                    'gearType': {
-                        'tent': c[3],
-                        'campervan': c[4],
-                        'caravan': c[5]
-                    }
-                }
-                result['sites'].append(site)
-                classes_map[c[1]] = site
-
-            # make a map of class IDs to site IDs
-            for s in sites_qs:
-                rate = rates_map[s.campsite_class.pk]
-                classes_map[s.campsite_class.pk]['breakdown'][s.name] = [[True, '${}'.format(rate[start_date+timedelta(days=i)]), rate[start_date+timedelta(days=i)]] for i in range(length)]
-
-            # store number of campsites in each class
-            class_sizes = {k: len(v) for k, v in class_sites_map.items()}
-
-            # update results based on availability map
-            for s in sites_qs:
-                # get campsite class key
-                key = s.campsite_class.pk
-                # if there's not a free run of slots
-                if (not all([v[0] == 'open' for k, v in availability[s.pk].items()])) or show_all:
-                    # clear the campsite from the campsite class map
-                    if s.pk in class_sites_map[key]:
-                        class_sites_map[key].remove(s.pk)
-
-                    # update the days that are non-open
-                    for offset, stat in [((k-start_date).days, v[0]) for k, v in availability[s.pk].items() if v[0] != 'open']:
-                        # update the per-site availability
-                        classes_map[key]['breakdown'][s.name][offset][0] = False
-                        classes_map[key]['breakdown'][s.name][offset][1] = 'Booked' if (stat == 'booked') else 'Unavailable'
-
-                        # update the class availability status
-                        book_offset = 0 if (stat == 'booked') else 1
-                        classes_map[key]['availability'][offset][3][book_offset] += 1
-                        if classes_map[key]['availability'][offset][3][0] == class_sizes[key]:
-                            classes_map[key]['availability'][offset][1] = 'Fully Booked'
-                        elif classes_map[key]['availability'][offset][3][1] == class_sizes[key]:
-                            classes_map[key]['availability'][offset][1] = 'Unavailable'
-                        elif classes_map[key]['availability'][offset][3][0] >= classes_map[key]['availability'][offset][3][1]:
-                            classes_map[key]['availability'][offset][1] = 'Partially Booked'
-                        else:
-                            classes_map[key]['availability'][offset][1] = 'Partially Unavailable'
-
-                        # tentatively flag campsite class as unavailable
-                        classes_map[key]['availability'][offset][0] = False
-                        classes_map[key]['price'] = False
-
-            # convert breakdowns to a flat list
-            for klass in classes_map.values():
-                klass['breakdown'] = [{'name': k, 'availability': v} for k, v in klass['breakdown'].items()]
-
-            # any campsites remaining in the class sites map have zero bookings!
-            # check if there's any left for each class, and if so return that as the target
-            for k, v in class_sites_map.items():
-                if v:
-                    rate = rates_map[k]
-                    # if the number of sites is less than the warning limit, add a notification
-                    if len(v) <= settings.PS_CAMPSITE_COUNT_WARNING:
-                        classes_map[k].update({
-                            'warning': 'Only {} left!'.format(len(v))
-                        })
-
-                    classes_map[k].update({
-                        'id': v.pop(),
-                        'price': '${}'.format(sum(rate.values())),
-                        'availability': [[True, '${}'.format(rate[start_date+timedelta(days=i)]), rate[start_date+timedelta(days=i)], [0, 0]] for i in range(length)],
-                        'breakdown': []
-                    })
-
-
+            sites = list(sites_qs.order_by('name').values_list(
+                'pk', 'name', 'campsite_class', 'campsite_class__name', 'tent', 'campervan', 'caravan'
+            ))
+            dates = matrix.dates
+            rate_rows = {pk: [rates[pk][d] for d in dates] for pk in rates}
+            result['sites'] = class_availability(sites, matrix, rate_rows, show_all=show_all)
             return Response(result)
 
 
@@ -1148,6 +1052,7 @@ class BaseAvailabilityViewSet(viewsets.ReadOnlyModelViewSet):
 
 
             # update results based on availability map
+            availability = matrix.as_dict()
             for s in sites_qs:
                 # if there's not a free run of slots
                 if (not all([v[0] == 'open' for k, v in availability[s.pk].items()])) or show_all:
@@ -1165,9 +1070,11 @@ class BaseAvailabilityViewSet(viewsets.ReadOnlyModelViewSet):
 
             return Response(result)
 
+@method_decorator(generation_condition(AVAILABILITY_MODELS, _availability_parts), name='dispatch')
 class AvailabilityViewSet(BaseAvailabilityViewSet):
     permission_classes = []
 
+@method_decorator(generation_condition(AVAILABILITY_MODELS, _availability_parts), name='dispatch')
 class AvailabilityRatisViewSet(BaseAvailabilityViewSet):
     permission_classes = []
     lookup_field = 'ratis_id'
@@ -1301,13 +1208,11 @@ class ParkViewSet(viewsets.ModelViewSet):
     queryset = Park.objects.all()
     serializer_class = ParkSerializer
 
+    @method_decorator(generation_condition(PAYLOAD_MODELS, _site_and_day))
     def list(self, request, *args, **kwargs):
-        data = cache.get('parks')
-        if data is None:
-            queryset = self.get_queryset()
-            serializer = self.get_serializer(queryset, many=True)
-            data = serializer.data
-            cache.set('parks',data,3600)
+        data = cached_payload('parks', PAYLOAD_MODELS,
+            lambda: list(self.get_serializer(self.get_queryset(), many=True).data),
+            parts=(request.build_absolute_uri('/'), date.today()))
         return Response(data)
 
     @list_route(methods=['get'])
@@ -1600,17 +1505,23 @@ class BookingViewSet(viewsets.ModelViewSet):
             # Remove temporary bookings
             sql += ' and parkstay_booking.booking_type <> 3'
             sqlCount += ' and parkstay_booking.booking_type <> 3'
+            # Filter cancelled bookings on their stored refund status
+            # bookings from before the stored summary are filled in by manage.py update_booking_summaries
+            if refund_status and canceled == 't' and refund_status != 'All':
+                sqlRefund = ' parkstay_booking.summary_refund_status = %(refund_status)s'
+                sql += ' and ' + sqlRefund
+                sqlCount += ' and ' + sqlRefund
+                sqlParams['refund_status'] = refund_status
             if search:
-                sqlsearch = ' lower(parkstay_campground.name) LIKE lower(%(wildSearch)s)\
-                or lower(parkstay_region.name) LIKE lower(%(wildSearch)s)\
-                or lower(parkstay_booking.details->>\'first_name\') LIKE lower(%(wildSearch)s)\
-                or lower(parkstay_booking.details->>\'last_name\') LIKE lower(%(wildSearch)s)\
-                or lower(parkstay_booking.legacy_name) LIKE lower(%(wildSearch)s)\
-                or lower(parkstay_booking.legacy_name) LIKE lower(%(wildSearch)s)'
+                # search_text is trigram indexed, see Booking.refresh_search_text
+                search = search.strip().lower()
+                sqlsearch = ' parkstay_booking.search_text LIKE %(wildSearch)s'
                 sqlParams['wildSearch'] = '%{}%'.format(search)
-                if search.isdigit:
-                    sqlsearch += ' or CAST (parkstay_booking.id as TEXT) like %(upperSearch)s'
-                    sqlParams['upperSearch'] = '{}%'.format(search)
+                # confirmation numbers match on their prefix, through the id text index
+                confirmation = search[2:] if search.startswith('ps') else search
+                if confirmation.isdigit():
+                    sqlsearch += ' or CAST(parkstay_booking.id AS text) LIKE %(confirmationSearch)s'
+                    sqlParams['confirmationSearch'] = '{}%'.format(confirmation)
 
                 sql += " and ( "+ sqlsearch +" )"
                 sqlCount +=  " and  ( "+ sqlsearch +" )"
@@ -1626,10 +1537,10 @@ class BookingViewSet(viewsets.ModelViewSet):
             #print(sql)
 
             cursor = connection.cursor()
-            cursor.execute("Select count(*) from parkstay_booking ");
-            recordsTotal = cursor.fetchone()[0]
             cursor.execute(sqlCount, sqlParams);
             recordsFiltered = cursor.fetchone()[0]
+            cursor.execute("Select count(*) from parkstay_booking ");
+            recordsTotal = cursor.fetchone()[0]
 
             cursor.execute(sql, sqlParams)
             columns = [col[0] for col in cursor.description]
@@ -1637,20 +1548,36 @@ class BookingViewSet(viewsets.ModelViewSet):
                 dict(zip(columns, row))
                 for row in cursor.fetchall()
             ]
-            bookings_qs = Booking.objects.filter(id__in=[b['id'] for b in data]).prefetch_related('campground', 'campsites', 'campsites__campsite', 'customer', 'regos', 'history', 'invoices', 'canceled_by')
+            bookings_qs = Booking.objects.filter(id__in=[b['id'] for b in data]).select_related(
+                'campground__park', 'customer', 'canceled_by'
+            ).prefetch_related('campsites__campsite', 'regos', 'invoices').annotate(history_count=Count('history'))
             booking_map = {b.id: b for b in bookings_qs}
+            # Fetch the invoices and the park entry lines of the active invoices in bulk
+            references = [i.invoice_reference for b in booking_map.values() for i in b.invoices.all()]
+            invoice_map = {i.reference: i for i in Invoice.objects.filter(reference__in=references)}
+            active_invoices = {}
+            for booking in booking_map.values():
+                invoices = [invoice_map[i.invoice_reference] for i in booking.invoices.all() if i.invoice_reference in invoice_map]
+                active_invoices[booking.id] = max(invoices, key=lambda i: i.created) if invoices else None
+            order_lines = {}
+            for line in Line.objects.filter(order__number__in=[i.order_number for i in active_invoices.values() if i]).select_related('order').prefetch_related('allocations'):
+                order_lines.setdefault(line.order.number, []).append(line)
             clean_data = []
             for bk in data:
                 cg = None
                 booking = booking_map[bk['id']]
                 cg = booking.campground
+                active_invoice = active_invoices[booking.id]
+                campsites = sorted(booking.campsites.all(), key=lambda c: c.pk)
                 bk['editable'] = booking.editable
                 bk['status'] = booking.status
                 bk['booking_type'] = booking.booking_type
-                bk['has_history'] = booking.has_history
+                bk['has_history'] = booking.history_count > 0
                 bk['cost_total'] = booking.cost_total
                 bk['amount_paid'] = booking.amount_paid
-                bk['vehicle_payment_status'] = booking.vehicle_payment_status
+                bk['vehicle_payment_status'] = booking.get_vehicle_payment_status(active_invoice, [
+                    l for l in order_lines.get(active_invoice.order_number, []) if l.oracle_code == cg.park.oracle_code
+                ] if active_invoice else [])
                 bk['refund_status'] = booking.refund_status
                 bk['is_canceled'] = 'Yes' if booking.is_canceled else 'No'
                 bk['cancelation_reason'] = booking.cancellation_reason
@@ -1658,9 +1585,9 @@ class BookingViewSet(viewsets.ModelViewSet):
                 bk['cancelation_time'] = booking.cancelation_time if booking.cancelation_time else ''
                 bk['paid'] = booking.paid
                 bk['invoices'] = [ i.invoice_reference for i in booking.invoices.all()]
-                bk['active_invoices'] = [ i.invoice_reference for i in booking.invoices.all() if i.active]
+                bk['active_invoices'] = [ i.invoice_reference for i in booking.invoices.all() if i.invoice_reference in invoice_map and not invoice_map[i.invoice_reference].voided]
                 bk['guests'] = booking.guests
-                bk['campsite_names'] = booking.campsite_name_list
+                bk['campsite_names'] = list(set(c.campsite.name for c in campsites))
                 bk['regos'] = [{r.type: r.rego} for r in booking.regos.all()]
                 bk['firstname'] = booking.details.get('first_name','')
                 bk['lastname'] = booking.details.get('last_name','')
@@ -1677,22 +1604,13 @@ class BookingViewSet(viewsets.ModelViewSet):
                     if booking.is_canceled:
                         bk['campground_site_type'] = ""
                     else:
-                        first_campsite = booking.first_campsite
+                        first_campsite = campsites[0].campsite if campsites else None
                         bk['campground_site_type'] = first_campsite.type if first_campsite else ""
                         if booking.campground.site_type != 2:
                             bk['campground_site_type'] = '{}{}'.format('{} - '.format(first_campsite.name if first_campsite else ""),'({})'.format(bk['campground_site_type'] if bk['campground_site_type'] else ""))
                 else:
                     bk['campground_site_type'] = ""
-                if refund_status and canceled == 't':
-                    refund_statuses = ['All','Partially Refunded','Not Refunded','Refunded']
-                    if refund_status in refund_statuses:
-                        if refund_status == 'All':
-                            clean_data.append(bk)
-                        else:       
-                            if refund_status == booking.refund_status:
-                                clean_data.append(bk)
-                else:
-                    clean_data.append(bk)
+                clean_data.append(bk)
             
             return Response(OrderedDict([
                 ('recordsTotal', recordsTotal),
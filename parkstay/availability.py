@@ -0,0 +1,520 @@
+from __future__ import unicode_literals
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q, Min
+
+from parkstay.caching import bump_generation
+from parkstay.models import (Campground, Campsite, CampsiteAvailability, CampsiteBooking, CampgroundBookingRange,
+                             CampsiteBookingRange, CampgroundStayHistory)
+
+# Availability status codes, one byte per campsite per day
+OPEN = 0
+CLOSED = 1
+BOOKED = 2
+TOOEARLY = 3
+TOOFAR = 4
+
+STATUS_NAMES = ('open', 'closed', 'booked', 'tooearly', 'toofar')
+
+
+def closure_filter(start_date, end_date):
+    '''Closed booking ranges overlapping a range of visit dates
+    '''
+    return Q(status=1) & Q(range_start__lt=end_date) & (Q(range_end__gte=start_date) | Q(range_end__isnull=True))
+
+
+def stay_history_filter(start_date, end_date, today):
+    '''Stay history periods that apply to a range of visit dates
+    '''
+    return (
+        Q(range_start__lte=start_date, range_end__gte=start_date) |  # filter start date is within period
+        Q(range_start__lte=end_date, range_end__gte=end_date) |  # filter end date is within period
+        Q(Q(range_start__gt=start_date, range_end__lt=end_date) & Q(range_end__gt=today))  # filter start date is before and end date after period
+    )
+
+
+def campground_max_stays(campground_ids, start_date, end_date, today=None):
+    '''Maximum stay length for each of a set of campgrounds over a range of visit dates
+    '''
+    today = today or date.today()
+    max_stays = dict.fromkeys(campground_ids, settings.PS_MAX_BOOKING_LENGTH)
+    stay_history = CampgroundStayHistory.objects.filter(
+        stay_history_filter(start_date, end_date, today),
+        campground__in=max_stays.keys()
+    ).order_by().values('campground').annotate(Min('max_days')).values_list('campground', 'max_days__min')
+    max_stays.update(stay_history)
+    return max_stays
+
+
+class AvailabilityMatrix(object):
+    """Availability of a set of campsites over a range of visit dates.
+
+    Each campsite has a bytearray row indexed by day offset from start_date,
+    holding one of the status codes above. Closures, bookings and booking
+    window limits are applied as slice writes over those rows.
+    """
+
+    def __init__(self, site_ids, start_date, end_date):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.duration = max(0, (end_date - start_date).days)
+        self.rows = OrderedDict((pk, bytearray(self.duration)) for pk in site_ids)
+
+    @property
+    def site_ids(self):
+        return list(self.rows.keys())
+
+    @property
+    def dates(self):
+        return [self.start_date + timedelta(days=i) for i in range(self.duration)]
+
+    def offset(self, day):
+        return (day - self.start_date).days
+
+    def mark(self, site_id, start, end, status):
+        '''Set the status of a site over the day offsets [start, end)
+        '''
+        start, end = max(0, start), min(self.duration, end)
+        if start < end:
+            self.rows[site_id][start:end] = bytearray([status]) * (end - start)
+
+    def mark_sites(self, site_ids, start, end, status):
+        for pk in site_ids:
+            self.mark(pk, start, end, status)
+
+    def mark_all(self, start, end, status):
+        self.mark_sites(self.rows.keys(), start, end, status)
+
+    def status(self, site_id, day):
+        return STATUS_NAMES[self.rows[site_id][self.offset(day)]]
+
+    def is_clear(self, site_id, allowed=(OPEN,)):
+        '''Check if every day for a site has one of the allowed statuses
+        '''
+        return set(self.rows[site_id]) <= set(allowed)
+
+    def clear_sites(self, allowed=(OPEN,)):
+        return [pk for pk in self.rows if self.is_clear(pk, allowed)]
+
+    def as_dict(self):
+        '''Render in the {site: {date: [status]}} shape of get_campsite_availability
+        '''
+        dates = self.dates
+        return {
+            pk: {d: [STATUS_NAMES[v]] for d, v in zip(dates, row)}
+            for pk, row in self.rows.items()
+        }
+
+
+def _closure_offsets(matrix, closure):
+    '''Day offsets [first, last) covered by a closure range (inclusive of range_end)
+    '''
+    start = max(matrix.start_date, closure.range_start)
+    end = min(matrix.end_date, closure.range_end) if closure.range_end else matrix.end_date
+    return matrix.offset(start), matrix.offset(end) + 1
+
+
+def _mark_closure(matrix, site_ids, closure, target, today):
+    '''Strike out a closure range for a group of sites.
+
+    A closure covering today only applies if the closed object is not
+    currently open, as it may have been reopened by a later range.
+    '''
+    first, last = _closure_offsets(matrix, closure)
+    today_offset = matrix.offset(today)
+    if first <= today_offset < min(last, matrix.duration):
+        matrix.mark_sites(site_ids, first, today_offset, CLOSED)
+        matrix.mark_sites(site_ids, today_offset + 1, last, CLOSED)
+        if not target._is_open(today):
+            matrix.mark_sites(site_ids, today_offset, today_offset + 1, CLOSED)
+    else:
+        matrix.mark_sites(site_ids, first, last, CLOSED)
+
+
+def _apply_live(matrix, campground_map, start_date, end_date, today):
+    '''Strike out bookings and closures from the booking and booking range tables
+    '''
+    bookings_qs = CampsiteBooking.objects.filter(
+        campsite__in=matrix.site_ids,
+        date__gte=start_date,
+        date__lt=end_date
+    ).values_list('campsite_id', 'date', 'booking_type')
+    for site_id, day, booking_type in bookings_qs:
+        offset = matrix.offset(day)
+        matrix.mark(site_id, offset, offset + 1, CLOSED if booking_type == 2 else BOOKED)
+
+    # strike out whole campground closures
+    cgbr_qs = CampgroundBookingRange.objects.filter(
+        closure_filter(start_date, end_date),
+        campground__in=list(campground_map.keys())
+    ).select_related('campground')
+    for closure in cgbr_qs:
+        _mark_closure(matrix, campground_map[closure.campground_id][1], closure, closure.campground, today)
+
+    # strike out campsite closures
+    csbr_qs = CampsiteBookingRange.objects.filter(
+        closure_filter(start_date, end_date),
+        campsite__in=matrix.site_ids
+    ).select_related('campsite')
+    for closure in csbr_qs:
+        _mark_closure(matrix, [closure.campsite_id], closure, closure.campsite, today)
+
+
+def _apply_materialized(matrix, campground_map, start_date, end_date, today):
+    '''Strike out bookings and closures with a single range scan of CampsiteAvailability
+    '''
+    site_campgrounds = {pk: cg for cg, (_, site_ids) in campground_map.items() for pk in site_ids}
+    reopened = {}
+
+    def is_open_today(model, pk):
+        if (model, pk) not in reopened:
+            reopened[(model, pk)] = model.objects.get(pk=pk)._is_open(today)
+        return reopened[(model, pk)]
+
+    days_qs = CampsiteAvailability.objects.filter(
+        campsite__in=matrix.site_ids,
+        date__gte=start_date,
+        date__lt=end_date
+    ).values_list('campsite_id', 'date', 'booking_type', 'campsite_closed', 'campground_closed')
+    for site_id, day, booking_type, campsite_closed, campground_closed in days_qs:
+        status = OPEN
+        if booking_type is not None:
+            status = CLOSED if booking_type == 2 else BOOKED
+        if day == today:
+            # a closure covering today only applies if it hasn't been reopened
+            if campground_closed and not is_open_today(Campground, site_campgrounds[site_id]):
+                status = CLOSED
+            elif campsite_closed and not is_open_today(Campsite, site_id):
+                status = CLOSED
+        elif campsite_closed or campground_closed:
+            status = CLOSED
+        if status != OPEN:
+            offset = matrix.offset(day)
+            matrix.mark(site_id, offset, offset + 1, status)
+
+
+def build_availability_matrix(campsites_qs, start_date, end_date):
+    """Build an AvailabilityMatrix for each campsite in a queryset over a range of visit dates."""
+    sites = list(campsites_qs.values_list('pk', 'campground_id', 'campground__max_advance_booking', 'campground__availability_until'))
+    matrix = AvailabilityMatrix([s[0] for s in sites], start_date, end_date)
+    if not sites:
+        return matrix
+    today = date.today()
+
+    campground_map = OrderedDict()
+    for pk, campground_id, max_advance_booking, _ in sites:
+        if campground_id not in campground_map:
+            campground_map[campground_id] = (max_advance_booking, [])
+        campground_map[campground_id][1].append(pk)
+
+    # use the materialized days if they cover the last night of the stay
+    last_night = end_date - timedelta(days=1)
+    if all(s[3] is not None and s[3] >= last_night for s in sites):
+        _apply_materialized(matrix, campground_map, start_date, end_date, today)
+    else:
+        _apply_live(matrix, campground_map, start_date, end_date, today)
+
+    # strike out days before today
+    if start_date < today:
+        matrix.mark_all(0, matrix.offset(min(today, end_date)), TOOEARLY)
+
+    # strike out days after the max_advance_booking
+    for max_advance_booking, site_ids in campground_map.values():
+        stop = today + timedelta(days=max_advance_booking)
+        if start_date > stop:
+            stop_mark = min(max(stop, start_date), end_date)
+            matrix.mark_sites(site_ids, matrix.offset(stop_mark), matrix.duration, TOOFAR)
+
+    # get the current stay history for the campground of the first site
+    first_site = sites[0] if campsites_qs.ordered else min(sites)
+    max_days = CampgroundStayHistory.objects.filter(
+        stay_history_filter(start_date, end_date, today),
+        campground=first_site[1]
+    ).aggregate(Min('max_days'))['max_days__min']
+    if max_days is None:
+        max_days = settings.PS_MAX_BOOKING_LENGTH
+
+    # strike out days after the max_stay period
+    stop = start_date + timedelta(days=max_days)
+    stop_mark = min(max(stop, start_date), end_date)
+    matrix.mark_all(matrix.offset(stop_mark), matrix.duration, TOOFAR)
+
+    return matrix
+
+
+_OPEN_DAY = bytearray([OPEN])
+
+
+def _class_day_label(booked, unavailable, size):
+    if booked == size:
+        return 'Fully Booked'
+    elif unavailable == size:
+        return 'Unavailable'
+    elif booked >= unavailable:
+        return 'Partially Booked'
+    return 'Partially Unavailable'
+
+
+def class_availability(sites, matrix, rates, show_all=False):
+    '''Availability of each campsite class, as the site entries of the class grouped
+    availability response
+
+    sites holds (pk, name, class id, class name, tent, campervan, caravan) for each
+    campsite in display order, matrix is their AvailabilityMatrix and rates maps each
+    campsite to its list of nightly prices. Each class takes its prices and gear from
+    its first campsite. A class with a campsite free for the whole stay is offered as
+    that campsite, otherwise its nights are summed up from per-day counts of booked
+    and unavailable campsites.
+    '''
+    length = matrix.duration
+    classes = OrderedDict()
+    for site in sites:
+        classes.setdefault(site[2], []).append(site)
+
+    result = []
+    for class_id, members in sorted(classes.items(), key=lambda c: c[1][0][3]):
+        first = members[0]
+        rate = rates[first[0]]
+        prices = ['${}'.format(r) for r in rate[:length]]
+        rows = [matrix.rows[s[0]] for s in members]
+        free = [s[0] for s, row in zip(members, rows) if row.count(_OPEN_DAY) == length]
+        entry = {
+            'name': first[3],
+            'id': None,
+            'type': class_id,
+            'gearType': {
+                'tent': first[4],
+                'campervan': first[5],
+                'caravan': first[6]
+            }
+        }
+        result.append(entry)
+
+        if free and not show_all:
+            if len(free) <= settings.PS_CAMPSITE_COUNT_WARNING:
+                entry['warning'] = 'Only {} left!'.format(len(free))
+            entry.update({
+                'id': free[0],
+                'price': '${}'.format(sum(rate[:length])),
+                'availability': [[True, prices[i], rate[i], [0, 0]] for i in range(length)],
+                'breakdown': []
+            })
+            continue
+
+        # count booked and otherwise unavailable campsites per day
+        size = len(rows)
+        opened = [day.count(OPEN) for day in zip(*rows)]
+        booked = [day.count(BOOKED) for day in zip(*rows)]
+        availability = []
+        for i in range(length):
+            unavailable = size - opened[i] - booked[i]
+            if opened[i] == size:
+                availability.append([True, prices[i], rate[i], [0, 0]])
+            else:
+                availability.append([False, _class_day_label(booked[i], unavailable, size), rate[i], [booked[i], unavailable]])
+
+        breakdown = []
+        for site, row in zip(members, rows):
+            breakdown.append({'name': site[1], 'availability': [
+                [True, prices[i], rate[i]] if status == OPEN else
+                [False, 'Booked' if status == BOOKED else 'Unavailable', rate[i]]
+                for i, status in enumerate(row)
+            ]})
+        entry.update({
+            'price': False,
+            'availability': availability,
+            'breakdown': breakdown
+        })
+    return result
+
+
+# MATERIALIZED AVAILABILITY
+# =====================================
+_deferred = threading.local()
+
+
+def _days_filter(keys):
+    by_site = {}
+    for site_id, day in keys:
+        by_site.setdefault(site_id, set()).add(day)
+    q = Q()
+    for site_id, days in by_site.items():
+        q |= Q(campsite_id=site_id, date__in=list(days))
+    return q
+
+
+def _prune(*args, **kwargs):
+    '''Drop materialized days that have become open again
+    '''
+    CampsiteAvailability.objects.filter(
+        *args, booking_type__isnull=True, campsite_closed=False, campground_closed=False, **kwargs
+    ).delete()
+
+
+def _create_days(days, **defaults):
+    '''Insert new materialized days, falling back to per-row upserts if a
+    concurrent writer got to any of them first
+    '''
+    if not days:
+        return
+    try:
+        with transaction.atomic():
+            CampsiteAvailability.objects.bulk_create(days, batch_size=1000)
+    except IntegrityError:
+        for d in days:
+            CampsiteAvailability.objects.update_or_create(
+                campsite_id=d.campsite_id, date=d.date,
+                defaults={f: getattr(d, f) for f in defaults}
+            )
+
+
+def refresh_booking_days(keys):
+    '''Recompute the booking status of materialized days from CampsiteBooking.
+
+    keys is an iterable of (campsite_id, date) pairs.
+    '''
+    keys = set(keys)
+    if not keys:
+        return
+    days_q = _days_filter(keys)
+    booked = {(s, d): t for s, d, t in CampsiteBooking.objects.filter(days_q).values_list('campsite_id', 'date', 'booking_type')}
+    existing = {(s, d): (pk, t) for pk, s, d, t in CampsiteAvailability.objects.filter(days_q).values_list('pk', 'campsite_id', 'date', 'booking_type')}
+
+    created, updates = [], {}
+    for key in keys:
+        booking_type = booked.get(key)
+        if key in existing:
+            pk, current = existing[key]
+            if current != booking_type:
+                updates.setdefault(booking_type, []).append(pk)
+        elif booking_type is not None:
+            created.append(CampsiteAvailability(campsite_id=key[0], date=key[1], booking_type=booking_type))
+
+    for booking_type, pks in updates.items():
+        CampsiteAvailability.objects.filter(pk__in=pks).update(booking_type=booking_type)
+    _create_days(created, booking_type=None)
+    _prune(days_q)
+
+
+def refresh_closure_days(campground_id, campsite_ids=None):
+    '''Recompute the closure flags of materialized days for the sites of a campground.
+
+    Closures are only materialized from today up to the campground's
+    availability_until; campgrounds that haven't been built yet are skipped.
+    '''
+    until = Campground.objects.filter(pk=campground_id).values_list('availability_until', flat=True).first()
+    today = date.today()
+    if until is None or until < today:
+        return
+    end = until + timedelta(days=1)
+    sites_qs = Campsite.objects.filter(campground_id=campground_id)
+    if campsite_ids is not None:
+        sites_qs = sites_qs.filter(pk__in=campsite_ids)
+    site_ids = list(sites_qs.values_list('pk', flat=True))
+    if not site_ids:
+        return
+
+    campground_closed = AvailabilityMatrix(site_ids, today, end)
+    for closure in CampgroundBookingRange.objects.filter(closure_filter(today, end), campground=campground_id):
+        first, last = _closure_offsets(campground_closed, closure)
+        campground_closed.mark_all(first, last, CLOSED)
+    campsite_closed = AvailabilityMatrix(site_ids, today, end)
+    for closure in CampsiteBookingRange.objects.filter(closure_filter(today, end), campsite__in=site_ids):
+        first, last = _closure_offsets(campsite_closed, closure)
+        campsite_closed.mark(closure.campsite_id, first, last, CLOSED)
+
+    existing = {
+        (s, d): (pk, cs, cg) for pk, s, d, cs, cg in CampsiteAvailability.objects.filter(
+            campsite__in=site_ids, date__gte=today, date__lt=end
+        ).values_list('pk', 'campsite_id', 'date', 'campsite_closed', 'campground_closed')
+    }
+    dates = campground_closed.dates
+    created, updates = [], {}
+    for site_id in site_ids:
+        cs_row, cg_row = campsite_closed.rows[site_id], campground_closed.rows[site_id]
+        for i, day in enumerate(dates):
+            flags = (bool(cs_row[i]), bool(cg_row[i]))
+            if (site_id, day) in existing:
+                pk, cs, cg = existing[(site_id, day)]
+                if (cs, cg) != flags:
+                    updates.setdefault(flags, []).append(pk)
+            elif any(flags):
+                created.append(CampsiteAvailability(campsite_id=site_id, date=day, campsite_closed=flags[0], campground_closed=flags[1]))
+
+    for (cs, cg), pks in updates.items():
+        CampsiteAvailability.objects.filter(pk__in=pks).update(campsite_closed=cs, campground_closed=cg)
+    _create_days(created, campsite_closed=False, campground_closed=False)
+    _prune(campsite__in=site_ids, date__gte=today, date__lt=end)
+
+
+def rebuild_campground_availability(campground):
+    '''Rebuild the materialized days for a campground and roll its horizon forward
+    to cover any stay that can currently be booked.
+    '''
+    today = date.today()
+    until = today + timedelta(days=campground.max_advance_booking + settings.PS_MAX_BOOKING_LENGTH)
+    with transaction.atomic():
+        site_ids = list(campground.campsites.values_list('pk', flat=True))
+        CampsiteAvailability.objects.filter(campsite__in=site_ids).delete()
+        refresh_booking_days(CampsiteBooking.objects.filter(campsite__in=site_ids, date__gte=today).values_list('campsite_id', 'date'))
+        Campground.objects.filter(pk=campground.pk).update(availability_until=until)
+        refresh_closure_days(campground.pk)
+    campground.availability_until = until
+
+
+def booking_changed(campsite_id, day):
+    '''Record a CampsiteBooking change, refreshing the materialized day now
+    or at the end of the enclosing deferred_refresh block
+    '''
+    keys = getattr(_deferred, 'keys', None)
+    if keys is not None:
+        keys.add((campsite_id, day))
+    else:
+        refresh_booking_days([(campsite_id, day)])
+
+
+def reserve_campsite(campsite_id, booking, start_date, end_date, booking_type=3):
+    '''Insert a CampsiteBooking for each night of a stay in a single statement.
+
+    The (campsite, date) unique constraint detects a conflicting booking, in
+    which case nothing is inserted and False is returned.
+    '''
+    nights = [start_date + timedelta(days=i) for i in range((end_date - start_date).days)]
+    try:
+        with transaction.atomic():
+            CampsiteBooking.objects.bulk_create([
+                CampsiteBooking(campsite_id=campsite_id, booking_type=booking_type, date=day, booking=booking)
+                for day in nights
+            ])
+    except IntegrityError:
+        return False
+
+    # bulk_create bypasses the CampsiteBooking listeners
+    bump_generation(CampsiteBooking)
+    with deferred_refresh():
+        for day in nights:
+            booking_changed(campsite_id, day)
+    return True
+
+
+@contextmanager
+def deferred_refresh():
+    '''Batch the materialized day refreshes for CampsiteBooking changes made
+    inside the block into a fixed number of queries on exit
+    '''
+    if getattr(_deferred, 'keys', None) is not None:
+        yield
+        return
+    _deferred.keys = set()
+    try:
+        yield
+        keys = _deferred.keys
+    finally:
+        _deferred.keys = None
+    refresh_booking_days(keys)
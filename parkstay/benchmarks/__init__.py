@@ -0,0 +1,6 @@
+"""Benchmarks for the parkstay booking paths.
+
+availability compares the class grouped availability builder with the loops it
+replaced, data generates a synthetic booking system and funnel times the booking
+funnel endpoints against it. See the management commands named benchmark_*.
+"""
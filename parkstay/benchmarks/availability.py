@@ -0,0 +1,178 @@
+"""Benchmark of the class grouped availability response builder.
+
+Runs the builder against a port of the per-campsite loops it replaced on
+synthetic campgrounds, checks both produce the same response and reports the
+time each takes.
+"""
+import random
+import timeit
+from collections import OrderedDict
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.conf import settings
+
+from parkstay.availability import AvailabilityMatrix, OPEN, CLOSED, BOOKED, class_availability
+
+SITE_COUNTS = (50, 200, 500)
+DAY_COUNTS = (7, 28, 90)
+CLASS_NAMES = ('Camper trailer', 'Campervan', 'Caravan', 'Tent')
+
+
+def synthetic_campground(num_sites, num_days, seed=0):
+    '''Campsites, availability and nightly rates for a made up campground
+
+    Returns (sites, matrix, rates) as taken by class_availability.
+    '''
+    rng = random.Random(seed)
+    start_date = date(2017, 1, 1)
+    sites = []
+    for pk in range(1, num_sites + 1):
+        class_id = pk % len(CLASS_NAMES) + 1
+        sites.append((pk, 'Site {:04d}'.format(pk), class_id, CLASS_NAMES[class_id - 1], True, class_id > 1, class_id > 2))
+    matrix = AvailabilityMatrix([s[0] for s in sites], start_date, start_date + timedelta(days=num_days))
+    # book out most sites for a few nights and close a block of them for a while
+    for pk in matrix.rows if num_days else ():
+        for _ in range(rng.randint(0, 3)):
+            start = rng.randrange(num_days)
+            matrix.mark(pk, start, start + rng.randint(1, 7), BOOKED)
+    closed = [s[0] for s in sites[:num_sites // 10]]
+    matrix.mark_sites(closed, num_days // 3, num_days // 2, CLOSED)
+    rates = {}
+    for pk, _, class_id, _, _, _, _ in sites:
+        weekday, weekend = Decimal('{}.00'.format(10 + class_id)), Decimal('{}.50'.format(15 + class_id))
+        rates[pk] = [weekend if d.weekday() >= 5 else weekday for d in matrix.dates]
+    return sites, matrix, rates
+
+
+def legacy_class_availability(sites, availability, rates, start_date, length, show_all=False):
+    '''The class grouping loops previously in BaseAvailabilityViewSet.retrieve
+
+    Takes the {site: {date: [status]}} and {site: {date: price}} maps those loops
+    read. A class is offered as its first free campsite rather than an arbitrary
+    one so the output can be compared.
+    '''
+    classes = OrderedDict()
+    for s in sorted(sites, key=lambda s: s[3]):
+        if s[3] not in classes:
+            classes[s[3]] = s
+    classes_map = {}
+    rates_map = {}
+    class_sites_map = OrderedDict()
+    result = []
+    for s in sites:
+        if s[2] not in class_sites_map:
+            class_sites_map[s[2]] = []
+            rates_map[s[2]] = rates[s[0]]
+        class_sites_map[s[2]].append(s[0])
+
+    for c in classes.values():
+        rate = rates_map[c[2]]
+        site = {
+            'name': c[3],
+            'id': None,
+            'type': c[2],
+            'price': '${}'.format(sum(rate.values())) if not show_all else False,
+            'availability': [[True, '${}'.format(rate[start_date+timedelta(days=i)]), rate[start_date+timedelta(days=i)], [0, 0]] for i in range(length)],
+            'breakdown': OrderedDict(),
+            'gearType': {
+                'tent': c[4],
+                'campervan': c[5],
+                'caravan': c[6]
+            }
+        }
+        result.append(site)
+        classes_map[c[2]] = site
+
+    for s in sites:
+        rate = rates_map[s[2]]
+        classes_map[s[2]]['breakdown'][s[1]] = [[True, '${}'.format(rate[start_date+timedelta(days=i)]), rate[start_date+timedelta(days=i)]] for i in range(length)]
+
+    class_sizes = {k: len(v) for k, v in class_sites_map.items()}
+
+    for s in sites:
+        key = s[2]
+        if (not all([v[0] == 'open' for k, v in availability[s[0]].items()])) or show_all:
+            if s[0] in class_sites_map[key]:
+                class_sites_map[key].remove(s[0])
+
+            for offset, stat in [((k-start_date).days, v[0]) for k, v in availability[s[0]].items() if v[0] != 'open']:
+                classes_map[key]['breakdown'][s[1]][offset][0] = False
+                classes_map[key]['breakdown'][s[1]][offset][1] = 'Booked' if (stat == 'booked') else 'Unavailable'
+
+                book_offset = 0 if (stat == 'booked') else 1
+                classes_map[key]['availability'][offset][3][book_offset] += 1
+                if classes_map[key]['availability'][offset][3][0] == class_sizes[key]:
+                    classes_map[key]['availability'][offset][1] = 'Fully Booked'
+                elif classes_map[key]['availability'][offset][3][1] == class_sizes[key]:
+                    classes_map[key]['availability'][offset][1] = 'Unavailable'
+                elif classes_map[key]['availability'][offset][3][0] >= classes_map[key]['availability'][offset][3][1]:
+                    classes_map[key]['availability'][offset][1] = 'Partially Booked'
+                else:
+                    classes_map[key]['availability'][offset][1] = 'Partially Unavailable'
+
+                classes_map[key]['availability'][offset][0] = False
+                classes_map[key]['price'] = False
+
+    for klass in classes_map.values():
+        klass['breakdown'] = [{'name': k, 'availability': v} for k, v in klass['breakdown'].items()]
+
+    for k, v in class_sites_map.items():
+        if v:
+            rate = rates_map[k]
+            if len(v) <= settings.PS_CAMPSITE_COUNT_WARNING:
+                classes_map[k].update({
+                    'warning': 'Only {} left!'.format(len(v))
+                })
+
+            classes_map[k].update({
+                'id': v[0],
+                'price': '${}'.format(sum(rate.values())),
+                'availability': [[True, '${}'.format(rate[start_date+timedelta(days=i)]), rate[start_date+timedelta(days=i)], [0, 0]] for i in range(length)],
+                'breakdown': []
+            })
+
+    return result
+
+
+def legacy_inputs(matrix, rates):
+    '''Convert the matrix and rate rows to the maps the legacy loops read
+    '''
+    dates = matrix.dates
+    return matrix.as_dict(), {pk: dict(zip(dates, row)) for pk, row in rates.items()}
+
+
+def compare(sites, matrix, rates, show_all=False):
+    availability, rate_map = legacy_inputs(matrix, rates)
+    legacy = legacy_class_availability(sites, availability, rate_map, matrix.start_date, matrix.duration, show_all)
+    return legacy == class_availability(sites, matrix, rates, show_all)
+
+
+def _best(func, repeat, number):
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def run(site_counts=SITE_COUNTS, day_counts=DAY_COUNTS, repeat=5, number=3, out=None):
+    '''Time both builders over each campground size and stay length, for the public
+    view and for the admin view which breaks every class down by campsite
+
+    Returns a list of (sites, days, matches, legacy seconds, builder seconds,
+    legacy admin seconds, builder admin seconds).
+    '''
+    results = []
+    for num_sites in site_counts:
+        for num_days in day_counts:
+            sites, matrix, rates = synthetic_campground(num_sites, num_days)
+            matches = compare(sites, matrix, rates) and compare(sites, matrix, rates, show_all=True)
+            availability, rate_map = legacy_inputs(matrix, rates)
+            timings = []
+            for show_all in (False, True):
+                timings.append(_best(lambda: legacy_class_availability(
+                    sites, availability, rate_map, matrix.start_date, matrix.duration, show_all), repeat, number))
+                timings.append(_best(lambda: class_availability(sites, matrix, rates, show_all), repeat, number))
+            results.append((num_sites, num_days, matches) + tuple(timings))
+            if out:
+                out.write('{:>5} sites {:>3} days  {:<8} legacy {:8.2f}ms  builder {:8.2f}ms  '
+                          'admin legacy {:8.2f}ms  builder {:8.2f}ms\n'.format(
+                              num_sites, num_days, 'same' if matches else 'DIFFERS', *[t * 1000 for t in timings]))
+    return results
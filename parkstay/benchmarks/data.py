@@ -0,0 +1,222 @@
+"""Synthetic parkstay data for the booking funnel benchmark.
+
+Everything generated is named with BENCHMARK_PREFIX so it can be told apart
+from real data and removed again with flush().
+"""
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import Group
+from django.contrib.gis.geos import Point
+from django.db import transaction
+from django.db.models import F
+
+from ledger.accounts.models import EmailUser
+from ledger.payments.cash.models import CashTransaction
+from ledger.payments.models import Invoice
+from parkstay.availability import rebuild_campground_availability
+from parkstay.caching import bump_generation
+from parkstay.helpers import invalidate_campground_permissions
+from parkstay.models import (Region, District, Park, Campground, CampsiteClass, Campsite, Rate, CampsiteRate,
+                             PriceReason, ClosureReason, CampgroundBookingRange, CampsiteBookingRange, Booking,
+                             BookingInvoice, CampsiteBooking, PAYLOAD_MODELS, MAP_MODELS, SUGGEST_MODELS,
+                             AVAILABILITY_MODELS)
+
+BENCHMARK_PREFIX = 'Benchmark'
+BENCHMARK_DOMAIN = 'benchmark.invalid'
+OFFICER_EMAIL = 'officer@{}'.format(BENCHMARK_DOMAIN)
+CLASS_NAMES = ('Tent', 'Campervan', 'Caravan', 'Camper trailer')
+CHUNK_SIZE = 5000
+
+
+def _name(*parts):
+    return ' '.join((BENCHMARK_PREFIX,) + tuple(str(p) for p in parts))
+
+
+def _bulk_create(model, objs):
+    return model.objects.bulk_create(objs, batch_size=CHUNK_SIZE)
+
+
+def generate(regions=3, parks=4, campgrounds=5, campsites=40, customers=500, days=365, occupancy=0.5, seed=0, start=None, out=None):
+    '''Generate a synthetic booking system
+
+    Creates regions with one district each, parks per region, campgrounds per park and
+    campsites per campground, alternating per-site and per-class campgrounds. Every
+    campsite gets a rate, a tenth of the campsites and one campground in ten get a
+    closure, and the campsites are booked out to roughly the given occupancy over
+    days from start (default today). Each booking gets an invoice, four in five of
+    them paid in cash. Returns a dict of the number of rows created per model.
+    '''
+    rng = random.Random(seed)
+    start = start or date.today()
+    end = start + timedelta(days=days)
+    counts = {}
+
+    def log(message):
+        if out:
+            out.write(message + '\n')
+
+    with transaction.atomic():
+        price_reason = PriceReason.objects.get_or_create(text=_name('pricing'))[0]
+        closure_reason = ClosureReason.objects.get_or_create(text=_name('closure'))[0]
+        classes = [CampsiteClass.objects.get_or_create(name=_name(n), defaults={
+            'tent': i == 0, 'campervan': i in (1, 3), 'caravan': i >= 2
+        })[0] for i, n in enumerate(CLASS_NAMES)]
+        rates = [Rate.objects.get_or_create(adult=Decimal(a), concession=(Decimal(a) * Decimal('0.66')).quantize(Decimal('0.01')),
+                                            child=Decimal('2.20'), infant=Decimal('0'))[0]
+                 for a in ('7.50', '10.00', '12.50', '15.00')]
+        officer = EmailUser.objects.filter(email=OFFICER_EMAIL).first()
+        if officer is None:
+            officer = EmailUser.objects.create_superuser(OFFICER_EMAIL, BENCHMARK_PREFIX)
+        officer.groups.add(Group.objects.get_or_create(name='Parkstay Officers')[0])
+
+        # places
+        region_objs = _bulk_create(Region, [
+            Region(name=_name(seed, 'region', r), abbreviation='BM{}R{}'.format(seed, r)) for r in range(regions)
+        ])
+        district_objs = _bulk_create(District, [
+            District(name=_name(seed, 'district', r), abbreviation='BM{}D{}'.format(seed, r), region=region)
+            for r, region in enumerate(region_objs)
+        ])
+        park_objs = _bulk_create(Park, [
+            Park(name=_name(seed, 'park', r, p), district=district, wkb_geometry=Point(115 + r, -30 - p),
+                 entry_fee_required=True, oracle_code='BM-PARK-ENTRY')
+            for r, district in enumerate(district_objs) for p in range(parks)
+        ])
+        campground_objs = _bulk_create(Campground, [
+            Campground(name=_name('campground', park.pk, c), park=park, campground_type=0, site_type=c % 2, oracle_code='BM-CAMPING',
+                       wkb_geometry=Point(park.wkb_geometry.x + c * 0.01, park.wkb_geometry.y), max_advance_booking=days)
+            for park in park_objs for c in range(campgrounds)
+        ])
+        counts.update(regions=len(region_objs), parks=len(park_objs), campgrounds=len(campground_objs))
+        log('Created {regions} regions, {parks} parks and {campgrounds} campgrounds'.format(**counts))
+
+        # campsites, rates and closures
+        site_objs = _bulk_create(Campsite, [
+            Campsite(campground=campground, name='Site {:03d}'.format(s), campsite_class=classes[s % len(classes)],
+                     tent=classes[s % len(classes)].tent, campervan=classes[s % len(classes)].campervan,
+                     caravan=classes[s % len(classes)].caravan, max_people=12)
+            for campground in campground_objs for s in range(campsites)
+        ])
+        _bulk_create(CampsiteRate, [
+            CampsiteRate(campsite=site, rate=rates[i % len(rates)], date_start=start - timedelta(days=30), reason=price_reason)
+            for i, site in enumerate(site_objs)
+        ])
+        closures = []
+        for site in rng.sample(site_objs, len(site_objs) // 10):
+            closed = start + timedelta(days=rng.randrange(days))
+            closures.append(CampsiteBookingRange(campsite=site, status=1, closure_reason=closure_reason,
+                                                 range_start=closed, range_end=closed + timedelta(days=rng.randint(1, 14))))
+        _bulk_create(CampsiteBookingRange, closures)
+        campground_closures = []
+        for campground in rng.sample(campground_objs, len(campground_objs) // 10):
+            closed = start + timedelta(days=rng.randrange(days))
+            campground_closures.append(CampgroundBookingRange(campground=campground, status=1, closure_reason=closure_reason,
+                                                              range_start=closed, range_end=closed + timedelta(days=rng.randint(7, 30))))
+        _bulk_create(CampgroundBookingRange, campground_closures)
+        counts.update(campsites=len(site_objs), closures=len(closures) + len(campground_closures))
+        log('Created {campsites} campsites and {closures} closures'.format(**counts))
+
+        # customers
+        customer_objs = _bulk_create(EmailUser, [
+            EmailUser(email='customer{}.{}@{}'.format(seed, c, BENCHMARK_DOMAIN), first_name=BENCHMARK_PREFIX, last_name='Customer {}'.format(c))
+            for c in range(customers)
+        ])
+        counts['customers'] = len(customer_objs)
+
+        # runs of stays over each campsite, with gaps sized to give the occupancy
+        rate_map = dict(CampsiteRate.objects.filter(campsite__in=site_objs).values_list('campsite', 'rate__adult'))
+        gap_mean = 4.0 * (1 - occupancy) / occupancy
+        stays = []
+        for site in site_objs:
+            day = start + timedelta(days=rng.randint(0, 6))
+            while day < end:
+                departure = min(day + timedelta(days=rng.randint(1, 7)), end)
+                stays.append((site, day, departure))
+                day = departure + timedelta(days=int(round(rng.expovariate(1 / gap_mean))) if gap_mean > 0 else 0)
+        booking_objs = _bulk_create(Booking, [
+            Booking(customer=rng.choice(customer_objs), arrival=arrival, departure=departure, booking_type=1,
+                    campground_id=site.campground_id, cost_total=rate_map[site.pk] * 2 * (departure - arrival).days,
+                    confirmation_sent=True, details={'num_adult': 2, 'num_concession': 0, 'num_child': 0, 'num_infant': 0,
+                                                     'first_name': BENCHMARK_PREFIX, 'last_name': 'Customer',
+                                                     'phone': '0400000000', 'country': 'AU', 'postcode': '6000'})
+            for site, arrival, departure in stays
+        ])
+        _bulk_create(CampsiteBooking, [
+            CampsiteBooking(campsite=site, date=arrival + timedelta(days=n), booking=booking, booking_type=1)
+            for booking, (site, arrival, departure) in zip(booking_objs, stays)
+            for n in range((departure - arrival).days)
+        ])
+        counts['bookings'] = len(booking_objs)
+        log('Created {bookings} bookings for {customers} customers'.format(**counts))
+
+        # invoices, most of them paid
+        invoice_objs = _bulk_create(Invoice, [
+            Invoice(amount=booking.cost_total, order_number='BM{}-{}'.format(seed, booking.pk),
+                    reference='9{:02d}{:010d}'.format(seed, booking.pk), system='0019',
+                    text='Reservation for {}'.format(booking.pk))
+            for booking in booking_objs
+        ])
+        _bulk_create(BookingInvoice, [
+            BookingInvoice(booking=booking, invoice_reference=invoice.reference)
+            for booking, invoice in zip(booking_objs, invoice_objs)
+        ])
+        paid = [invoice for invoice in invoice_objs if rng.random() < 0.8]
+        _bulk_create(CashTransaction, [
+            CashTransaction(invoice=invoice, amount=invoice.amount, type='payment', source='eftpos')
+            for invoice in paid
+        ])
+        # the payment summaries the signals would have kept
+        invoices = Invoice.objects.filter(pk__in=[i.pk for i in invoice_objs])
+        invoices.filter(reference__in=[i.reference for i in paid]).update(payment_total=F('amount'), refund_total=0)
+        invoices.exclude(reference__in=[i.reference for i in paid]).update(payment_total=0, refund_total=0)
+        bookings = Booking.objects.filter(pk__in=[b.pk for b in booking_objs])
+        bookings.filter(invoices__invoice_reference__in=[i.reference for i in paid]).update(
+            summary_invoiced=True, summary_payment_status='paid', summary_refund_status='Not Paid',
+            summary_amount_paid=F('cost_total'), summary_outstanding=0
+        )
+        bookings.filter(summary_invoiced__isnull=True).update(
+            summary_invoiced=True, summary_payment_status='unpaid', summary_refund_status='Not Paid',
+            summary_amount_paid=0, summary_outstanding=F('cost_total')
+        )
+        counts.update(invoices=len(invoice_objs), paid=len(paid))
+        log('Created {invoices} invoices, {paid} of them paid'.format(**counts))
+
+        for region in region_objs:
+            Booking.refresh_search_text(region=region.pk)
+
+    # bulk inserts skip the signals that keep the caches and materialized days current
+    for campground in campground_objs:
+        rebuild_campground_availability(campground)
+    for model in set(PAYLOAD_MODELS + MAP_MODELS + SUGGEST_MODELS + AVAILABILITY_MODELS):
+        bump_generation(model)
+    invalidate_campground_permissions()
+    log('Built availability until {}'.format(campground_objs[-1].availability_until if campground_objs else None))
+    return counts
+
+
+def flush(out=None):
+    '''Remove everything generated by generate() and the benchmark runs
+    '''
+    with transaction.atomic():
+        campgrounds = Campground.objects.filter(name__startswith=BENCHMARK_PREFIX)
+        bookings = Booking.objects.filter(campground__in=campgrounds)
+        references = list(BookingInvoice.objects.filter(booking__in=bookings).values_list('invoice_reference', flat=True))
+        CampsiteBooking.objects.filter(campsite__campground__in=campgrounds).delete()
+        bookings.delete()
+        CashTransaction.objects.filter(invoice__reference__in=references).delete()
+        Invoice.objects.filter(reference__in=references).delete()
+        CampsiteRate.objects.filter(campsite__campground__in=campgrounds).delete()
+        CampsiteBookingRange.objects.filter(campsite__campground__in=campgrounds).delete()
+        Campsite.objects.filter(campground__in=campgrounds).delete()
+        campgrounds.delete()
+        Park.objects.filter(name__startswith=BENCHMARK_PREFIX).delete()
+        District.objects.filter(name__startswith=BENCHMARK_PREFIX).delete()
+        Region.objects.filter(name__startswith=BENCHMARK_PREFIX).delete()
+        EmailUser.objects.filter(email__endswith='@{}'.format(BENCHMARK_DOMAIN)).exclude(email=OFFICER_EMAIL).delete()
+    for model in set(PAYLOAD_MODELS + MAP_MODELS + SUGGEST_MODELS + AVAILABILITY_MODELS):
+        bump_generation(model)
+    invalidate_campground_permissions()
+    if out:
+        out.write('Removed the benchmark data\n')
@@ -0,0 +1,225 @@
+"""Benchmark of the parkstay booking funnel.
+
+Replays the requests of a release day rush against the endpoints that carry it
+through the Django test client, on the data from parkstay.benchmarks.data, and
+records the latency percentiles and query count of each. Results are written
+as JSON tagged with the git commit so runs can be compared across commits.
+"""
+import json
+import random
+import subprocess
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ledger.accounts.models import EmailUser
+from parkstay import utils
+from parkstay.availability import build_availability_matrix
+from parkstay.benchmarks.data import BENCHMARK_DOMAIN, BENCHMARK_PREFIX, OFFICER_EMAIL
+from parkstay.models import Booking, Campground, Campsite
+
+ENDPOINTS = ('availability', 'campground_map_filter', 'create_booking', 'make_booking', 'booking_list')
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    '''Nearest rank percentile of a list of values
+    '''
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class _CheckoutRedirect(object):
+    cookies = {}
+
+
+class _CheckoutResponse(object):
+    status_code = 200
+    content = b''
+    headers = {'Content-Type': 'text/html'}
+    # MakeBookingsView reads the basket cookie of anonymous users from the first redirect
+    history = [_CheckoutRedirect()]
+
+
+@contextmanager
+def in_process_checkout():
+    '''Hand bookings over to payment in process
+
+    The public checkout posts back to the ledger checkout views over HTTP, which the
+    test client can't serve, so the basket, order and invoice are created with
+    internal_checkout instead.
+    '''
+    checkout = utils.checkout
+
+    def internal(request, booking, lines, invoice_text=None, vouchers=None):
+        invoice = utils.internal_checkout(booking, lines, invoice_text=invoice_text, vouchers=vouchers)
+        utils.internal_create_booking_invoice(booking, invoice)
+        return _CheckoutResponse()
+
+    utils.checkout = internal
+    try:
+        yield
+    finally:
+        utils.checkout = checkout
+
+
+class Funnel(object):
+    '''The requests of the booking funnel against the benchmark data
+    '''
+
+    def __init__(self, seed=0, nights=3):
+        self.rng = random.Random(seed)
+        self.nights = nights
+        self.campgrounds = list(Campground.objects.filter(name__startswith=BENCHMARK_PREFIX).values_list('pk', 'site_type'))
+        if not self.campgrounds:
+            raise ValueError('No benchmark data, generate it first')
+        self.officer = EmailUser.objects.get(email=OFFICER_EMAIL)
+        self.customer_count = 0
+
+    def stay(self):
+        arrival = date.today() + timedelta(days=self.rng.randint(1, 150))
+        return arrival, arrival + timedelta(days=self.nights)
+
+    def stay_params(self):
+        arrival, departure = self.stay()
+        return {'arrival': arrival.strftime('%Y/%m/%d'), 'departure': departure.strftime('%Y/%m/%d'), 'num_adult': 2}
+
+    def free_site(self):
+        '''Pick a campsite free for a stay
+        '''
+        for _ in range(100):
+            campground = self.rng.choice(self.campgrounds)[0]
+            arrival, departure = self.stay()
+            free = build_availability_matrix(Campsite.objects.filter(campground=campground), arrival, departure).clear_sites()
+            if free:
+                site = Campsite.objects.select_related('campground').get(pk=self.rng.choice(free))
+                return site, arrival, departure
+        raise ValueError('No free campsites left in the benchmark data')
+
+    def booking_data(self, site, arrival, departure):
+        data = {'arrival': arrival.strftime('%Y/%m/%d'), 'departure': departure.strftime('%Y/%m/%d'), 'num_adult': 2}
+        if site.campground.site_type == 0:
+            data['campsite'] = site.pk
+        else:
+            data.update(campground=site.campground_id, campsite_class=site.campsite_class_id)
+        return data
+
+    # endpoints, each returns a client and the request to time
+    def availability(self):
+        campground = self.rng.choice(self.campgrounds)[0]
+        return Client(), 'get', '/api/availability/{}/'.format(campground), self.stay_params()
+
+    def campground_map_filter(self):
+        return Client(), 'get', '/api/campground_map_filter/', self.stay_params()
+
+    def create_booking(self):
+        client = Client()
+        return client, 'post', '/api/create_booking', self.booking_data(*self.free_site())
+
+    def make_booking(self):
+        client = Client()
+        client.post('/api/create_booking', self.booking_data(*self.free_site()))
+        self.customer_count += 1
+        email = 'funnel{}.{}@{}'.format(int(time.time()), self.customer_count, BENCHMARK_DOMAIN)
+        return client, 'post', '/booking/', {
+            'num_adult': 2, 'num_child': 0, 'num_concession': 0, 'num_infant': 0,
+            'first_name': BENCHMARK_PREFIX, 'last_name': 'Funnel', 'phone': '0400000000', 'postcode': '6000',
+            'country': 'AU', 'email': email, 'confirm_email': email,
+            'form-TOTAL_FORMS': 1, 'form-INITIAL_FORMS': 0, 'form-MIN_NUM_FORMS': 0, 'form-MAX_NUM_FORMS': 8,
+            'form-0-vehicle_rego': 'BENCH1', 'form-0-vehicle_type': '0',
+        }
+
+    def booking_list(self):
+        client = Client()
+        client.force_login(self.officer)
+        return client, 'get', '/api/booking/', {'draw': 1, 'start': 0, 'length': 10, 'search[value]': self.rng.choice(['', 'Customer', 'PS1'])}
+
+    def measure(self, endpoint):
+        '''Time one request to an endpoint, returns (seconds, queries, status code)
+        '''
+        client, method, path, data = getattr(self, endpoint)()
+        with CaptureQueriesContext(connection) as queries:
+            started = time.time()
+            response = getattr(client, method)(path, data)
+            elapsed = time.time() - started
+        return elapsed, len(queries), response.status_code
+
+
+def run(endpoints=ENDPOINTS, requests=50, warmup=5, seed=0, out=None):
+    '''Replay the funnel, returns the results as a dict ready to be saved as JSON
+    '''
+    funnel = Funnel(seed=seed)
+    started = timezone.now()
+    results = OrderedDict()
+    with in_process_checkout():
+        for endpoint in endpoints:
+            for _ in range(warmup):
+                funnel.measure(endpoint)
+            timings, queries, statuses = [], [], {}
+            for _ in range(requests):
+                elapsed, count, status = funnel.measure(endpoint)
+                timings.append(elapsed)
+                queries.append(count)
+                statuses[status] = statuses.get(status, 0) + 1
+            result = OrderedDict([('requests', requests)])
+            for p in PERCENTILES:
+                result['p{}_ms'.format(p)] = round(percentile(timings, p) * 1000, 2)
+            result['mean_ms'] = round(sum(timings) / len(timings) * 1000, 2)
+            result['queries_max'] = max(queries)
+            result['queries_mean'] = round(sum(queries) / float(len(queries)), 1)
+            result['statuses'] = {str(k): v for k, v in statuses.items()}
+            results[endpoint] = result
+            if out:
+                out.write('{:<22} p50 {p50_ms:8.2f}ms  p90 {p90_ms:8.2f}ms  p99 {p99_ms:8.2f}ms  queries {queries_max}\n'.format(endpoint, **result))
+    return OrderedDict([
+        ('commit', git_commit()),
+        ('started', started.isoformat()),
+        ('database', connection.vendor),
+        ('bookings', Booking.objects.filter(campground__name__startswith=BENCHMARK_PREFIX).count()),
+        ('endpoints', results),
+    ])
+
+
+def compare(baseline, current, tolerance=0.2, out=None):
+    '''Compare two runs, returns the endpoints that got slower than the tolerance
+    allows or now run more queries
+    '''
+    regressions = []
+    for endpoint, result in current['endpoints'].items():
+        before = baseline['endpoints'].get(endpoint)
+        if not before:
+            continue
+        slower = result['p50_ms'] > before['p50_ms'] * (1 + tolerance) or result['p90_ms'] > before['p90_ms'] * (1 + tolerance)
+        more_queries = result['queries_max'] > before['queries_max']
+        if slower or more_queries:
+            regressions.append(endpoint)
+        if out:
+            out.write('{:<22} p50 {:8.2f}ms -> {:8.2f}ms  p90 {:8.2f}ms -> {:8.2f}ms  queries {} -> {}{}\n'.format(
+                endpoint, before['p50_ms'], result['p50_ms'], before['p90_ms'], result['p90_ms'],
+                before['queries_max'], result['queries_max'], '  REGRESSED' if endpoint in regressions else ''))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,103 @@
+"""Versioned cache of serialized parkstay payloads.
+
+Every tracked model has a generation counter in the shared ``default`` cache
+that is bumped from its save, delete and many-to-many signals. Payload keys
+embed the generations of the models they are built from, so invalidation is a
+single increment that every worker sees, and stale payloads simply age out.
+Payloads themselves are stored in the ``PARKSTAY_PAYLOAD_CACHE`` alias, which
+can be a per-process LRU cache since the keys already carry the versions.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.views.decorators.http import condition
+
+PAYLOAD_TIMEOUT = 3600
+
+
+def _generation_cache():
+    return caches['default']
+
+
+def _payload_cache():
+    return caches[getattr(settings, 'PARKSTAY_PAYLOAD_CACHE', 'default')]
+
+
+def _generation_key(model):
+    return 'parkstay_generation:{}'.format(model._meta.label_lower)
+
+
+def _new_generation():
+    # start from the clock so a counter lost from the cache never reuses an old value
+    return int(time.time() * 1000)
+
+
+def bump_generation(model):
+    """Invalidate every payload built from the model."""
+    cache = _generation_cache()
+    key = _generation_key(model)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_generation(), None)
+
+
+def generations(models):
+    """Get the current generation of each model."""
+    cache = _generation_cache()
+    keys = [_generation_key(m) for m in models]
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            cache.add(key, _new_generation(), None)
+            values[key] = cache.get(key)
+    return [values[key] for key in keys]
+
+
+def generation_etag(models, parts=()):
+    """Build an ETag from the generations of the models and any other parts."""
+    version = ':'.join(str(p) for p in list(parts) + generations(models))
+    return hashlib.md5(version.encode('utf-8')).hexdigest()
+
+
+def generation_condition(models, parts=None):
+    """View decorator answering conditional GETs with 304 Not Modified while
+    none of the models changed, without running the view.
+
+    parts(request, *args, **kwargs) returns anything else the response
+    depends on, e.g. the query string.
+    """
+    def etag(request, *args, **kwargs):
+        return generation_etag(models, parts(request, *args, **kwargs) if parts else ())
+    return condition(etag_func=etag)
+
+
+def cached_payload(name, models, build, parts=(), timeout=PAYLOAD_TIMEOUT):
+    """Return the payload built by build(), cached until one of the models changes.
+
+    parts holds anything else the payload depends on, e.g. the host used for
+    hyperlinks or the current date.
+    """
+    key = 'parkstay_payload:{}:{}'.format(name, generation_etag(models, parts))
+    cache = _payload_cache()
+    payload = cache.get(key)
+    if payload is None:
+        payload = build()
+        cache.set(key, payload, timeout)
+    return payload
+
+
+def track_generations(*models):
+    """Bump the generation of each model whenever it or its many-to-many relations change."""
+    for model in models:
+        def receiver(sender, _model=model, **kwargs):
+            bump_generation(_model)
+        uid = 'parkstay_generation_{}'.format(model._meta.label_lower)
+        post_save.connect(receiver, sender=model, weak=False, dispatch_uid=uid)
+        post_delete.connect(receiver, sender=model, weak=False, dispatch_uid=uid)
+        for field in model._meta.local_many_to_many:
+            m2m_changed.connect(receiver, sender=field.remote_field.through, weak=False,
+                                dispatch_uid='{}_{}'.format(uid, field.name))
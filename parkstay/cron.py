@@ -4,7 +4,8 @@ from django.db.models import Q
 
 from django_cron import CronJobBase, Schedule
 
-from parkstay.models import Booking
+from parkstay.models import Booking, Campground
+from parkstay.availability import rebuild_campground_availability
 from parkstay.reports import outstanding_bookings
 from parkstay.emails import send_booking_confirmation
 from parkstay.utils import oracle_integration
@@ -27,6 +28,16 @@ class OracleIntegrationCronJob(CronJobBase):
     def do(self):
         oracle_integration(str(date.today()-timedelta(days=1)),False)
 
+class AvailabilityRefreshCronJob(CronJobBase):
+    RUN_AT_TIMES = ['00:05']
+
+    schedule = Schedule(run_at_times=RUN_AT_TIMES)
+    code = 'parkstay.availability_refresh'
+
+    def do(self):
+        for campground in Campground.objects.all():
+            rebuild_campground_availability(campground)
+
 class SendBookingsConfirmationCronJob(CronJobBase):
     RUN_EVERY_MINS = 5
 
@@ -1,6 +1,11 @@
 from __future__ import unicode_literals
+import time
+from django.core.cache import cache
 from ledger.accounts.models import EmailUser
 
+CAMPGROUND_PERMISSIONS_VERSION = 'campground_permissions_version'
+CAMPGROUND_PERMISSIONS_TIMEOUT = 3600
+
 
 def belongs_to(user, group_name):
     """
@@ -13,7 +18,12 @@ def belongs_to(user, group_name):
 
 
 def is_officer(user):
-    return user.is_authenticated() and (belongs_to(user, 'Parkstay Officers') or user.is_superuser)
+    if not user.is_authenticated():
+        return False
+    # remember the answer on the user object for the rest of the request
+    if not hasattr(user, '_parkstay_officer'):
+        user._parkstay_officer = user.is_superuser or belongs_to(user, 'Parkstay Officers')
+    return user._parkstay_officer
 
 
 def is_customer(user):
@@ -30,8 +40,36 @@ def is_customer(user):
 def get_all_officers():
     return EmailUser.objects.filter(groups__name='Parkstay Officers')
 
+def invalidate_campground_permissions():
+    """
+    Expire every cached set of viewable campgrounds.
+    """
+    cache.set(CAMPGROUND_PERMISSIONS_VERSION, time.time(), None)
+
+
+def viewable_campgrounds(user):
+    """
+    Get the ids of the campgrounds the user can view through their campground groups.
+    The set is cached per user until a campground group or campground changes.
+    :param user:
+    :return: set of campground ids
+    """
+    from parkstay.models import CampgroundGroup
+    if not user.is_authenticated():
+        return set()
+    version = cache.get(CAMPGROUND_PERMISSIONS_VERSION)
+    if version is None:
+        invalidate_campground_permissions()
+        version = cache.get(CAMPGROUND_PERMISSIONS_VERSION)
+    key = 'viewable_campgrounds_{}_{}'.format(user.id, version)
+    campgrounds = cache.get(key)
+    if campgrounds is None:
+        campgrounds = set(CampgroundGroup.objects.filter(
+            members=user, campgrounds__isnull=False
+        ).values_list('campgrounds', flat=True))
+        cache.set(key, campgrounds, CAMPGROUND_PERMISSIONS_TIMEOUT)
+    return campgrounds
+
+
 def can_view_campground(user,campground):
-    for g in campground.campgroundgroup_set.all():
-        if user in g.members.all():
-            return True
-    return False
+    return campground.id in viewable_campgrounds(user)
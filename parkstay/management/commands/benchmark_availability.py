@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand, CommandError
+from parkstay.benchmarks import availability
+
+
+class Command(BaseCommand):
+    help = 'Compare and time the class grouped availability builder against the loops it replaced'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sites', nargs='+', type=int, default=list(availability.SITE_COUNTS), help='Campground sizes to benchmark')
+        parser.add_argument('--days', nargs='+', type=int, default=list(availability.DAY_COUNTS), help='Stay lengths to benchmark')
+        parser.add_argument('--repeat', type=int, default=5, help='Number of timing runs, the best is reported')
+
+    def handle(self, *args, **options):
+        results = availability.run(options['sites'], options['days'], repeat=options['repeat'], out=self.stdout)
+        if not all(r[2] for r in results):
+            raise CommandError('The availability builder output differs from the legacy loops')
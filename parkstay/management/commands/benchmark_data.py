@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from parkstay.benchmarks import data
+
+
+class Command(BaseCommand):
+    help = 'Generate (or remove) the synthetic data for the booking funnel benchmark'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--regions', type=int, default=3)
+        parser.add_argument('--parks', type=int, default=4, help='Parks per region')
+        parser.add_argument('--campgrounds', type=int, default=5, help='Campgrounds per park')
+        parser.add_argument('--campsites', type=int, default=40, help='Campsites per campground')
+        parser.add_argument('--customers', type=int, default=500)
+        parser.add_argument('--days', type=int, default=365, help='Days of bookings to generate from today')
+        parser.add_argument('--occupancy', type=float, default=0.5, help='Share of campsite nights booked, above 0 and up to 1')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--flush', action='store_true', help='Remove the benchmark data instead')
+
+    def handle(self, *args, **options):
+        if options['flush']:
+            data.flush(out=self.stdout)
+            return
+        data.generate(
+            regions=options['regions'], parks=options['parks'], campgrounds=options['campgrounds'],
+            campsites=options['campsites'], customers=options['customers'], days=options['days'],
+            occupancy=options['occupancy'], seed=options['seed'], out=self.stdout
+        )
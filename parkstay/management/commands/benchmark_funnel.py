@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment
+from parkstay.benchmarks import funnel
+
+
+class Command(BaseCommand):
+    help = 'Time the booking funnel endpoints against the benchmark data and compare with an earlier run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--endpoint', nargs='+', choices=funnel.ENDPOINTS, default=list(funnel.ENDPOINTS))
+        parser.add_argument('--requests', type=int, default=50, help='Timed requests per endpoint')
+        parser.add_argument('--warmup', type=int, default=5, help='Untimed requests per endpoint')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Save the results as JSON')
+        parser.add_argument('--baseline', help='Results of an earlier run to compare with')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown against the baseline')
+
+    def handle(self, *args, **options):
+        # allow the test client host and keep confirmation emails in memory
+        setup_test_environment()
+        try:
+            results = funnel.run(options['endpoint'], requests=options['requests'], warmup=options['warmup'],
+                                 seed=options['seed'], out=self.stdout)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['output']:
+            funnel.save(results, options['output'])
+        if options['baseline']:
+            baseline = funnel.load(options['baseline'])
+            self.stdout.write('Compared with {} ({})'.format(baseline.get('commit'), baseline.get('started')))
+            regressions = funnel.compare(baseline, results, tolerance=options['tolerance'], out=self.stdout)
+            if regressions:
+                raise CommandError('Regressed: {}'.format(', '.join(regressions)))
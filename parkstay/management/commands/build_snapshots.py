@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from six.moves.urllib.parse import urlparse
+from parkstay.snapshots import SNAPSHOTS, build_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Render the search suggestion and campground map snapshots'
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', nargs='*', help='Site urls to render the campground map for, e.g. https://parkstay.example.com/')
+
+    def handle(self, *args, **options):
+        for name, (models, build, per_host) in sorted(SNAPSHOTS.items()):
+            urls = options['url'] if per_host else [None]
+            for url in urls:
+                if url:
+                    site = urlparse(url)
+                    request = RequestFactory().get('/', HTTP_HOST=site.netloc, secure=site.scheme == 'https')
+                else:
+                    request = RequestFactory().get('/')
+                snapshot = build_snapshot(name, request)
+                print('Snapshot {}{} built: {} bytes, {} gzipped'.format(
+                    name, ' for {}'.format(url) if url else '', len(snapshot.content), len(snapshot.gzipped)))
@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.utils import timezone
 from parkstay.models import Booking
+from parkstay.availability import deferred_refresh
 
 from datetime import timedelta
 
@@ -12,5 +14,7 @@ class Command(BaseCommand):
             booking_type=3, 
             expiry_time__lt=timezone.now()-timedelta(minutes=5)
         )
-        print(query.delete())
+        # refresh the released campsite days in one batch rather than per night
+        with transaction.atomic(), deferred_refresh():
+            print(query.delete())
         
@@ -4,6 +4,7 @@ from django.conf import settings
 from parkstay.models import Booking
 from parkstay import emails
 from ledger.payments.models import Invoice
+from ledger.payments.invoice.models import annotate_payment_totals
 
 from datetime import timedelta, date
 from decimal import Decimal as D
@@ -21,7 +22,7 @@ class Command(BaseCommand):
         ).prefetch_related('invoices') 
 
         invoice_ids = itertools.chain(*query.values_list('invoices__invoice_reference'))
-        invoice_map = {i.reference: i for i in Invoice.objects.filter(reference__in=invoice_ids)}
+        invoice_map = {i.reference: i for i in annotate_payment_totals(Invoice.objects.filter(reference__in=invoice_ids))}
 
         booking_del = []
         for booking in query:
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from parkstay.models import Campground
+from parkstay.availability import rebuild_campground_availability
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the materialized campsite availability and roll its horizon forward'
+
+    def add_arguments(self, parser):
+        parser.add_argument('campground', nargs='*', type=int, help='Ids of the campgrounds to rebuild (default all)')
+
+    def handle(self, *args, **options):
+        campgrounds = Campground.objects.all()
+        if options['campground']:
+            campgrounds = campgrounds.filter(pk__in=options['campground'])
+        for campground in campgrounds:
+            rebuild_campground_availability(campground)
+            print('Availability for {} built until {}'.format(campground, campground.availability_until))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from parkstay.models import Booking
+
+CHUNK_SIZE = 1000
+
+
+class Command(BaseCommand):
+    help = 'Store the payment summary of the bookings that don\'t have one yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', default=False, help='Recalculate the summary of every booking')
+
+    def handle(self, *args, **options):
+        bookings = Booking.objects.all()
+        if not options['all']:
+            bookings = bookings.filter(summary_payment_status__isnull=True)
+        pks = list(bookings.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(pks), CHUNK_SIZE):
+            for booking in Booking.objects.filter(pk__in=pks[start:start + CHUNK_SIZE]):
+                booking.update_payment_summary()
+        print('Updated the payment summary of {} bookings'.format(len(pks)))
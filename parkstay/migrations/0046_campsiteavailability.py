@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parkstay', '0045_campground_additional_info'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CampsiteAvailability',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('booking_type', models.SmallIntegerField(blank=True, choices=[(0, 'Reception booking'), (1, 'Internet booking'), (2, 'Black booking'), (3, 'Temporary reservation')], null=True)),
+                ('campsite_closed', models.BooleanField(default=False)),
+                ('campground_closed', models.BooleanField(default=False)),
+                ('campsite', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='availability', to='parkstay.Campsite')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='campsiteavailability',
+            unique_together=set([('campsite', 'date')]),
+        ),
+        migrations.AddField(
+            model_name='campground',
+            name='availability_until',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+    ]
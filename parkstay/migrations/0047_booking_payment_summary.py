@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parkstay', '0046_campsiteavailability'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='summary_amount_paid',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=8, null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='summary_invoiced',
+            field=models.NullBooleanField(editable=False),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='summary_outstanding',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=8, null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='summary_payment_status',
+            field=models.CharField(blank=True, editable=False, max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='summary_refund_status',
+            field=models.CharField(blank=True, editable=False, max_length=20, null=True),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Frozen copy of parkstay.models.BOOKING_SEARCH_TEXT as it was then, replaced
+# by the backfill in 0049_booking_search_text_names.
+SEARCH_TEXT = "lower(concat_ws('|', cg.name, r.name, b.details->>'first_name', b.details->>'last_name', b.legacy_name, 'ps' || b.id))"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parkstay', '0047_booking_payment_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='search_text',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX parkstay_booking_search_text_trgm ON parkstay_booking USING gin (search_text gin_trgm_ops)',
+            'DROP INDEX parkstay_booking_search_text_trgm'
+        ),
+        migrations.RunSQL(
+            """UPDATE parkstay_booking b SET search_text = {0}
+            FROM parkstay_campground cg
+            JOIN parkstay_park p ON p.id = cg.park_id
+            JOIN parkstay_district d ON d.id = p.district_id
+            JOIN parkstay_region r ON r.id = d.region_id
+            WHERE cg.id = b.campground_id""".format(SEARCH_TEXT),
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Frozen copy of parkstay.models.BOOKING_SEARCH_TEXT, which keeps the search text
+# current after this backfill. Change them together, and backfill again in a new
+# migration when the expression changes.
+SEARCH_TEXT = "lower(concat_ws('|', cg.name, r.name, b.details->>'first_name', b.details->>'last_name', b.legacy_name))"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('parkstay', '0048_booking_search_text'),
+    ]
+
+    operations = [
+        # confirmation numbers are matched on the prefix of the id
+        migrations.RunSQL(
+            'CREATE INDEX parkstay_booking_id_text_prefix ON parkstay_booking ((CAST(id AS text)) text_pattern_ops)',
+            'DROP INDEX parkstay_booking_id_text_prefix'
+        ),
+        migrations.RunSQL(
+            """UPDATE parkstay_booking b SET search_text = {0}
+            FROM parkstay_campground cg
+            JOIN parkstay_park p ON p.id = cg.park_id
+            JOIN parkstay_district d ON d.id = p.district_id
+            JOIN parkstay_region r ON r.id = d.region_id
+            WHERE cg.id = b.campground_id""".format(SEARCH_TEXT),
+            migrations.RunSQL.noop
+        ),
+    ]
@@ -17,10 +17,12 @@ from datetime import date, time, datetime, timedelta
 from django.conf import settings
 from taggit.managers import TaggableManager
 from django.dispatch import receiver
-from django.db.models.signals import post_delete, pre_save, post_save,pre_delete
+from django.db.models.signals import post_delete, pre_save, post_save,pre_delete, m2m_changed
 from parkstay.exceptions import BookingRangeWithinException
-from django.core.cache import cache
+from parkstay.caching import track_generations
+from parkstay.helpers import invalidate_campground_permissions
 from ledger.payments.models import Invoice
+from ledger.payments.invoice.models import payment_summary_updated
 from ledger.accounts.models import EmailUser
 
 # Create your models here.
@@ -67,7 +69,6 @@ class Park(models.Model):
             raise ValidationError('A park entry oracle code is required if entry fee is required.')
 
     def save(self,*args,**kwargs):
-        cache.delete('parks')
         self.full_clean()
         super(Park,self).save(*args,**kwargs)
 
@@ -132,15 +133,12 @@ class Campground(models.Model):
     max_advance_booking = models.IntegerField(default =180)
     oracle_code = models.CharField(max_length=50,null=True,blank=True)
     campground_map = models.FileField(upload_to=update_campground_map_filename,null=True,blank=True)
+    # last day covered by the materialized CampsiteAvailability closures
+    availability_until = models.DateField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return self.name
 
-    def save(self,*args,**kwargs):
-        cache.delete('campgrounds')
-        cache.delete('campgrounds_dt')
-        super(Campground,self).save(*args,**kwargs)
-
     class Meta:
         unique_together = (('name', 'park'),)
 
@@ -818,6 +816,25 @@ class CampsiteBooking(models.Model):
         unique_together = (('campsite', 'date'),)
 
 
+class CampsiteAvailability(models.Model):
+    """Materialized non-open days for a campsite.
+
+    Maintained from CampsiteBooking and the booking range listeners, so an
+    availability lookup is a single range scan. Days without a row are open.
+    """
+    campsite = models.ForeignKey('Campsite', on_delete=models.CASCADE, related_name='availability')
+    date = models.DateField()
+    booking_type = models.SmallIntegerField(choices=CampsiteBooking.BOOKING_TYPE_CHOICES, null=True, blank=True)
+    campsite_closed = models.BooleanField(default=False)
+    campground_closed = models.BooleanField(default=False)
+
+    def __str__(self):
+        return '{} - {}'.format(self.campsite, self.date)
+
+    class Meta:
+        unique_together = (('campsite', 'date'),)
+
+
 class Rate(models.Model):
     adult = models.DecimalField(max_digits=8, decimal_places=2, default='10.00')
     concession = models.DecimalField(max_digits=8, decimal_places=2, default='6.60')
@@ -896,6 +913,20 @@ class CampsiteRate(models.Model):
         self.save()
 
 
+# Denormalised booking search text of the names a booking can be found by.
+# Confirmation numbers are left out, they are matched on their prefix against the id.
+# Migration 0049_booking_search_text_names backfilled with a copy of this expression,
+# a change here needs a migration refreshing the existing bookings.
+BOOKING_SEARCH_TEXT = "lower(concat_ws('|', cg.name, r.name, b.details->>'first_name', b.details->>'last_name', b.legacy_name))"
+BOOKING_SEARCH_SQL = """UPDATE parkstay_booking b SET search_text = {0}
+    FROM parkstay_campground cg
+    JOIN parkstay_park p ON p.id = cg.park_id
+    JOIN parkstay_district d ON d.id = p.district_id
+    JOIN parkstay_region r ON r.id = d.region_id
+    WHERE cg.id = b.campground_id AND b.search_text IS DISTINCT FROM {0}""".format(BOOKING_SEARCH_TEXT)
+
+BOOKING_SUMMARY_FIELDS = ('summary_invoiced', 'summary_payment_status', 'summary_refund_status', 'summary_amount_paid', 'summary_outstanding')
+
 class Booking(models.Model):
     BOOKING_TYPE_CHOICES = (
         (0, 'Reception booking'),
@@ -920,6 +951,14 @@ class Booking(models.Model):
     confirmation_sent = models.BooleanField(default=False)
     created = models.DateTimeField(default=timezone.now)
     canceled_by = models.ForeignKey(settings.AUTH_USER_MODEL,on_delete=models.PROTECT, blank=True, null=True,related_name='canceled_bookings')
+    # Payment summary rolled up from the booking invoices, see update_payment_summary
+    summary_invoiced = models.NullBooleanField(editable=False)
+    summary_payment_status = models.CharField(max_length=20, null=True, blank=True, editable=False)
+    summary_refund_status = models.CharField(max_length=20, null=True, blank=True, editable=False)
+    summary_amount_paid = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True, editable=False)
+    summary_outstanding = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True, editable=False)
+    # Trigram indexed search text, see refresh_search_text
+    search_text = models.TextField(null=True, blank=True, editable=False)
 
     # Properties
     # =================================
@@ -998,7 +1037,7 @@ class Booking(models.Model):
 
     @property
     def paid(self):
-        if self.legacy_id and self.invoices.count() < 1:
+        if self.legacy_id and not self.__payment_summary()['invoiced']:
             return True
         else:
             payment_status = self.__check_payment_status()
@@ -1008,7 +1047,7 @@ class Booking(models.Model):
 
     @property
     def unpaid(self):
-        if self.legacy_id and self.invoices.count() < 1:
+        if self.legacy_id and not self.__payment_summary()['invoiced']:
             return False
         else:
             payment_status = self.__check_payment_status()
@@ -1030,7 +1069,7 @@ class Booking(models.Model):
 
     @property
     def status(self):
-        if (self.legacy_id and self.invoices.count() >= 1) or not self.legacy_id:
+        if (self.legacy_id and self.__payment_summary()['invoiced']) or not self.legacy_id:
             payment_status = self.__check_payment_status()
             status =  ''
             parts = payment_status.split('_')
@@ -1078,74 +1117,117 @@ class Booking(models.Model):
             raise ValidationError('Park does not have an Oracle code.')
         super(Booking,self).clean(*args,**kwargs)
 
+    def save(self,*args,**kwargs):
+        # The payment summary is only written by update_payment_summary, so that an
+        # instance loaded before a payment doesn't save its stale summary back
+        if self.pk and not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            kwargs['update_fields'] = [f.name for f in self._meta.concrete_fields if not f.primary_key and f.name not in BOOKING_SUMMARY_FIELDS]
+            super(Booking,self).save(*args,**kwargs)
+            self.refresh_from_db(fields=BOOKING_SUMMARY_FIELDS)
+        else:
+            super(Booking,self).save(*args,**kwargs)
+
     def __str__(self):
         return '{}: {} - {}'.format(self.customer, self.arrival, self.departure)
 
+    def __payment_summary(self):
+        if self.summary_payment_status is None:
+            self.update_payment_summary()
+        return {
+            'invoiced': self.summary_invoiced,
+            'payment_status': self.summary_payment_status,
+            'refund_status': self.summary_refund_status,
+            'amount_paid': self.summary_amount_paid,
+            'outstanding': self.summary_outstanding
+        }
+
     def __check_payment_amount(self):
-        invoices = []
-        amount = D('0.0')
-        references = [i.invoice_reference for i in self.invoices.all()]
-        #invoices = Invoice.objects.filter(reference__in=references,voided=False)
-        if self.active_invoice:
-            amount = self.active_invoice.payment_amount
-        elif self.legacy_id:
-            amount =  D(self.cost_total)
-        return amount
+        return self.__payment_summary()['amount_paid']
 
     def __check_payment_status(self):
-        invoices = []
-        amount = D('0.0')
-        references = self.invoices.all().values('invoice_reference')
-        for r in references:
-            try:
-                invoices.append(Invoice.objects.get(reference=r.get("invoice_reference")))
-            except Invoice.DoesNotExist:
-                pass
-        for i in invoices:
-            if not i.voided:
-                amount += i.payment_amount
-
-        if amount == 0:
-            return 'unpaid'
-        if self.cost_total < amount:
-            return 'over_paid'
-        elif self.cost_total > amount:
-            return 'partially_paid'
-        else:return "paid"
+        return self.__payment_summary()['payment_status']
 
     def __check_refund_status(self):
-        invoices = []
-        amount = D('0.0')
-        refund_amount = D('0.0')
+        return self.__payment_summary()['refund_status']
+
+    def __outstanding_amount(self):
+        return self.__payment_summary()['outstanding']
+
+    def update_payment_summary(self):
+        '''Recalculate and store the payment summary from the booking invoices
+        '''
         references = self.invoices.all().values_list('invoice_reference', flat=True)
-        invoices = Invoice.objects.filter(reference__in=references)
-        for i in invoices:
-            if i.voided:
-                amount += i.payment_amount
-                refund_amount += i.refund_amount
+        invoices = list(Invoice.objects.filter(reference__in=references).order_by('-created'))
 
-        if amount == 0:
-            return 'Not Paid'
-        if refund_amount > 0 and amount > refund_amount:
-            return 'Partially Refunded'
-        elif refund_amount == amount:
-            return 'Refunded'
-        else:return "Not Refunded"
+        # amount paid against the active (latest) invoice
+        amount_paid = D('0.0')
+        if invoices:
+            amount_paid = invoices[0].payment_amount
+        elif self.legacy_id:
+            amount_paid = D(self.cost_total)
 
-    def __outstanding_amount(self):
-        invoices = []
-        amount = D('0.0')
-        references = self.invoices.all().values('invoice_reference')
-        for r in references:
-            try:
-                invoices.append(Invoice.objects.get(reference=r.get("invoice_reference")))
-            except Invoice.DoesNotExist:
-                pass
+        paid = D('0.0')
+        outstanding = D('0.0')
+        voided_paid = D('0.0')
+        voided_refunded = D('0.0')
         for i in invoices:
-            if not i.voided:
-                amount += i.balance
+            if i.voided:
+                voided_paid += i.payment_amount
+                voided_refunded += i.refund_amount
+            else:
+                paid += i.payment_amount
+                outstanding += i.balance
+
+        if paid == 0:
+            payment_status = 'unpaid'
+        elif self.cost_total < paid:
+            payment_status = 'over_paid'
+        elif self.cost_total > paid:
+            payment_status = 'partially_paid'
+        else:
+            payment_status = 'paid'
+
+        if voided_paid == 0:
+            refund_status = 'Not Paid'
+        elif voided_refunded > 0 and voided_paid > voided_refunded:
+            refund_status = 'Partially Refunded'
+        elif voided_refunded == voided_paid:
+            refund_status = 'Refunded'
+        else:
+            refund_status = 'Not Refunded'
+
+        self.summary_invoiced = self.invoices.exists()
+        self.summary_payment_status = payment_status
+        self.summary_refund_status = refund_status
+        self.summary_amount_paid = amount_paid
+        self.summary_outstanding = outstanding
+        Booking.objects.filter(pk=self.pk).update(
+            summary_invoiced=self.summary_invoiced,
+            summary_payment_status=payment_status,
+            summary_refund_status=refund_status,
+            summary_amount_paid=amount_paid,
+            summary_outstanding=outstanding
+        )
 
-        return amount
+    @staticmethod
+    def update_payment_summaries(invoice_reference):
+        '''Recalculate the payment summary of the bookings for an invoice
+        '''
+        for booking in Booking.objects.filter(invoices__invoice_reference=invoice_reference).distinct():
+            booking.update_payment_summary()
+
+    @staticmethod
+    def refresh_search_text(booking=None, campground=None, park=None, region=None):
+        '''Rebuild the search text of the bookings matching the given ids
+        '''
+        sql = BOOKING_SEARCH_SQL
+        params = []
+        for column, value in (('b.id', booking), ('cg.id', campground), ('p.id', park), ('r.id', region)):
+            if value is not None:
+                sql += ' AND {} = %s'.format(column)
+                params.append(value)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
 
     def cancelBooking(self,reason,user=None):
         if not reason:
@@ -1191,20 +1273,23 @@ class Booking(models.Model):
     @property
     def vehicle_payment_status(self):
         # Get current invoice
-        inv  = None
+        inv = self.active_invoice
+        lines = []
+        if inv and not self.legacy_id:
+            lines = inv.order.lines.filter(oracle_code=self.campground.park.oracle_code)
+        return self.get_vehicle_payment_status(inv, lines)
+
+    def get_vehicle_payment_status(self, inv, lines):
+        """Work out the vehicle payment status from the active invoice and its
+        park entry order lines, so that lists can fetch those in bulk.
+        """
         payment_dict = []
-        references = [i.invoice_reference for i in self.invoices.all()]
-        #temp_invoices = Invoice.objects.filter(reference__in=references,voided=False)
-        temp_invoices = [self.active_invoice] if self.active_invoice else []
-        if len(temp_invoices) == 1 or self.legacy_id:
-            if not self.legacy_id:
-                inv = temp_invoices[0]
+        if inv or self.legacy_id:
             # Get all lines 
             total_paid = D('0.0')
             total_due = D('0.0')
-            lines = []
-            if not self.legacy_id:
-                lines = inv.order.lines.filter(oracle_code=self.campground.park.oracle_code)
+            if self.legacy_id:
+                lines = []
 
             price_dict = {}
             for line in lines:
@@ -1475,7 +1560,8 @@ class CampgroundBookingRangeListener(object):
                     CampgroundBookingRange.objects.create(campsite=instance.campground,range_start=today,status=0)
             except:
                 pass
-        cache.delete('campgrounds_dt')
+        from parkstay import availability
+        availability.refresh_closure_days(instance.campground_id)
 
     @staticmethod
     @receiver(post_save, sender=CampgroundBookingRange)
@@ -1492,6 +1578,8 @@ class CampgroundBookingRangeListener(object):
                     CampgroundBookingRange.objects.create(campground=instance.campground,range_start=instance.range_end+timedelta(days=1),status=0)
                 except BookingRangeWithinException as e:
                     pass
+        from parkstay import availability
+        availability.refresh_closure_days(instance.campground_id)
 
 class CampgroundListener(object):
     """
@@ -1536,6 +1624,24 @@ class CampgroundListener(object):
                         except Exception:
                             pass
 
+class CampgroundGroupListener(object):
+    """
+    Event listener expiring the cached campground permissions
+    """
+
+    @staticmethod
+    @receiver(m2m_changed, sender=CampgroundGroup.members.through)
+    @receiver(m2m_changed, sender=CampgroundGroup.campgrounds.through)
+    def _m2m_changed(sender, action, **kwargs):
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            invalidate_campground_permissions()
+
+    @staticmethod
+    @receiver(post_delete, sender=CampgroundGroup)
+    @receiver(post_delete, sender=Campground)
+    def _post_delete(sender, instance, **kwargs):
+        invalidate_campground_permissions()
+
 class CampsiteBookingRangeListener(object):
     """
     Event listener for CampsiteBookingRange
@@ -1597,6 +1703,8 @@ class CampsiteBookingRangeListener(object):
                     CampsiteBookingRange.objects.create(campsite=instance.campsite,range_start=today,status=0)
             except:
                 pass
+        from parkstay import availability
+        availability.refresh_closure_days(instance.campsite.campground_id, [instance.campsite_id])
 
     @staticmethod
     @receiver(post_save, sender=CampsiteBookingRange)
@@ -1614,6 +1722,37 @@ class CampsiteBookingRangeListener(object):
                     CampsiteBookingRange.objects.create(campsite=instance.campsite,range_start=instance.range_end+timedelta(days=1),status=0)
                 except BookingRangeWithinException as e:
                     pass
+        from parkstay import availability
+        availability.refresh_closure_days(instance.campsite.campground_id, [instance.campsite_id])
+
+class CampsiteBookingListener(object):
+    """
+    Event listener for CampsiteBooking
+    """
+
+    @staticmethod
+    @receiver(pre_save, sender=CampsiteBooking)
+    def _pre_save(sender, instance, **kwargs):
+        if instance.pk:
+            original_instance = CampsiteBooking.objects.filter(pk=instance.pk).values_list('campsite_id', 'date').first()
+            setattr(instance, "_original_day", original_instance)
+        elif hasattr(instance, "_original_day"):
+            delattr(instance, "_original_day")
+
+    @staticmethod
+    @receiver(post_save, sender=CampsiteBooking)
+    def _post_save(sender, instance, **kwargs):
+        from parkstay import availability
+        original_day = getattr(instance, "_original_day", None)
+        if original_day and original_day != (instance.campsite_id, instance.date):
+            availability.booking_changed(*original_day)
+        availability.booking_changed(instance.campsite_id, instance.date)
+
+    @staticmethod
+    @receiver(post_delete, sender=CampsiteBooking)
+    def _post_delete(sender, instance, **kwargs):
+        from parkstay import availability
+        availability.booking_changed(instance.campsite_id, instance.date)
 
 class BookingListener(object):
     """
@@ -1632,6 +1771,63 @@ class BookingListener(object):
         else:
             instance.full_clean()
 
+    @staticmethod
+    @receiver(post_save, sender=Booking)
+    def _post_save(sender, instance, **kwargs):
+        original_instance = getattr(instance, "_original_instance", None)
+        if original_instance and (original_instance.cost_total != instance.cost_total or original_instance.legacy_id != instance.legacy_id):
+            instance.update_payment_summary()
+
+class BookingSearchListener(object):
+    """
+    Event listener keeping the booking search text current
+    """
+
+    @staticmethod
+    @receiver(post_save, sender=Booking)
+    def _booking_saved(sender, instance, **kwargs):
+        Booking.refresh_search_text(booking=instance.pk)
+
+    @staticmethod
+    @receiver(post_save, sender=Campground)
+    def _campground_saved(sender, instance, created, **kwargs):
+        if not created:
+            Booking.refresh_search_text(campground=instance.pk)
+
+    @staticmethod
+    @receiver(post_save, sender=Park)
+    def _park_saved(sender, instance, created, **kwargs):
+        if not created:
+            Booking.refresh_search_text(park=instance.pk)
+
+    @staticmethod
+    @receiver(post_save, sender=Region)
+    def _region_saved(sender, instance, created, **kwargs):
+        if not created:
+            Booking.refresh_search_text(region=instance.pk)
+
+class BookingInvoiceListener(object):
+    """
+    Event listener keeping the booking payment summary current with its invoices
+    """
+
+    @staticmethod
+    @receiver([post_save, post_delete], sender=BookingInvoice)
+    def _booking_invoice_changed(sender, instance, **kwargs):
+        booking = Booking.objects.filter(pk=instance.booking_id).first()
+        if booking:
+            booking.update_payment_summary()
+
+    @staticmethod
+    @receiver(post_save, sender=Invoice)
+    def _invoice_saved(sender, instance, **kwargs):
+        Booking.update_payment_summaries(instance.reference)
+
+    @staticmethod
+    @receiver(payment_summary_updated, sender=Invoice)
+    def _invoice_summary_updated(sender, invoice, **kwargs):
+        Booking.update_payment_summaries(invoice.reference)
+
 class CampsiteListener(object):
     """
     Event listener for Campsites
@@ -1808,3 +2004,11 @@ class ParkEntryRateListener(object):
             price_before = price_before[0]
             price_before.period_end = None
             price_before.save()
+
+# Models the cached payloads and ETags are built from, see parkstay.caching
+PAYLOAD_MODELS = (Campground, CampgroundBookingRange, CampgroundImage, Park, District, Region, Feature)
+MAP_MODELS = (Campground, CampgroundImage, Park, District, Region, Feature, Campsite, CampsiteRate, Rate)
+SUGGEST_MODELS = (Campground, Park, PromoArea)
+AVAILABILITY_MODELS = (Campground, Campsite, CampsiteBooking, CampsiteBookingRange, CampgroundBookingRange,
+                       CampsiteStayHistory, CampgroundStayHistory, CampsiteRate, Rate)
+track_generations(*set(PAYLOAD_MODELS + MAP_MODELS + SUGGEST_MODELS + AVAILABILITY_MODELS))
@@ -58,12 +58,25 @@ TEMPLATES[0]['OPTIONS']['context_processors'].append('parkstay.context_processor
     'required_css_class': 'required-form-field',
     'set_placeholder': False,
 }'''
+# The default cache is shared between workers and holds the payload generation
+# counters, point it at memcached or redis in production.
+# Serialized payloads are versioned by those counters so they can live in a
+# per-process LRU cache, see parkstay.caching.
+# The default cache holds the payload generations and snapshots and must be shared by
+# every host serving parkstay (memcached, redis, or a shared directory for the file
+# cache), otherwise a change on one host doesn't invalidate the others' payloads.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
-        'LOCATION': os.path.join(BASE_DIR, 'parkstay', 'cache'),
+        'BACKEND': env('CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': env('CACHE_LOCATION', os.path.join(BASE_DIR, 'parkstay', 'cache')),
+    },
+    'parkstay_payloads': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'parkstay_payloads',
+        'OPTIONS': {'MAX_ENTRIES': env('PAYLOAD_CACHE_ENTRIES', 200)},
     }
 }
+PARKSTAY_PAYLOAD_CACHE = 'parkstay_payloads'
 STATICFILES_DIRS.append(os.path.join(os.path.join(BASE_DIR, 'parkstay', 'static')))
 
 
@@ -76,6 +89,7 @@ CRON_CLASSES = [
     #'parkstay.cron.SendBookingsConfirmationCronJob',
     'parkstay.cron.UnpaidBookingsReportCronJob',
     'parkstay.cron.OracleIntegrationCronJob',
+    'parkstay.cron.AvailabilityRefreshCronJob',
 ]
 
 # Additional logging for parkstay
@@ -0,0 +1,88 @@
+"""Prerendered map payloads.
+
+The search suggestions and the campground map are the same for every visitor,
+so they are rendered once to JSON and gzip bytes and kept in the shared
+``default`` cache. Snapshot keys carry the generations of the models they are
+built from (see ``parkstay.caching``), so an edit to a campground, park, promo
+area or rate retires the stored snapshot and the next request renders a fresh
+one. ``manage.py build_snapshots`` renders them ahead of time.
+"""
+from collections import namedtuple
+
+import geojson
+from django.core.cache import caches
+from django.db.models import Min
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+from rest_framework.renderers import JSONRenderer
+
+from parkstay.caching import generation_etag
+from parkstay.models import Campground, Park, PromoArea, MAP_MODELS, SUGGEST_MODELS
+from parkstay.serialisers import CampgroundMapSerializer
+
+SNAPSHOT_TIMEOUT = 86400
+
+Snapshot = namedtuple('Snapshot', ('content', 'gzipped'))
+
+
+def build_search_suggest(request):
+    entries = []
+    for x in Campground.objects.filter(wkb_geometry__isnull=False).values_list('id', 'name', 'wkb_geometry'):
+        entries.append(geojson.Point((x[2].x, x[2].y), properties={'type': 'Campground', 'id': x[0], 'name': x[1]}))
+    for x in Park.objects.filter(wkb_geometry__isnull=False).values_list('id', 'name', 'wkb_geometry'):
+        entries.append(geojson.Point((x[2].x, x[2].y), properties={'type': 'Park', 'id': x[0], 'name': x[1]}))
+    for x in PromoArea.objects.filter(wkb_geometry__isnull=False).values_list('id', 'name', 'wkb_geometry'):
+        entries.append(geojson.Point((x[2].x, x[2].y), properties={'type': 'PromoArea', 'id': x[0], 'name': x[1]}))
+    return geojson.dumps(geojson.FeatureCollection(entries)).encode('utf-8')
+
+
+def build_campground_map(request):
+    queryset = Campground.objects.exclude(campground_type=3).annotate(
+        Min('campsites__rates__rate__adult')
+    ).select_related('park__district__region').prefetch_related('features', 'images')
+    serializer = CampgroundMapSerializer(queryset, many=True, context={'request': request})
+    return JSONRenderer().render(serializer.data)
+
+
+# name: (models read, builder, whether the payload embeds absolute urls)
+SNAPSHOTS = {
+    'search_suggest': (SUGGEST_MODELS, build_search_suggest, False),
+    'campground_map': (MAP_MODELS, build_campground_map, True),
+}
+
+
+def _snapshot_key(name, request):
+    models, build, per_host = SNAPSHOTS[name]
+    parts = (request.build_absolute_uri('/'),) if per_host else ()
+    return 'parkstay_snapshot:{}:{}'.format(name, generation_etag(models, parts))
+
+
+def build_snapshot(name, request):
+    """Render the snapshot and store it until its models change."""
+    models, build, per_host = SNAPSHOTS[name]
+    # read the key first so a change made while rendering retires this snapshot
+    key = _snapshot_key(name, request)
+    content = build(request)
+    snapshot = Snapshot(content, compress_string(content))
+    caches['default'].set(key, snapshot, SNAPSHOT_TIMEOUT)
+    return snapshot
+
+
+def get_snapshot(name, request):
+    snapshot = caches['default'].get(_snapshot_key(name, request))
+    if snapshot is None:
+        snapshot = build_snapshot(name, request)
+    return snapshot
+
+
+def snapshot_response(name, request):
+    """Serve the stored snapshot bytes, gzipped if the client accepts it."""
+    snapshot = get_snapshot(name, request)
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = HttpResponse(snapshot.gzipped, content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(snapshot.content, content_type='application/json')
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
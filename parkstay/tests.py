@@ -1,3 +1,196 @@
-from django.test import TestCase
+from datetime import date
 
+from django.test import SimpleTestCase, TestCase, override_settings
 
+from parkstay.availability import AvailabilityMatrix, BOOKED, CLOSED, TOOFAR, class_availability
+from parkstay.benchmarks.availability import compare, synthetic_campground
+from parkstay.benchmarks.data import BENCHMARK_PREFIX, generate
+from parkstay.benchmarks.funnel import ENDPOINTS, Funnel, in_process_checkout
+from parkstay.caching import bump_generation, cached_payload, generation_etag
+from ledger.payments.cash.models import CashTransaction
+from ledger.payments.models import Invoice
+from parkstay.models import Booking, BookingInvoice, CampsiteRate, Park, Rate, Region
+from parkstay.utils import build_rate_runs
+
+
+class AvailabilityMatrixTest(TestCase):
+
+    def setUp(self):
+        super(AvailabilityMatrixTest, self).setUp()
+        self.matrix = AvailabilityMatrix([1, 2], date(2018, 1, 1), date(2018, 1, 8))
+
+    def test_prefilled_open(self):
+        """Test every site starts with an open run
+        """
+        self.assertEqual(self.matrix.clear_sites(), [1, 2])
+        self.assertEqual(self.matrix.status(1, date(2018, 1, 7)), 'open')
+
+    def test_mark_clipped_to_window(self):
+        """Test range writes outside the visit dates are ignored
+        """
+        self.matrix.mark(1, -3, 1, CLOSED)
+        self.matrix.mark_all(6, 99, TOOFAR)
+        self.assertEqual(list(self.matrix.rows[1]), [CLOSED, 0, 0, 0, 0, 0, TOOFAR])
+        self.assertEqual(list(self.matrix.rows[2]), [0, 0, 0, 0, 0, 0, TOOFAR])
+
+    def test_clear_sites_allowed(self):
+        """Test clear_sites only returns sites with allowed statuses
+        """
+        self.matrix.mark(2, 2, 4, BOOKED)
+        self.assertEqual(self.matrix.clear_sites(), [1])
+        self.assertEqual(self.matrix.clear_sites(allowed=(0, BOOKED)), [1, 2])
+
+    def test_as_dict(self):
+        """Test as_dict renders the get_campsite_availability shape
+        """
+        self.matrix.mark(1, 2, 3, BOOKED)
+        result = self.matrix.as_dict()
+        self.assertEqual(result[1][date(2018, 1, 3)], ['booked'])
+        self.assertEqual(result[1][date(2018, 1, 4)], ['open'])
+        self.assertEqual(len(result[2]), 7)
+
+
+class ClassAvailabilityTest(SimpleTestCase):
+
+    def test_matches_legacy_loops(self):
+        """Test the class builder renders the same response as the loops it replaced
+        """
+        for num_sites, num_days in ((1, 1), (6, 0), (12, 7), (60, 28)):
+            sites, matrix, rates = synthetic_campground(num_sites, num_days, seed=num_sites)
+            self.assertTrue(compare(sites, matrix, rates))
+            self.assertTrue(compare(sites, matrix, rates, show_all=True))
+
+    def test_class_counts(self):
+        """Test a class with no free site counts booked and unavailable sites per day
+        """
+        sites, matrix, rates = synthetic_campground(2, 3)
+        sites = [s[:2] + (1, 'Tent') + s[4:] for s in sites]
+        matrix.mark_all(0, 3, 0)
+        matrix.mark(1, 0, 2, BOOKED)
+        matrix.mark(2, 1, 3, CLOSED)
+        result = class_availability(sites, matrix, rates)
+        self.assertEqual(len(result), 1)
+        self.assertEqual([day[3] for day in result[0]['availability']], [[1, 0], [1, 1], [0, 1]])
+        self.assertEqual([day[1] for day in result[0]['availability']],
+                         ['Partially Booked', 'Partially Booked', 'Partially Unavailable'])
+        self.assertFalse(result[0]['price'])
+
+
+class RateRunsTest(TestCase):
+
+    def setUp(self):
+        super(RateRunsTest, self).setUp()
+        self.low, self.high = Rate(id=1, adult='10.00'), Rate(id=2, adult='15.00')
+
+    def campsite_rate(self, campsite, rate, date_start):
+        return CampsiteRate(campsite_id=campsite, rate=rate, date_start=date_start)
+
+    def test_runs_split_on_rate_change(self):
+        """Test a rate change inside the window splits the run
+        """
+        rates = [
+            self.campsite_rate(1, self.low, date(2017, 6, 1)),
+            self.campsite_rate(1, self.high, date(2018, 1, 4)),
+        ]
+        runs = build_rate_runs(rates, [1], date(2018, 1, 1), date(2018, 1, 8))
+        self.assertEqual([(r.start, r.end, r.rate.id) for r in runs], [
+            (date(2018, 1, 1), date(2018, 1, 3), 1),
+            (date(2018, 1, 4), date(2018, 1, 7), 2),
+        ])
+
+    def test_latest_rate_before_window(self):
+        """Test only the latest rate starting before the window applies and equal rates merge
+        """
+        rates = [
+            self.campsite_rate(1, self.high, date(2017, 1, 1)),
+            self.campsite_rate(1, self.low, date(2017, 6, 1)),
+            self.campsite_rate(1, self.low, date(2018, 1, 3)),
+            self.campsite_rate(2, self.high, date(2018, 1, 5)),
+        ]
+        runs = build_rate_runs(rates, [1, 2, 3], date(2018, 1, 1), date(2018, 1, 8))
+        self.assertEqual([(r.campsite, r.start, r.end, r.rate.id) for r in runs], [
+            (1, date(2018, 1, 1), date(2018, 1, 7), 1),
+            (2, date(2018, 1, 5), date(2018, 1, 7), 2),
+        ])
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tests'}},
+    PARKSTAY_PAYLOAD_CACHE='default'
+)
+class CachedPayloadTest(SimpleTestCase):
+
+    def setUp(self):
+        super(CachedPayloadTest, self).setUp()
+        self.builds = []
+
+    def build(self):
+        self.builds.append(1)
+        return len(self.builds)
+
+    def test_cached_until_generation_bumped(self):
+        """Test a payload is rebuilt only after one of its models changes
+        """
+        self.assertEqual(cached_payload('parks', (Park, Region), self.build), 1)
+        self.assertEqual(cached_payload('parks', (Park, Region), self.build), 1)
+        bump_generation(Region)
+        self.assertEqual(cached_payload('parks', (Park, Region), self.build), 2)
+
+    def test_parts_in_key(self):
+        """Test payloads differing in their parts are cached separately
+        """
+        self.assertEqual(cached_payload('parks', (Park,), self.build, parts=('a',)), 1)
+        self.assertEqual(cached_payload('parks', (Park,), self.build, parts=('b',)), 2)
+        self.assertEqual(cached_payload('parks', (Park,), self.build, parts=('a',)), 1)
+
+    def test_etag_follows_generations(self):
+        """Test the ETag only changes when one of its models changes
+        """
+        etag = generation_etag((Park, Region), ('a',))
+        self.assertEqual(generation_etag((Park, Region), ('a',)), etag)
+        self.assertNotEqual(generation_etag((Park, Region), ('b',)), etag)
+        bump_generation(Park)
+        self.assertNotEqual(generation_etag((Park, Region), ('a',)), etag)
+
+
+class FunnelTest(TestCase):
+
+    def setUp(self):
+        generate(regions=1, parks=1, campgrounds=2, campsites=4, customers=5, days=180, occupancy=0.3)
+
+    def test_measure_each_endpoint(self):
+        """Test every funnel endpoint can be measured against generated data
+        """
+        funnel = Funnel()
+        with in_process_checkout():
+            for endpoint in ENDPOINTS:
+                invoices = BookingInvoice.objects.count()
+                elapsed, queries, status_code = funnel.measure(endpoint)
+                self.assertLess(status_code, 500, endpoint)
+                self.assertGreater(queries, 0, endpoint)
+                if endpoint == 'create_booking':
+                    self.assertEqual(status_code, 200)
+                if endpoint == 'make_booking':
+                    # the booking went through pricing, the order and the invoice
+                    self.assertEqual(BookingInvoice.objects.count(), invoices + 1)
+
+
+class BookingSummaryTest(TestCase):
+
+    def test_save_keeps_invoice_summary(self):
+        """Test saving a booking loaded before its invoice was added doesn't undo the invoice summary
+        """
+        generate(regions=1, parks=1, campgrounds=1, campsites=1, customers=1, days=30, occupancy=0.5)
+        booking = Booking.objects.filter(campground__name__startswith=BENCHMARK_PREFIX).first()
+        BookingInvoice.objects.filter(booking=booking).delete()
+        invoice = Invoice.objects.create(amount=booking.cost_total, order_number='SUMMARYTEST', reference='9990000000001', system='0019')
+        CashTransaction.objects.create(invoice=invoice, amount=invoice.amount, type='payment', source='eftpos')
+
+        stale = Booking.objects.get(pk=booking.pk)
+        self.assertFalse(stale.paid)
+        BookingInvoice.objects.create(booking=booking, invoice_reference=invoice.reference)
+        stale.booking_type = 1
+        stale.save()
+
+        self.assertTrue(stale.paid)
+        self.assertEqual(Booking.objects.get(pk=booking.pk).summary_payment_status, 'paid')
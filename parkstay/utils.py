@@ -1,3 +1,4 @@
+from collections import OrderedDict, namedtuple
 from datetime import datetime, timedelta, date
 import traceback
 from decimal import *
@@ -11,7 +12,8 @@ from django.db.models import Q
 from django.utils import timezone
 
 from ledger.payments.models import Invoice,OracleInterface,CashTransaction
-from ledger.payments.utils import oracle_parser,update_payments
+from ledger.payments.utils import oracle_parser,update_payments,internalCheckout
+from parkstay.availability import build_availability_matrix, closure_filter, reserve_campsite
 from parkstay.models import (Campground, Campsite, CampsiteRate, CampsiteBooking, Booking, BookingInvoice, CampsiteBookingRange, Rate, CampgroundBookingRange,CampgroundStayHistory, CampsiteRate, ParkEntryRate, BookingVehicleRego)
 from parkstay.serialisers import BookingRegoSerializer, CampsiteRateSerializer, ParkEntryRateSerializer,RateSerializer,CampsiteRateReadonlySerializer
 from parkstay.emails import send_booking_invoice,send_booking_confirmation
@@ -39,28 +41,22 @@ def create_booking_by_class(campground_id, campsite_class_id, start_date, end_da
             raise ValidationError('No matching campsites found.')
 
         # get availability for sites, filter out the non-clear runs
-        availability = get_campsite_availability(sites_qs, start_date, end_date)
-        excluded_site_ids = set()
-        for site_id, dates in availability.items():
-            if not all([v[0] == 'open' for k, v in dates.items()]):
-                excluded_site_ids.add(site_id)
+        clear_site_ids = set(build_availability_matrix(sites_qs, start_date, end_date).clear_sites())
 
         # create a list of campsites without bookings for that period
-        sites = [x for x in sites_qs if x.pk not in excluded_site_ids]
+        sites = [x for x in sites_qs if x.pk in clear_site_ids]
 
         if not sites:
             raise ValidationError('Campsite class unavailable for specified time period.')
 
-        # TODO: add campsite sorting logic based on business requirements
-        # for now, pick the first campsite in the list
-        site = sites[0]
-
-        # Prevent booking if max people passed
+        # Only try the campsites that take the number of people
         total_people = num_adult + num_concession + num_child + num_infant
-        if total_people > site.max_people:
-            raise ValidationError('Maximum number of people exceeded for the selected campsite')
-        # Prevent booking if less than min people 
-        if total_people < site.min_people:
+        fitting = [x for x in sites if x.min_people <= total_people <= x.max_people]
+        if not fitting:
+            # Prevent booking if max people passed
+            if all(total_people > x.max_people for x in sites):
+                raise ValidationError('Maximum number of people exceeded for the selected campsite')
+            # Prevent booking if less than min people
             raise ValidationError('Number of people is less than the minimum allowed for the selected campsite')
 
         # Create a new temporary booking with an expiry timestamp (default 20mins)
@@ -77,13 +73,10 @@ def create_booking_by_class(campground_id, campsite_class_id, start_date, end_da
                         expiry_time=timezone.now()+timedelta(seconds=settings.BOOKING_TIMEOUT),
                         campground=campground
                     )
-        for i in range((end_date-start_date).days):
-            cb =    CampsiteBooking.objects.create(
-                        campsite=site,
-                        booking_type=3,
-                        date=start_date+timedelta(days=i),
-                        booking=booking
-                    )
+        # TODO: add campsite sorting logic based on business requirements
+        # for now, reserve the first fitting campsite that hasn't been taken by a concurrent booking
+        if not any(reserve_campsite(x.pk, booking, start_date, end_date) for x in fitting):
+            raise ValidationError('Campsite class unavailable for specified time period.')
 
     # On success, return the temporary booking
     return booking
@@ -135,13 +128,8 @@ def create_booking_by_site(campsite_id, start_date, end_date, num_adult=0, num_c
                         campground=campsite.campground,
                         customer = customer
                     )
-        for i in range((end_date-start_date).days):
-            cb =    CampsiteBooking.objects.create(
-                        campsite=campsite,
-                        booking_type=3,
-                        date=start_date+timedelta(days=i),
-                        booking=booking
-                    )
+        if not reserve_campsite(campsite.pk, booking, start_date, end_date):
+            raise ValidationError('Campsite unavailable for specified time period.')
 
     # On success, return the temporary booking
     return booking
@@ -163,131 +151,20 @@ def get_open_campgrounds(campsites_qs, start_date, end_date):
         campground__max_advance_booking__lt=(start_date-today).days 
     )
 
-    # get closures at campsite and campground level
-    cgbr_qs =    CampgroundBookingRange.objects.filter(
-        Q(campground__in=[x[0] for x in campsites_qs.distinct('campground').values_list('campground')]),
-        Q(status=1),
-        Q(range_start__lt=end_date) & (Q(range_end__gte=start_date)|Q(range_end__isnull=True))
-    )
-    cgbr = set([x[0] for x in cgbr_qs.values_list('campground')])
-
-    csbr_qs =    CampsiteBookingRange.objects.filter(
-        Q(campsite__in=campsites_qs),
-        Q(status=1),
-        Q(range_start__lt=end_date) & (Q(range_end__gte=start_date)|Q(range_end__isnull=True))
+    # remove closures at campsite and campground level as subqueries, so the
+    # whole lookup runs as a single statement
+    campsites_qs = campsites_qs.exclude(
+        pk__in=CampsiteBookingRange.objects.filter(closure_filter(start_date, end_date)).values('campsite')
+    ).exclude(
+        campground__in=CampgroundBookingRange.objects.filter(closure_filter(start_date, end_date)).values('campground')
     )
-    csbr = set([x[0] for x in csbr_qs.values_list('campsite')])
-
-    # generate a campground-to-campsite-list map with closures removed
-    campground_map = {}
-    for cs in campsites_qs:
-        if (cs.pk in csbr) or (cs.campground.pk in cgbr):
-            continue
-        if cs.campground.pk not in campground_map:
-            campground_map[cs.campground.pk] = []
-        campground_map[cs.campground.pk].append(cs.pk)
 
-    return set(campground_map.keys())
+    return set(campsites_qs.order_by().values_list('campground', flat=True).distinct())
 
 
 def get_campsite_availability(campsites_qs, start_date, end_date):
     """Fetch the availability of each campsite in a queryset over a range of visit dates."""
-    # fetch all of the single-day CampsiteBooking objects within the date range for the sites
-    bookings_qs =   CampsiteBooking.objects.filter(
-                        campsite__in=campsites_qs,
-                        date__gte=start_date,
-                        date__lt=end_date
-                    ).order_by('date', 'campsite__name')
-
-    # prefill all slots as 'open'
-    duration = (end_date-start_date).days
-    results = {site.pk: {start_date+timedelta(days=i): ['open', ] for i in range(duration)} for site in campsites_qs}
-
-    # strike out existing bookings
-    for b in bookings_qs:
-        results[b.campsite.pk][b.date][0] = 'closed' if b.booking_type == 2 else 'booked'
-
-    # generate a campground-to-campsite-list map
-    campground_map = {cg[0]: [cs.pk for cs in campsites_qs if cs.campground.pk == cg[0]] for cg in campsites_qs.distinct('campground').values_list('campground')}
-
-    # strike out whole campground closures
-    cgbr_qs =    CampgroundBookingRange.objects.filter(
-        Q(campground__in=campground_map.keys()),
-        Q(status=1),
-        Q(range_start__lt=end_date) & (Q(range_end__gte=start_date)|Q(range_end__isnull=True))
-    )
-    for closure in cgbr_qs:
-        start = max(start_date, closure.range_start)
-        end = min(end_date, closure.range_end) if closure.range_end else end_date
-        today = date.today()
-        diff = (end-start).days + 1
-        for i in range(diff):
-            for cs in campground_map[closure.campground.pk]:
-                #results[cs][start+timedelta(days=i)][0] = 'closed'
-                if start+timedelta(days=i) == today:
-                    if not closure.campground._is_open(start+timedelta(days=i)):
-                        if start+timedelta(days=i) in results[cs]:
-                            results[cs][start+timedelta(days=i)][0] = 'closed'
-                else:
-                    if start+timedelta(days=i) in results[cs]:
-                        results[cs][start+timedelta(days=i)][0] = 'closed'
-
-    # strike out campsite closures
-    csbr_qs =    CampsiteBookingRange.objects.filter(
-        Q(campsite__in=campsites_qs),
-        Q(status=1),
-        Q(range_start__lt=end_date) & (Q(range_end__gte=start_date)|Q(range_end__isnull=True))
-    )
-    for closure in csbr_qs:
-        start = max(start_date, closure.range_start)
-        end = min(end_date, closure.range_end) if closure.range_end else end_date
-        today = date.today()
-        diff = (end-start).days + 1
-        for i in range(diff):
-            #results[closure.campsite.pk][start+timedelta(days=i)][0] = 'closed'
-            if start+timedelta(days=i) == today:
-                if not closure.campsite._is_open(start+timedelta(days=i)):
-                    if start+timedelta(days=i) in results[closure.campsite.pk]:
-                        results[closure.campsite.pk][start+timedelta(days=i)][0] = 'closed'
-            else:
-                if start+timedelta(days=i) in results[closure.campsite.pk]:
-                    results[closure.campsite.pk][start+timedelta(days=i)][0] = 'closed'
-                
-
-    # strike out days before today
-    today = date.today()
-    if start_date < today:
-        for i in range((min(today, end_date)-start_date).days):
-            for key, val in results.items():
-                val[start_date+timedelta(days=i)][0] = 'tooearly'
-
-    # strike out days after the max_advance_booking
-    for site in campsites_qs:
-        stop = today + timedelta(days=site.campground.max_advance_booking)
-        stop_mark = min(max(stop, start_date), end_date)
-        if start_date > stop:
-            for i in range((end_date-stop_mark).days):
-                results[site.pk][stop_mark+timedelta(days=i)][0] = 'toofar'
-
-    # Get the current stay history
-    stay_history = CampgroundStayHistory.objects.filter(
-                    Q(range_start__lte=start_date,range_end__gte=start_date)|# filter start date is within period
-                    Q(range_start__lte=end_date,range_end__gte=end_date)|# filter end date is within period
-                    Q(Q(range_start__gt=start_date,range_end__lt=end_date)&Q(range_end__gt=today)) #filter start date is before and end date after period
-                    ,campground=campsites_qs.first().campground)
-    if stay_history:
-        max_days = min([x.max_days for x in stay_history])
-    else:
-        max_days = settings.PS_MAX_BOOKING_LENGTH
-
-    # strike out days after the max_stay period
-    for site in campsites_qs:
-        stop = start_date + timedelta(days=max_days)
-        stop_mark = min(max(stop, start_date), end_date)
-        for i in range((end_date-stop_mark).days):
-            results[site.pk][stop_mark+timedelta(days=i)][0] = 'toofar'
-
-    return results
+    return build_availability_matrix(campsites_qs, start_date, end_date).as_dict()
 
 
 def get_visit_rates(campsites_qs, start_date, end_date):
@@ -354,29 +231,23 @@ def get_available_campsitetypes(campground_id,start_date,end_date,_list=True):
         else:
             available_campsiteclasses = {}
 
+        # get availability for every site in the campground in one pass, filter out the non-clear runs
+        sites_qs = Campsite.objects.filter(campground=campground_id)
+        clear_site_ids = set(build_availability_matrix(sites_qs, start_date, end_date).clear_sites())
+
+        # group the campsites without bookings for that period by class
+        class_sites = {}
+        for site in sites_qs:
+            if site.pk in clear_site_ids:
+                class_sites.setdefault(site.campsite_class_id, []).append(site)
+
         for _class in cg.campsite_classes:
-            sites_qs =  Campsite.objects.filter(
-                            campground=campground_id,
-                            campsite_class=_class
-                        )
-
-            if sites_qs.exists():
-
-                # get availability for sites, filter out the non-clear runs
-                availability = get_campsite_availability(sites_qs, start_date, end_date)
-                excluded_site_ids = set()
-                for site_id, dates in availability.items():
-                    if not all([v[0] == 'open' for k, v in dates.items()]):
-                        excluded_site_ids.add(site_id)
-
-                # create a list of campsites without bookings for that period
-                sites = [x for x in sites_qs if x.pk not in excluded_site_ids]
-
-                if sites:
-                    if not _list:
-                        available_campsiteclasses[_class] = sites
-                    else:
-                        available_campsiteclasses.append(_class)
+            sites = class_sites.get(_class)
+            if sites:
+                if not _list:
+                    available_campsiteclasses[_class] = sites
+                else:
+                    available_campsiteclasses.append(_class)
 
         return available_campsiteclasses
     except Campground.DoesNotExist:
@@ -415,16 +286,51 @@ def get_available_campsites_list_booking(campsite_qs,request, start_date, end_da
 
     return available
 
+RateRun = namedtuple('RateRun', ['campsite', 'start', 'end', 'rate'])
+
+def build_rate_runs(campsite_rates, campsite_ids, start_date, end_date):
+    """Turn the rate history of campsites into runs of nights sharing a rate.
+    campsite_rates must be ordered by campsite, date_start and id.
+    Returns RateRun(campsite, start, end, rate) tuples where end is the last
+    night the rate applies to.
+    """
+    history = {}
+    for cr in campsite_rates:
+        history.setdefault(cr.campsite_id, []).append(cr)
+    runs = []
+    for campsite_id in campsite_ids:
+        # the latest rate starting on a day wins, as does the latest one before the window
+        changes = OrderedDict()
+        for cr in history.get(campsite_id, []):
+            changes[max(cr.date_start, start_date)] = cr.rate
+        days = list(changes.keys())
+        for i, day in enumerate(days):
+            rate = changes[day]
+            end = (days[i+1] if i+1 < len(days) else end_date) - timedelta(days=1)
+            if runs and runs[-1].campsite == campsite_id and runs[-1].rate.id == rate.id:
+                runs[-1] = runs[-1]._replace(end=end)
+            else:
+                runs.append(RateRun(campsite_id, day, end, rate))
+    return runs
+
+def get_campsite_rate_runs(campsite_ids, start_date, end_date):
+    """Resolve the rates of a set of campsites between start_date and
+    end_date with a single query.
+    """
+    campsite_rates = CampsiteRate.objects.filter(
+        campsite__in=campsite_ids, date_start__lt=end_date
+    ).select_related('rate').order_by('campsite', 'date_start', 'id')
+    return build_rate_runs(campsite_rates, campsite_ids, start_date, end_date)
+
 def get_campsite_current_rate(request,campsite_id,start_date,end_date):
     res = []
     if start_date and end_date:
         start_date = datetime.strptime(start_date,"%Y-%m-%d").date()
         end_date = datetime.strptime(end_date,"%Y-%m-%d").date()
-        for single_date in daterange(start_date, end_date):
-            price_history = CampsiteRate.objects.filter(campsite=campsite_id,date_start__lte=single_date).order_by('-date_start')
-            if price_history:
-                rate = RateSerializer(price_history[0].rate,context={'request':request}).data
-                rate['campsite'] = campsite_id
+        for run in get_campsite_rate_runs([campsite_id], start_date, end_date):
+            rate = RateSerializer(run.rate,context={'request':request}).data
+            rate['campsite'] = campsite_id
+            for single_date in daterange(run.start, run.end + timedelta(days=1)):
                 res.append({
                     "date" : single_date.strftime("%Y-%m-%d") ,
                     "rate" : rate
@@ -444,23 +350,13 @@ def get_park_entry_rate(request,start_date):
 
 def price_or_lineitems(request,booking,campsite_list,lines=True,old_booking=None):
     total_price = Decimal(0)
-    rate_list = {}
     invoice_lines = []
     if not lines and not old_booking:
         raise Exception('An old booking is required if lines is set to false')
     # Create line items for customers
-    daily_rates = [get_campsite_current_rate(request,c,booking.arrival.strftime('%Y-%m-%d'),booking.departure.strftime('%Y-%m-%d')) for c in campsite_list]
-    if not daily_rates:
+    if not campsite_list:
         raise Exception('There was an error while trying to get the daily rates.')
-    for rates in daily_rates:
-        for c in rates:
-            if c['rate']['campsite'] not in rate_list.keys():
-                rate_list[c['rate']['campsite']] = {c['rate']['id']:{'start':c['date'],'end':c['date'],'adult':c['rate']['adult'],'concession':c['rate']['concession'],'child':c['rate']['child'],'infant':c['rate']['infant']}}
-            else:
-                if c['rate']['id'] not in rate_list[c['rate']['campsite']].keys():
-                    rate_list[c['rate']['campsite']] = {c['rate']['id']:{'start':c['date'],'end':c['date'],'adult':c['rate']['adult'],'concession':c['rate']['concession'],'child':c['rate']['child'],'infant':c['rate']['infant']}}
-                else:
-                    rate_list[c['rate']['campsite']][c['rate']['id']]['end'] = c['date']
+    rate_runs = get_campsite_rate_runs(campsite_list, booking.arrival, booking.departure)
     # Get Guest Details
     guests = {}
     for k,v in booking.details.items():
@@ -468,22 +364,18 @@ def price_or_lineitems(request,booking,campsite_list,lines=True,old_booking=None
             guests[k.split('num_')[1]] = v
     for k,v in guests.items():
         if int(v) > 0:
-            for c,p in rate_list.items():
-                for i,r in p.items():
-                    price = Decimal(0)
-                    end = datetime.strptime(r['end'],"%Y-%m-%d").date()
-                    start = datetime.strptime(r['start'],"%Y-%m-%d").date()
-                    num_days = int ((end - start).days) + 1
-                    campsite = Campsite.objects.get(id=c)
-                    if lines:
-                        price = str((num_days * Decimal(r[k])))
-                        if not booking.campground.oracle_code:
-                            raise Exception('The campground selected does not have an Oracle code attached to it.')
-                        end_date = end + timedelta(days=1)
-                        invoice_lines.append({'ledger_description':'Camping fee {} ({} - {})'.format(k,start.strftime('%d-%m-%Y'),end_date.strftime('%d-%m-%Y')),"quantity":v,"price_incl_tax":price,"oracle_code":booking.campground.oracle_code})
-                    else:
-                        price = (num_days * Decimal(r[k])) * v
-                        total_price += price
+            for r in rate_runs:
+                price = Decimal(0)
+                num_days = int ((r.end - r.start).days) + 1
+                if lines:
+                    price = str((num_days * Decimal(getattr(r.rate, k))))
+                    if not booking.campground.oracle_code:
+                        raise Exception('The campground selected does not have an Oracle code attached to it.')
+                    end_date = r.end + timedelta(days=1)
+                    invoice_lines.append({'ledger_description':'Camping fee {} ({} - {})'.format(k,r.start.strftime('%d-%m-%Y'),end_date.strftime('%d-%m-%Y')),"quantity":v,"price_incl_tax":price,"oracle_code":booking.campground.oracle_code})
+                else:
+                    price = (num_days * Decimal(getattr(r.rate, k))) * v
+                    total_price += price
     # Create line items for vehicles
     if lines:
         vehicles = booking.regos.all()
@@ -570,8 +462,8 @@ def create_temp_bookingupdate(request,arrival,departure,booking_details,old_book
     booking_departure = booking.departure.strftime('%d-%m-%Y')
     reservation = "Reservation for {} from {} to {} at {}".format('{} {}'.format(booking.customer.first_name,booking.customer.last_name),booking_arrival,booking_departure,booking.campground.name)
     # Proceed to generate invoice
-    checkout_response = checkout(request,booking,lines,invoice_text=reservation,internal=True)
-    internal_create_booking_invoice(booking, checkout_response)
+    invoice = internal_checkout(booking,lines,invoice_text=reservation)
+    internal_create_booking_invoice(booking, invoice)
 
 
     # Get the new invoice
@@ -767,7 +659,7 @@ def create_or_update_booking(request,booking_details,updating=False):
         booking.save()
     return booking
 
-def checkout(request, booking, lines, invoice_text=None, vouchers=[], internal=False):
+def checkout(request, booking, lines, invoice_text=None, vouchers=[]):
     JSON_REQUEST_HEADER_PARAMS = {
         "Content-Type": "application/json",
         "Accept": "application/json",
@@ -780,15 +672,13 @@ def checkout(request, booking, lines, invoice_text=None, vouchers=[], internal=F
             'fallback_url': request.build_absolute_uri('/'),
             'return_url': request.build_absolute_uri(reverse('public_booking_success')),
             'forceRedirect': True,
-            'proxy': True if internal else False,
             "products": lines,
             "custom_basket": True,
             "invoice_text": invoice_text,
             "vouchers": vouchers,
         }
-        if not internal:
-            parameters["check_url"] = request.build_absolute_uri('/api/booking/{}/booking_checkout_status.json'.format(booking.id))
-        if internal or request.user.is_anonymous():
+        parameters["check_url"] = request.build_absolute_uri('/api/booking/{}/booking_checkout_status.json'.format(booking.id))
+        if request.user.is_anonymous():
             parameters['basket_owner'] = booking.customer.id
 
 
@@ -816,16 +706,16 @@ def checkout(request, booking, lines, invoice_text=None, vouchers=[], internal=F
         e.args = (http_error_msg,)
         raise
 
-def internal_create_booking_invoice(booking, checkout_response):
-    if not checkout_response.history:
-        raise Exception('There was a problem retrieving the invoice for this booking')
-    last_redirect = checkout_response.history[-2]
-    reference = last_redirect.url.split('=')[1]
-    try:
-        Invoice.objects.get(reference=reference)
-    except Invoice.DoesNotExist:
-        raise Exception("There was a problem attaching an invoice for this booking")
-    book_inv = BookingInvoice.objects.create(booking=booking,invoice_reference=reference)
+def internal_checkout(booking, lines, invoice_text=None, vouchers=None):
+    ''' Create the basket, order and invoice of an internal booking in process
+        instead of going through the checkout views.
+    '''
+    vouchers = vouchers or []
+    basket, order, invoice = internalCheckout(lines, booking.customer, 'S019', custom_basket=True, vouchers=vouchers, invoice_text=invoice_text)
+    return invoice
+
+def internal_create_booking_invoice(booking, invoice):
+    book_inv = BookingInvoice.objects.create(booking=booking,invoice_reference=invoice.reference)
     return book_inv
 
 
@@ -843,11 +733,11 @@ def internal_booking(request,booking_details,internal=True,updating=False):
             lines = price_or_lineitems(request,booking,booking.campsite_id_list)
 
             # Proceed to generate invoice
-            checkout_response = checkout(request,booking,lines,invoice_text=reservation,internal=True)
+            invoice = internal_checkout(booking,lines,invoice_text=reservation)
             # Change the type of booking
             booking.booking_type = 0
             booking.save()
-            internal_create_booking_invoice(booking, checkout_response)
+            internal_create_booking_invoice(booking, invoice)
             delete_session_booking(request.session)
             send_booking_invoice(booking)
             return booking